@@ -1,3 +1,6 @@
+import zlib
+
+from django.conf import settings
 from django.core.cache import cache
 from django.template.defaultfilters import linebreaks, linebreaksbr
 from django.templatetags.static import static
@@ -5,6 +8,7 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 from jinja2 import Environment, nodes
 from jinja2.ext import Extension
+from markupsafe import Markup
 
 from busstops.templatetags.urlise import urlise
 from vehicles.context_processors import _liveries_css_version
@@ -58,9 +62,15 @@ class FragmentCacheExtension(Extension):
         # it in the cache.
         rv = cache.get(key)
         if rv is not None:
+            if type(rv) is bytes:
+                rv = Markup(zlib.decompress(rv).decode())
             return rv
         rv = caller()
-        cache.set(key, rv, timeout)
+
+        # compressed, because some fragments (timetables) can be huge
+        compressed = zlib.compress(rv.encode())
+        if len(compressed) <= settings.FRAGMENT_CACHE_MAX_SIZE:
+            cache.set(key, compressed, timeout)
         return rv
 
 
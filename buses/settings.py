@@ -155,6 +155,12 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = None
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 2000
 
 REDIS_URL = os.environ.get("REDIS_URL")
+# store live vehicle locations in Redis in a compact binary format, instead of JSON
+BINARY_LIVE_STATE = bool(os.environ.get("BINARY_LIVE_STATE", False))
+# publish live vehicle locations to Redis for vehicles_stream (only works under ASGI)
+VEHICLES_STREAM = bool(os.environ.get("VEHICLES_STREAM", False))
+# don't cache template fragments (timetables) bigger than this, after compression
+FRAGMENT_CACHE_MAX_SIZE = 1_000_000
 
 HUEY = {
     "name": "bustimes",
@@ -1,7 +1,10 @@
 """Tests for the buses app"""
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
 from . import utils
+from .jinja2 import environment
 
 
 class UtilsTests(TestCase):
@@ -32,3 +35,25 @@ class UtilsTests(TestCase):
 </marquee>
 """,
         )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class FragmentCacheTests(TestCase):
+    """Tests for the Jinja {% cache %} tag"""
+
+    def test_cache(self):
+        template = environment(autoescape=True).from_string(
+            "{% cache key, 60 %}<b>{{ value }}</b>{% endcache %}"
+        )
+
+        self.assertEqual(template.render(key="a", value="&"), "<b>&amp;</b>")
+        self.assertIsInstance(cache.get("a"), bytes)  # compressed
+        # from the cache
+        self.assertEqual(template.render(key="a", value="b"), "<b>&amp;</b>")
+
+        # too big to cache
+        with override_settings(FRAGMENT_CACHE_MAX_SIZE=10):
+            self.assertEqual(template.render(key="c", value="d"), "<b>d</b>")
+        self.assertIsNone(cache.get("c"))
@@ -1,5 +1,4 @@
 import logging
-import xml.etree.ElementTree as ET
 from pathlib import Path
 
 import requests
@@ -11,6 +10,7 @@ from django.core.management.base import BaseCommand
 from django.utils.timezone import make_aware
 
 from busstops.models import AdminArea, DataSource, Locality, StopArea, StopPoint
+from transxchange.parser import iterparse
 
 logger = logging.getLogger(__name__)
 
@@ -287,7 +287,12 @@ class Command(BaseCommand):
 
         self.stop_areas = {}
 
-        iterator = ET.iterparse(path, events=["start", "end"])
+        iterator = iterparse(
+            path,
+            "http://www.naptan.org.uk/",
+            ("NaPTAN", "StopPoint", "StopArea"),
+            ("start", "end"),
+        )
         for event, element in iterator:
             if event == "start":
                 if element.tag == "{http://www.naptan.org.uk/}NaPTAN":
@@ -299,7 +304,6 @@ class Command(BaseCommand):
 
                 continue
 
-            element.tag = element.tag.removeprefix("{http://www.naptan.org.uk/}")
             if element.tag == "StopPoint":
                 atco_code = element.findtext("AtcoCode")
                 if atco_code[:3] != atco_code_prefix:
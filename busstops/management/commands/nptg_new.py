@@ -1,11 +1,12 @@
 import logging
-import xml.etree.ElementTree as ET
 
 import requests
 from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
 from django.core.management.base import BaseCommand
 
+from transxchange.parser import iterparse
+
 from ...models import AdminArea, DataSource, District, Locality, Region
 from .naptan_new import get_datetime
 
@@ -110,7 +111,12 @@ class Command(BaseCommand):
         admin_areas = AdminArea.objects.only("modified_at").in_bulk()
         districts = District.objects.only("modified_at").in_bulk()
 
-        iterator = ET.iterparse(path, events=["start", "end"])
+        iterator = iterparse(
+            path,
+            "http://www.naptan.org.uk/",
+            ("NationalPublicTransportGazetteer", "Regions", "NptgLocalities"),
+            ("start", "end"),
+        )
         for event, element in iterator:
             if event == "start":
                 if (
@@ -127,8 +133,6 @@ class Command(BaseCommand):
 
                 continue
 
-            element.tag = element.tag.removeprefix("{http://www.naptan.org.uk/}")
-
             if element.tag == "Regions":
                 for item in self.handle_regions(element):
                     if type(item) is Region:
@@ -979,13 +979,11 @@ class Service(models.Model):
         if line_names:
             cache_key += line_names
         if also_services:
-            cache_key += [
-                f"{s.id}:{self.modified_at.timestamp()}" for s in also_services
-            ]
+            cache_key += [f"{s.id}:{s.modified_at.timestamp()}" for s in also_services]
         cache_key += [str(r.id) for r in timetable.current_routes]
 
         if timetable.calendar:
-            cache_key += str(timetable.calendar.id)
+            cache_key.append(str(timetable.calendar.id))
         elif timetable.calendars:
             cache_key += [str(calendar_id) for calendar_id in timetable.calendar_ids]
 
@@ -1032,6 +1030,45 @@ class Service(models.Model):
 
         return stop_usages
 
+    def do_timetable_layouts(self):
+        """Build and cache the timetable grids for the dates/calendars a visitor
+        might choose, so that rendering the page only has to fill in the times
+        """
+        line_names = self.get_line_names()
+        timetable = self.get_timetable(line_names=line_names)
+        if not timetable or not timetable.routes:
+            return
+
+        timetables = [timetable]
+        if timetable.calendar_options:
+            timetables += [
+                self.get_timetable(calendar_id=calendar_id, line_names=line_names)
+                for calendar_id, _ in timetable.calendar_options
+                if calendar_id != timetable.calendar.id
+            ]
+        elif timetable.calendars and not timetable.calendar:
+            # lots of dates will have the same calendars and routes, and so the same
+            # layout - so only build a timetable for the first of each
+            date_keys = {timetable.get_date_key(timetable.date)}
+            for date in timetable.date_options:
+                if date == timetable.date:
+                    continue
+                date_key = timetable.get_date_key(date)
+                if date_key is not None:
+                    if date_key in date_keys:
+                        continue
+                    date_keys.add(date_key)
+                timetables.append(self.get_timetable(date, line_names=line_names))
+
+        # (some might still have the same layout)
+        layout_keys = set()
+        for timetable in timetables:
+            if timetable:
+                layout_key = timetable.get_layout_key()
+                if layout_key not in layout_keys:
+                    layout_keys.add(layout_key)
+                    timetable.render(save_layout=True)
+
     def update_description(self):
         routes = self.route_set.all()
 
@@ -0,0 +1,274 @@
+"""Reading GTFS feeds without holding the whole feed in memory.
+
+gtfs_kit.read_feed reads every file of a feed into a DataFrame up front, which for a
+big feed means gigabytes of stop times and shapes. Here, the small files (agency.txt,
+routes.txt, trips.txt, calendar.txt etc) are only read when they're first used,
+shapes.txt is boiled down to an array of coordinates, and stop_times.txt is read
+a chunk of whole trips at a time, straight out of the zip file.
+
+Columns have the same types as they would with gtfs_kit
+"""
+
+import zipfile
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from gtfs_kit.constants import DTYPE
+from shapely.geometry import LineString
+from shapely.ops import linemerge
+
+
+class Feed:
+    def __init__(self, path, chunk_size=100_000):
+        """`path` is a zip file or a directory of .txt files"""
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.archive = zipfile.ZipFile(self.path) if self.path.is_file() else None
+        self.trip_ids = None  # all of them
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+
+    def open(self, name):
+        if self.archive:
+            if name in self.archive.NameToInfo:
+                return self.archive.open(name)
+        elif (self.path / name).exists():
+            return (self.path / name).open("rb")
+
+    def read_csv(self, name, columns=None, chunksize=None):
+        """A file as a DataFrame (or, with `chunksize`, an iterator of DataFrames),
+        or None if it's missing or empty
+        """
+        open_file = self.open(name)
+        if open_file is None:
+            return
+        try:
+            reader = pd.read_csv(
+                open_file,
+                dtype=DTYPE,
+                encoding="utf-8-sig",  # ignore any byte order mark
+                usecols=columns and (lambda column: column.strip() in columns),
+                chunksize=chunksize,
+            )
+        except pd.errors.EmptyDataError:
+            open_file.close()
+            return
+
+        if chunksize:
+            return self.read_chunks(open_file, reader)
+
+        open_file.close()
+        if not reader.empty:
+            reader.columns = reader.columns.str.strip()
+            return reader
+
+    @staticmethod
+    def read_chunks(open_file, reader):
+        with open_file, reader:
+            for chunk in reader:
+                chunk.columns = chunk.columns.str.strip()
+                yield chunk
+
+    @cached_property
+    def agency(self):
+        return self.read_csv("agency.txt")
+
+    @cached_property
+    def stops(self):
+        return self.read_csv("stops.txt")
+
+    @cached_property
+    def routes(self):
+        return self.read_csv("routes.txt")
+
+    @cached_property
+    def trips(self):
+        return self.read_csv("trips.txt")
+
+    @cached_property
+    def calendar(self):
+        return self.read_csv("calendar.txt")
+
+    @cached_property
+    def calendar_dates(self):
+        return self.read_csv("calendar_dates.txt")
+
+    def restrict_to_routes(self, route_ids):
+        """Like gtfs_kit.Feed.restrict_to_routes - forget about any routes not in
+        `route_ids`, and their trips, calendars, stop times and shapes
+        """
+        self.routes = self.routes[self.routes.route_id.isin(route_ids)]
+        self.trips = self.trips[self.trips.route_id.isin(route_ids)]
+        self.trip_ids = set(self.trips.trip_id)
+        service_ids = self.trips.service_id
+        if self.calendar is not None:
+            self.calendar = self.calendar[self.calendar.service_id.isin(service_ids)]
+        if self.calendar_dates is not None:
+            self.calendar_dates = self.calendar_dates[
+                self.calendar_dates.service_id.isin(service_ids)
+            ]
+        return self
+
+    def iter_stop_times(self, columns=None):
+        """stop_times.txt in DataFrames of about chunk_size rows, each with all the
+        stop times of some trips. Most feeds have the stop times of each trip all
+        together in the file, so it can be read a chunk at a time - but the GTFS spec
+        doesn't require it, so other feeds are read whole and sorted
+        """
+        if columns is not None:
+            columns = {"trip_id", *columns}
+        if not self.is_grouped_by_trip():
+            yield from self.iter_sorted_stop_times(columns)
+            return
+        chunks = self.read_csv("stop_times.txt", columns, self.chunk_size)
+        if chunks is None:
+            return
+
+        rest = None
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            if rest is not None:
+                chunk = pd.concat([rest, chunk], ignore_index=True)
+
+            # the last trip might continue in the next chunk
+            is_last_trip = (chunk.trip_id == chunk.trip_id.iat[-1]).to_numpy()
+            rest = chunk[is_last_trip]
+            chunk = chunk[~is_last_trip]
+
+            if not chunk.empty:
+                chunk = self.restrict_stop_times(chunk)
+                if not chunk.empty:
+                    yield chunk
+
+        if rest is not None:
+            rest = self.restrict_stop_times(rest)
+            if not rest.empty:
+                yield rest
+
+    def is_grouped_by_trip(self) -> bool:
+        """Whether each trip's stop times are all together in stop_times.txt
+        (only reads the trip_id column)
+        """
+        chunks = self.read_csv("stop_times.txt", ("trip_id",), self.chunk_size)
+        if chunks is None:
+            return True
+
+        seen_trip_ids = set()
+        last_trip_id = None
+        for chunk in chunks:
+            trip_ids = chunk.trip_id.to_numpy()
+            if not len(trip_ids):
+                continue
+            # the first row of each run of rows with the same trip_id
+            trip_ids = trip_ids[np.r_[True, trip_ids[1:] != trip_ids[:-1]]]
+            if trip_ids[0] == last_trip_id:
+                trip_ids = trip_ids[1:]
+            last_trip_id = chunk.trip_id.iat[-1]
+            unique_trip_ids = set(trip_ids)
+            if len(unique_trip_ids) < len(trip_ids) or not seen_trip_ids.isdisjoint(
+                unique_trip_ids
+            ):
+                chunks.close()
+                return False
+            seen_trip_ids.update(unique_trip_ids)
+        return True
+
+    def iter_sorted_stop_times(self, columns):
+        """Like iter_stop_times, but for a stop_times.txt that isn't grouped by trip -
+        read the whole thing, and sort it by trip_id and stop_sequence
+        """
+        read_columns = columns and {*columns, "stop_sequence"}
+        chunks = self.read_csv("stop_times.txt", read_columns, self.chunk_size)
+        if chunks is None:
+            return
+        chunks = [self.restrict_stop_times(chunk) for chunk in chunks]
+        if not chunks:
+            return
+        stop_times = pd.concat(chunks, ignore_index=True).sort_values(
+            ["trip_id", "stop_sequence"], ignore_index=True
+        )
+        if columns is not None and "stop_sequence" not in columns:
+            stop_times = stop_times.drop(columns="stop_sequence")
+
+        # split between trips
+        trip_ids = stop_times.trip_id.to_numpy()
+        ends = np.flatnonzero(trip_ids[1:] != trip_ids[:-1]) + 1
+        ends = [*ends.tolist(), len(trip_ids)]
+        start = 0
+        for end in ends:
+            if end - start >= self.chunk_size or end == len(trip_ids):
+                if end > start:
+                    yield stop_times.iloc[start:end]
+                start = end
+
+    def restrict_stop_times(self, stop_times):
+        if self.trip_ids is not None:
+            stop_times = stop_times[stop_times.trip_id.isin(self.trip_ids)]
+        return stop_times
+
+    @cached_property
+    def shapes(self) -> tuple[dict, np.ndarray] | None:
+        """An index of shape_ids to slices of an array of (lon, lat) points.
+        Only the shapes of (the remaining) trips are kept
+        """
+        if self.trips is None or "shape_id" not in self.trips:
+            return
+        shape_ids = set(self.trips.shape_id.dropna())
+
+        chunks = self.read_csv(
+            "shapes.txt",
+            ("shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"),
+            self.chunk_size,
+        )
+        if chunks is None:
+            return
+        chunks = [chunk[chunk.shape_id.isin(shape_ids)] for chunk in chunks]
+        if not chunks:
+            return
+        shapes = pd.concat(chunks, ignore_index=True).sort_values(
+            ["shape_id", "shape_pt_sequence"]
+        )
+
+        points = shapes[["shape_pt_lon", "shape_pt_lat"]].to_numpy()
+        shape_ids = shapes.shape_id.to_numpy()
+        starts = np.flatnonzero(np.r_[True, shape_ids[1:] != shape_ids[:-1]])
+        ends = [*starts[1:].tolist(), len(points)]
+        index = {
+            shape_ids[start]: slice(start, end)
+            for start, end in zip(starts.tolist(), ends)
+        }
+        return index, points
+
+    def get_shape(self, shape_id) -> LineString | None:
+        if self.shapes is None:
+            return
+        index, points = self.shapes
+        if shape_id in index:
+            return LineString(points[index[shape_id]])
+
+    def get_route_geometries(self) -> dict:
+        """Like gtfs_kit.routes.geometrize_routes - each route's trips' shapes,
+        merged into a LineString or MultiLineString
+        """
+        if self.shapes is None:
+            return {}
+        trips = self.trips.dropna(subset="shape_id").drop_duplicates(
+            ["route_id", "shape_id"]
+        )
+        geometries = {}
+        for route_id, shape_ids in trips.groupby("route_id").shape_id:
+            lines = [self.get_shape(shape_id) for shape_id in shape_ids]
+            if lines := [line for line in lines if line is not None]:
+                geometries[route_id] = linemerge(lines)
+        return geometries
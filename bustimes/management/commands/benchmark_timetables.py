@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils.timezone import localdate
+
+from busstops.models import Service
+
+
+class Command(BaseCommand):
+    help = "Time rendering the timetables with the most trips"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("services", nargs="*", type=str, help="Service slugs")
+        parser.add_argument("--count", type=int, default=5)
+
+    def get_services(self, count):
+        services = Service.objects.filter(current=True).annotate(
+            trips=Count("route__trip")
+        )
+        # the largest London and coach timetables
+        yield from services.filter(region="L").order_by("-trips")[:count]
+        yield from services.filter(mode="coach").order_by("-trips")[:count]
+
+    def handle(self, *args, services, count, **options):
+        if services:
+            services = Service.objects.filter(slug__in=services)
+        else:
+            services = self.get_services(count)
+
+        date = localdate()
+
+        for service in services:
+            start = time.perf_counter()
+            timetable = service.get_timetable(date)
+            if not timetable:
+                continue
+            timetable.render()
+            render_time = time.perf_counter() - start
+
+            # sort the (already sorted) columns again, timing just that part
+            start = time.perf_counter()
+            for grouping in timetable.groupings:
+                grouping.sort_columns()
+            sort_time = time.perf_counter() - start
+
+            trips = sum(len(grouping.trips) for grouping in timetable.groupings)
+            self.stdout.write(
+                f"{service.slug}: {trips} trips, rendered in {render_time:.3f}s "
+                f"(of which sorting columns {sort_time:.3f}s)"
+            )
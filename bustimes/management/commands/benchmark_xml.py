@@ -0,0 +1,58 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from transxchange import parser
+from transxchange.txc import TransXChange
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+
+
+class Command(BaseCommand):
+    help = "Time parsing TransXChange files with the standard library and with lxml"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("paths", nargs="*", type=Path, help="XML files")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def time(self, function, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - start) / repeat
+
+    def iterparse(self, path, use_lxml):
+        with path.open("rb") as open_file:
+            for _, element in parser.iterparse(
+                open_file, "http://www.transxchange.org.uk/", use_lxml=use_lxml
+            ):
+                element.clear()
+
+    def parse(self, path, use_lxml):
+        with path.open("rb") as open_file:
+            TransXChange(open_file, use_lxml=use_lxml)
+
+    def handle(self, *args, paths, repeat, **options):
+        if not parser.etree:
+            self.stderr.write("lxml isn't installed")
+            return
+
+        if not paths:
+            # the largest fixtures
+            paths = sorted(
+                FIXTURES_DIR.glob("**/*.xml"), key=lambda path: path.stat().st_size
+            )[-5:]
+
+        for path in paths:
+            self.stdout.write(f"{path.name} ({path.stat().st_size // 1024} KB):")
+            for use_lxml, name in ((False, "stdlib"), (True, "lxml")):
+                iterparse_time = self.time(
+                    lambda: self.iterparse(path, use_lxml), repeat
+                )
+                parse_time = self.time(lambda: self.parse(path, use_lxml), repeat)
+                self.stdout.write(
+                    f"  {name}: iterparse {iterparse_time:.3f}s, "
+                    f"TransXChange {parse_time:.3f}s"
+                )
@@ -5,6 +5,7 @@ from functools import cache
 
 from django.contrib.gis.geos import Point
 from django.core.management.base import BaseCommand
+from django.db.models.functions import Now
 
 from busstops.models import DataSource, Service, StopPoint
 
@@ -18,6 +19,7 @@ from ...models import (
     StopTime,
     Trip,
 )
+from ...utils import bulk_copy
 
 
 def parse_date(string):
@@ -85,6 +87,11 @@ class Command(BaseCommand):
             ],
         )
         Route.objects.bulk_update(self.routes.values(), ["inbound_description"])
+        # now that the stop times have been replaced
+        # (so cached timetables and departure boards aren't used)
+        Service.objects.filter(id__in=[service.id for service in services]).update(
+            modified_at=Now()
+        )
         for service in services:
             service.update_search_vector()
 
@@ -352,10 +359,10 @@ class Command(BaseCommand):
                     for stop_time in self.stop_times:
                         stop_time.trip = stop_time.trip  # set trip_id
                         assert stop_time.trip_id
-                    StopTime.objects.bulk_create(self.stop_times)
+                    bulk_copy(StopTime, self.stop_times)
 
                     if self.stop_time_notes:
-                        StopTime.notes.through.objects.bulk_create(self.stop_time_notes)
+                        bulk_copy(StopTime.notes.through, self.stop_time_notes)
                         self.stop_time_notes = []
                     self.stop_times = []
 
@@ -4,6 +4,7 @@ import hashlib
 import logging
 import xml.etree.cElementTree as ET
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import StringIO
 from pathlib import Path
 from time import sleep
@@ -12,22 +13,28 @@ import requests
 from ciso8601 import parse_datetime
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import DataError
+from django.db import DataError, connections, transaction
 from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
+from requests.adapters import HTTPAdapter
 
 from busstops.models import DataSource, Operator, Service
 
+from ... import download_utils
 from ...download_utils import download, download_if_modified
 from ...models import Route, TimetableDataSource
 from ...utils import log_time_taken
 from .import_transxchange import Command as TransXChangeCommand
+from .import_transxchange import get_pool
 
 logger = logging.getLogger(__name__)
 session = requests.Session()
 
 
-def clean_up(timetable_data_source, sources, incomplete=False):
+def clean_up(timetable_data_source, sources, incomplete=False) -> set:
+    """Delete other sources' routes for the same operators.
+    Returns the ids of the services that have lost routes
+    """
     service_operators = Service.operator.through.objects.filter(
         service=OuterRef("service")
     )
@@ -47,8 +54,9 @@ def clean_up(timetable_data_source, sources, incomplete=False):
     if incomplete:  # leave other sources alone
         routes = routes.filter(source__url__contains="bus-data.dft.gov.uk")
     # force evaluation of QuerySet:
-    route_ids = list(routes.values_list("id", flat=True))
-    routes = Route.objects.filter(id__in=route_ids)
+    routes = list(routes.values_list("id", "service"))
+    service_ids = {service_id for _, service_id in routes if service_id}
+    routes = Route.objects.filter(id__in=[route_id for route_id, _ in routes])
     # do this first to prevent IntegrityError
     routes.update(service=None)
     routes.delete()
@@ -58,6 +66,7 @@ def clean_up(timetable_data_source, sources, incomplete=False):
         current=True,
         route=None,
     ).update(current=False)
+    return service_ids
 
 
 def is_noc(search_term: str) -> bool:
@@ -72,9 +81,11 @@ def get_operator_ids(source) -> list:
     return [operator["noc"] for operator in operators]
 
 
-def get_command():
+def get_command(specific_operator=None):
     command = TransXChangeCommand()
     command.set_up()
+    # importing a specific operator on purpose - import even unchanged files
+    command.skip_unchanged = not specific_operator
     return command
 
 
@@ -88,6 +99,16 @@ def get_sha1(path):
             sha1.update(data)
 
 
+def handle_one_file(command, open_file, filename):
+    if command.lock_line_names:
+        # in a worker process (see import_file_in_worker), in a transaction per file,
+        # for as long as do_line_name_locks's locks should last
+        with transaction.atomic():
+            command.handle_file(open_file, filename)
+    else:
+        command.handle_file(open_file, filename)
+
+
 def handle_file(command, path, qualify_filename=False):
     # the downloaded file might be plain XML, or a zipped archive - we just don't know yet
     full_path = settings.DATA_DIR / path
@@ -103,12 +124,12 @@ def handle_file(command, path, qualify_filename=False):
                         filename = str(Path(path) / filename)
                     try:
                         try:
-                            command.handle_file(open_file, filename)
+                            handle_one_file(command, open_file, filename)
                         except ET.ParseError:
                             open_file.seek(0)
                             content = open_file.read().decode("utf-16")
                             fake_file = StringIO(content)
-                            command.handle_file(fake_file, filename)
+                            handle_one_file(command, fake_file, filename)
                     except (ET.ParseError, ValueError, AttributeError, DataError) as e:
                         if filename.endswith(".xml"):
                             logger.info(filename)
@@ -121,11 +142,103 @@ def handle_file(command, path, qualify_filename=False):
             else:
                 filename = ""
             try:
-                command.handle_file(open_file, filename)
+                handle_one_file(command, open_file, filename)
             except (AttributeError, DataError) as e:
                 logger.exception(e)
 
 
+def in_thread(function, *args):
+    try:
+        return function(*args)
+    finally:
+        # each thread has its own database connection
+        connections.close_all()
+
+
+def download_all(download_job, jobs: list, workers=1):
+    """Call download_job(job) for each job - with more than one worker, in a pool of
+    threads. Yields each job and what download_job returned, as each download finishes
+    """
+    if workers <= 1:
+        for job in jobs:
+            yield job, download_job(job)
+        return
+
+    # a connection per thread, instead of requests' default of 10 per host
+    download_utils.session.mount("https://", HTTPAdapter(pool_maxsize=workers))
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(in_thread, download_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def import_file(command, source, path, region_id) -> set:
+    """Import a downloaded file for a DataSource.
+    Returns the ids of the services created or updated
+    """
+    command.source = source
+    command.region_id = region_id
+    command.service_ids = set()
+    command.route_ids = set()
+    command.garages = {}
+
+    with log_time_taken(logger):
+        handle_file(command, path)
+
+        command.mark_old_services_as_not_current()
+
+    return command.service_ids
+
+
+def import_file_in_worker(specific_operator, source, path, region_id) -> tuple:
+    """Returns the ids of the services imported, and what might have changed about them"""
+    command = get_command(specific_operator)
+    # other workers might be importing sources with the same services at the same time
+    command.lock_line_names = True
+    service_ids = import_file(command, source, path, region_id)
+    return service_ids, command.service_changes
+
+
+class Importer:
+    """Imports files with import_file - straight away, or with more than one worker,
+    in a pool of worker processes while the parent process gets on with downloading
+    other files
+    """
+
+    def __init__(self, command, specific_operator=None, workers=1):
+        self.command = command
+        self.specific_operator = specific_operator
+        # start the worker processes now, before any download threads
+        self.pool = get_pool(workers) if workers > 1 else None
+        self.results = []
+
+    def submit(self, job, source, path, region_id):
+        if self.pool:
+            result = self.pool.apply_async(
+                import_file_in_worker,
+                (self.specific_operator, source, path, region_id),
+            )
+        else:
+            result = import_file(self.command, source, path, region_id)
+        self.results.append((job, result))
+
+    def get_results(self):
+        """Yields each submitted job and the ids of the services imported,
+        in the order they were submitted (and adds what might have changed about
+        the services, in worker processes, to the command's service_changes)
+        """
+        for job, result in self.results:
+            if self.pool:
+                result, service_changes = result.get()
+                self.command.add_service_changes(service_changes)
+            yield job, result
+
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
 def get_bus_open_data_paramses(sources, api_key):
     searches = [
         source.search for source in sources if not is_noc(source.search)
@@ -152,10 +265,10 @@ def get_bus_open_data_paramses(sources, api_key):
         yield {**base_params, "noc": ",".join(nocs)}
 
 
-def bus_open_data(api_key, specific_operator):
+def bus_open_data(api_key, specific_operator, workers=1):
     assert len(api_key) == 40
 
-    command = get_command()
+    command = get_command(specific_operator)
 
     url_prefix = "https://data.bus-data.dft.gov.uk"
     path_prefix = settings.DATA_DIR / "bod"
@@ -189,7 +302,9 @@ def bus_open_data(api_key, specific_operator):
             url = json["next"]
             params = None
 
+    all_sources = []  # (timetable data source, operators, data sources)
     all_source_ids = []
+    jobs = []  # (timetable data source, operators, data source, path) of changed datasets
 
     for source in timetable_data_sources:
         if not is_noc(source.search):
@@ -203,74 +318,79 @@ def bus_open_data(api_key, specific_operator):
                 item for item in datasets if source.search in item["noc"]
             ]
 
-        command.region_id = source.region_id
-
         sources = []
-        service_ids = set()
 
         operators = source.operators.values_list("noc", flat=True)
 
         for dataset in operator_datasets:
-            command.source = DataSource.objects.filter(url=dataset["url"]).first()
+            data_source = DataSource.objects.filter(url=dataset["url"]).first()
             if (
-                not command.source
+                not data_source
                 and is_noc(source.search)
                 and len(operator_datasets) == 1
             ):
                 name_prefix = dataset["name"].split("_", 1)[0]
                 # if old dataset was made inactive, reuse id
-                command.source = DataSource.objects.filter(
+                data_source = DataSource.objects.filter(
                     name__startswith=f"{name_prefix}_"
                 ).first()
-            if not command.source:
-                command.source = DataSource.objects.create(
+            if not data_source:
+                data_source = DataSource.objects.create(
                     name=dataset["name"], url=dataset["url"]
                 )
-            command.source.name = dataset["name"]
-            command.source.url = dataset["url"]
-            if command.source.source_id != source.id:
-                command.source.source = source
-                if command.source.id:
-                    command.source.save(update_fields=["source"])
+            data_source.name = dataset["name"]
+            data_source.url = dataset["url"]
+            if data_source.source_id != source.id:
+                data_source.source = source
+                if data_source.id:
+                    data_source.save(update_fields=["source"])
 
-            sources.append(command.source)
+            sources.append(data_source)
 
-            if specific_operator or command.source.datetime != dataset["modified"]:
-                logger.info(dataset["name"])
+            if specific_operator or data_source.datetime != dataset["modified"]:
+                data_source.datetime = dataset["modified"]
+                path = path_prefix / str(data_source.id)
+                jobs.append((source, operators, data_source, path))
 
-                filename = str(command.source.id)
-                path = path_prefix / filename
+        all_sources.append((source, operators, sources))
+        all_source_ids += [data_source.id for data_source in sources]
 
-                command.service_ids = set()
-                command.route_ids = set()
-                command.garages = {}
+    def download_job(job):
+        *_, data_source, path = job
+        download(path, data_source.url)
+        return get_sha1(path)
 
-                command.source.datetime = dataset["modified"]
+    importer = Importer(command, specific_operator, workers)
 
-                with log_time_taken(logger):
-                    download(path, command.source.url)
+    for job, sha1 in download_all(download_job, jobs, workers):
+        source, _, data_source, path = job
+        logger.info(data_source.name)
+        data_source.sha1 = sha1
+        importer.submit(job, data_source, path, source.region_id)
 
-                    handle_file(command, path)
+    service_ids = {source.id: set() for source, _, _ in all_sources}
 
-                    command.mark_old_services_as_not_current()
+    for job, source_service_ids in importer.get_results():
+        source, operators, data_source, _ = job
+        data_source.save()
 
-                    command.source.sha1 = get_sha1(path)
-                    command.source.save()
+        operator_ids = get_operator_ids(data_source)
+        logger.info(f"{data_source.name} {operator_ids}")
+        unexpected = [o for o in operator_ids if o not in operators]
+        if unexpected:
+            logger.info(f"  {unexpected=} (not in {operators})")
 
-                operator_ids = get_operator_ids(command.source)
-                logger.info(f"  {operator_ids}")
-                unexpected = [o for o in operator_ids if o not in operators]
-                if unexpected:
-                    logger.info(f"  {unexpected=} (not in {operators})")
-
-                service_ids |= command.service_ids
+        service_ids[source.id] |= source_service_ids
 
+    # one timetable data source at a time, because they might share services
+    for source, operators, sources in all_sources:
         # delete routes from any sources that have been made inactive
         if Service.objects.filter(
             Q(source__in=sources) | Q(route__source__in=sources),
             current=True,
         ).exists():
-            clean_up(source, sources, not source.complete)
+            for service_id in clean_up(source, sources, not source.complete):
+                command.service_changed(service_id)
         elif Service.objects.filter(
             current=True,
             route__source__source=source,
@@ -280,9 +400,8 @@ def bus_open_data(api_key, specific_operator):
 https://bustimes.org/admin/busstops/service/?operator__noc__in={','.join(operators)}"""
             )
 
-        command.service_ids = service_ids
-        command.finish_services()
-        all_source_ids += [source.id for source in sources]
+        command.service_ids = service_ids[source.id]
+        command.finish_services(workers)
 
     if not specific_operator:
         to_delete = DataSource.objects.filter(
@@ -295,8 +414,8 @@ https://bustimes.org/admin/busstops/service/?operator__noc__in={','.join(operato
             logger.info(to_delete.delete())
 
 
-def ticketer(specific_operator=None):
-    command = get_command()
+def ticketer(specific_operator=None, workers=1):
+    command = get_command(specific_operator)
 
     base_dir = settings.DATA_DIR / "ticketer"
 
@@ -315,29 +434,33 @@ def ticketer(specific_operator=None):
             return
         logger.info(timetable_data_sources)
 
+    importer = Importer(command, specific_operator, workers)
+    modified_jobs = []  # (timetable data source, data source, sha1, last modified)
+
     need_to_sleep = False
 
+    # downloads one at a time, with a pause after each unmodified one,
+    # but files are imported in parallel (with workers > 1) while that goes on
     for source in timetable_data_sources:
         path = Path(source.url)
 
         filename = f"{path.parts[3]}.zip"
         path = base_dir / filename
-        command.source, created = DataSource.objects.get_or_create(
+        data_source, created = DataSource.objects.get_or_create(
             {"name": source.name}, url=source.url
         )
-        command.source.source = source
-        command.garages = {}
+        data_source.source = source
 
         if need_to_sleep:
             sleep(2)
             need_to_sleep = False
 
-        modified, last_modified = download_if_modified(path, command.source)
+        modified, last_modified = download_if_modified(path, data_source)
 
         if (
             specific_operator
-            or not command.source.datetime
-            or last_modified > command.source.datetime
+            or not data_source.datetime
+            or last_modified > data_source.datetime
         ):
             logger.info(f"{source} {last_modified}")
 
@@ -348,60 +471,42 @@ def ticketer(specific_operator=None):
                 # hash matches that hash of some BODS data
                 logger.info(f"  skipping, {sha1=} matches {existing=}")
             else:
-                command.region_id = source.region_id
-                command.service_ids = set()
-                command.route_ids = set()
-
                 # for "end date is in the past" warnings
-                command.source.datetime = timezone.now()
-
-                with log_time_taken(logger):
-                    handle_file(command, path)
-
-                    command.mark_old_services_as_not_current()
-
-                    clean_up(source, [command.source])
+                data_source.datetime = timezone.now()
 
-                    command.finish_services()
-
-            command.source.sha1 = sha1
-            command.source.datetime = last_modified
-            command.source.save()
+                importer.submit(
+                    (source, data_source), data_source, path, source.region_id
+                )
 
-            logger.info(
-                f"  {command.source.route_set.order_by('end_date').distinct('end_date').values('end_date')}"
-            )
-            logger.info(f"  {get_operator_ids(command.source)}")
+            modified_jobs.append((source, data_source, sha1, last_modified))
         else:
             need_to_sleep = True
 
+    imported = {
+        data_source.id: service_ids
+        for (_, data_source), service_ids in importer.get_results()
+    }
 
-def do_stagecoach_source(command, last_modified, filename, nocs):
-    logger.info(f"{command.source.url} {last_modified}")
-
-    # avoid importing old data
-    command.source.datetime = timezone.now()
-
-    with log_time_taken(logger):
-        handle_file(command, filename)
+    for source, data_source, sha1, last_modified in modified_jobs:
+        if data_source.id in imported:
+            for service_id in clean_up(source, [data_source]):
+                command.service_changed(service_id)
 
-        command.mark_old_services_as_not_current()
+            command.service_ids = imported[data_source.id]
+            command.finish_services(workers)
 
-    command.source.datetime = last_modified
-    command.source.save()
+        data_source.sha1 = sha1
+        data_source.datetime = last_modified
+        data_source.save()
 
-    logger.info(
-        f"  {command.source.route_set.order_by('end_date').distinct('end_date').values('end_date')}"
-    )
-    operators = get_operator_ids(command.source)
-    logger.info(f"  {operators=}")
-    unexpected = [o for o in operators if o not in nocs]
-    if unexpected:
-        logger.info(f"  {unexpected=} (not in {nocs})")
+        logger.info(
+            f"  {data_source.route_set.order_by('end_date').distinct('end_date').values('end_date')}"
+        )
+        logger.info(f"  {get_operator_ids(data_source)}")
 
 
-def stagecoach(specific_operator=None):
-    command = get_command()
+def stagecoach(specific_operator=None, workers=1):
+    command = get_command(specific_operator)
 
     timetable_data_sources = TimetableDataSource.objects.filter(
         url__startswith="https://opendata.stagecoachbus.com", active=True
@@ -415,43 +520,78 @@ def stagecoach(specific_operator=None):
             return
         logger.info(timetable_data_sources)
 
-    for source in timetable_data_sources:
-        command.region_id = source.region_id
-        command.service_ids = set()
-        command.route_ids = set()
-        command.garages = {}
+    jobs = []  # (timetable data source, nocs, data source, filename)
 
+    for source in timetable_data_sources:
         nocs = list(source.operators.values_list("noc", flat=True))
 
         filename = Path(source.url).name
-        path = settings.DATA_DIR / filename
 
-        command.source, _ = DataSource.objects.get_or_create(
+        data_source, _ = DataSource.objects.get_or_create(
             {"name": source.name}, url=source.url
         )
 
-        modified, last_modified = download_if_modified(path, command.source)
-        sha1 = get_sha1(path)
+        jobs.append((source, nocs, data_source, filename))
 
-        if command.source.datetime != last_modified:
+    def download_job(job):
+        *_, data_source, filename = job
+        path = settings.DATA_DIR / filename
+        modified, last_modified = download_if_modified(path, data_source)
+        return modified, last_modified, get_sha1(path)
+
+    importer = Importer(command, specific_operator, workers)
+
+    for job, (modified, last_modified, sha1) in download_all(
+        download_job, jobs, workers
+    ):
+        source, nocs, data_source, filename = job
+
+        if data_source.datetime != last_modified:
             modified = True
 
         if modified:
             # use sha1 checksum to check if file has really changed -
             # last_modified seems to change every night
             # even when contents stay the same
-            if sha1 == command.source.sha1 or not command.source.older_than(
-                last_modified
-            ):
+            if sha1 == data_source.sha1 or not data_source.older_than(last_modified):
                 modified = False
 
-            command.source.sha1 = sha1
+            data_source.sha1 = sha1
 
             if modified or specific_operator:
-                do_stagecoach_source(command, last_modified, filename, nocs)
+                logger.info(f"{data_source.url} {last_modified}")
+
+                # avoid importing old data
+                data_source.datetime = timezone.now()
+
+                importer.submit(
+                    (job, last_modified), data_source, filename, source.region_id
+                )
 
-        clean_up(source, [command.source])
-        command.finish_services()
+    imported = {}
+
+    for (job, last_modified), service_ids in importer.get_results():
+        source, nocs, data_source, _ = job
+        imported[data_source.id] = service_ids
+
+        data_source.datetime = last_modified
+        data_source.save()
+
+        logger.info(
+            f"  {data_source.route_set.order_by('end_date').distinct('end_date').values('end_date')}"
+        )
+        operators = get_operator_ids(data_source)
+        logger.info(f"  {operators=}")
+        unexpected = [o for o in operators if o not in nocs]
+        if unexpected:
+            logger.info(f"  {unexpected=} (not in {nocs})")
+
+    # one source at a time, because they might share services
+    for source, _, data_source, _ in jobs:
+        for service_id in clean_up(source, [data_source]):
+            command.service_changed(service_id)
+        command.service_ids = imported.get(data_source.id, set())
+        command.finish_services(workers)
 
 
 class Command(BaseCommand):
@@ -459,11 +599,17 @@ class Command(BaseCommand):
     def add_arguments(parser):
         parser.add_argument("api_key", type=str)
         parser.add_argument("operator", type=str, nargs="?")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of threads to download files, and processes to import them",
+        )
 
-    def handle(self, api_key, operator, **options):
+    def handle(self, api_key, operator, workers, **options):
         if api_key == "stagecoach":
-            stagecoach(operator)
+            stagecoach(operator, workers)
         elif api_key == "ticketer":
-            ticketer(operator)
+            ticketer(operator, workers)
         else:
-            bus_open_data(api_key, operator)
+            bus_open_data(api_key, operator, workers)
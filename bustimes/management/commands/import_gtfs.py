@@ -1,7 +1,8 @@
 import logging
 from pathlib import Path
 
-import gtfs_kit
+import numpy as np
+import pandas as pd
 from zipfile import BadZipFile
 from numpy import nan
 from django.conf import settings
@@ -11,9 +12,12 @@ from django.db.models import Count, Exists, OuterRef, Q
 from django.db.models.functions import Now
 
 from busstops.models import AdminArea, DataSource, Operator, Region, Service, StopPoint
+from vehicles.utils import redis_client
 
 from ...download_utils import download_if_modified
+from ...gtfs import Feed
 from ...models import Route, StopTime, Trip
+from ...utils import bulk_copy, copy_dataframe
 from .import_gtfs_ember import get_calendars
 
 logger = logging.getLogger(__name__)
@@ -27,6 +31,53 @@ MODES = {
 }
 
 
+def get_seconds(times):
+    """A column of GTFS times like "25:30:00" as seconds, like SecondsField"""
+    parts = times.str.split(":", expand=True).astype(float)
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]).astype("Int64")
+
+
+def get_stop_times(stop_times, trips: dict, stops: dict, stops_not_created: dict):
+    """Turn stop_times.txt into StopTime table rows, one column at a time"""
+    assert stop_times.pickup_type.isin((0, 1)).all()  # regular or no pick up
+    assert stop_times.drop_off_type.isin((0, 1)).all()  # regular or no drop off
+
+    stop_ids = stop_times.stop_id.map(
+        {stop_id: stop.pk for stop_id, stop in stops.items()}
+    )
+    stop_codes = np.where(
+        stop_ids.isna(),
+        stop_times.stop_id.map(
+            {stop_id: stop.stop_name for stop_id, stop in stops_not_created.items()}
+        ).fillna(stop_times.stop_id),
+        "",
+    )
+
+    arrival = get_seconds(stop_times.arrival_time)
+    departure = get_seconds(stop_times.departure_time)
+
+    if "timepoint" in stop_times:
+        timing_status = np.where(stop_times.timepoint == 1, "PTP", "OTH")
+    else:
+        timing_status = "PTP"
+
+    return pd.DataFrame(
+        {
+            "trip_id": stop_times.trip_id.map(
+                {trip_id: trip.id for trip_id, trip in trips.items() if trip}
+            ),
+            "stop_code": stop_codes,
+            "stop_id": stop_ids,
+            "arrival": arrival.mask((arrival == departure).fillna(False)),
+            "departure": departure,
+            "sequence": stop_times.stop_sequence,
+            "timing_status": timing_status,
+            "pick_up": stop_times.pickup_type == 0,
+            "set_down": stop_times.drop_off_type == 0,
+        }
+    )
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
@@ -57,7 +108,7 @@ class Command(BaseCommand):
 
         return operator
 
-    def do_stops(self, feed: gtfs_kit.feed.Feed):
+    def do_stops(self, feed: Feed):
         stops = {}
         admin_areas = {}
         stops_not_created = {}
@@ -164,8 +215,10 @@ class Command(BaseCommand):
         self.route_operators[line.route_id] = operator
 
     def handle_zipfile(self, path):
-        feed = gtfs_kit.read_feed(path, dist_units="km")
+        with Feed(path) as feed:
+            self.handle_feed(feed)
 
+    def handle_feed(self, feed: Feed):
         self.operators = {}
         self.routes = {}
         self.route_operators = {}
@@ -177,12 +230,9 @@ class Command(BaseCommand):
         for route in feed.routes.itertuples():
             self.handle_route(route)
 
-        try:
-            for route in gtfs_kit.routes.geometrize_routes(feed).itertuples():
-                self.routes[route.route_id].service.geometry = route.geometry.wkt
-                self.routes[route.route_id].service.save(update_fields=["geometry"])
-        except ValueError:
-            pass
+        for route_id, geometry in feed.get_route_geometries().items():
+            self.routes[route_id].service.geometry = geometry.wkt
+            self.routes[route_id].service.save(update_fields=["geometry"])
 
         stops, stops_not_created = self.do_stops(feed)
 
@@ -216,41 +266,6 @@ class Command(BaseCommand):
                         }
                     headsigns[line.route_id][line.direction_id].add(headsign)
 
-        # use stop_times.txt to calculate trips' start times, end times and destinations:
-
-        trip = None
-        previous_line = None
-
-        for line in feed.stop_times.itertuples():
-            if not previous_line or previous_line.trip_id != line.trip_id:
-                if trip:
-                    trip.destination = stops.get(previous_line.stop_id)
-                    trip.end = previous_line.arrival_time
-
-                trip = trips[line.trip_id]
-                trip.start = line.departure_time
-                # if line["stop_headsign"]:
-                #     if not trip["trip_headsign"]:
-                #         trip["trip_headsign"] = line["stop_headsign"]
-
-            previous_line = line
-
-        if previous_line:
-            # last trip:
-            trip.destination = stops.get(line.stop_id)
-            trip.end = line.arrival_time
-
-        for trip_id in trips:
-            trip = trips[trip_id]
-            if trip.start is None:
-                logger.warning(f"trip {trip_id} has no stop times")
-                trips[trip_id] = None
-
-        Trip.objects.bulk_create(
-            [trip for trip in trips.values() if isinstance(trip, Trip)],
-            batch_size=1000,
-        )
-
         # headsigns - origins and destinations:
 
         for route_id in headsigns:
@@ -291,52 +306,39 @@ class Command(BaseCommand):
                     )
                     route.service.save(update_fields=["description"])
 
-        i = 0
-        stop_times = []
-
-        for line in feed.stop_times.itertuples():
-            stop_time = StopTime(
-                arrival=line.arrival_time,
-                departure=line.departure_time,
-                sequence=line.stop_sequence,
-                trip=trips[line.trip_id],
-                timing_status="PTP" if getattr(line, "timepoint", 1) == 1 else "OTH",
+        # a chunk of whole trips at a time -
+        # use stop_times.txt to calculate trips' start times, end times and destinations,
+        # then save those trips and their stop times:
+
+        for stop_times in feed.iter_stop_times():
+            first_stop_times = stop_times.drop_duplicates("trip_id")
+            for trip_id, departure_time in zip(
+                first_stop_times.trip_id, first_stop_times.departure_time
+            ):
+                trips[trip_id].start = departure_time
+
+            last_stop_times = stop_times.drop_duplicates("trip_id", keep="last")
+            for trip_id, arrival_time, stop_id in zip(
+                last_stop_times.trip_id,
+                last_stop_times.arrival_time,
+                last_stop_times.stop_id,
+            ):
+                trip = trips[trip_id]
+                trip.destination = stops.get(stop_id)
+                trip.end = arrival_time
+
+            chunk_trips = {
+                trip_id: trips[trip_id] for trip_id in first_stop_times.trip_id
+            }
+            bulk_copy(Trip, list(chunk_trips.values()))
+            copy_dataframe(
+                StopTime,
+                get_stop_times(stop_times, chunk_trips, stops, stops_not_created),
             )
-            match line.pickup_type:
-                case 0:  # Regularly scheduled pickup
-                    stop_time.pick_up = True
-                case 1:  # "No pickup available"
-                    stop_time.pick_up = False
-                case _:
-                    assert False
-            match line.drop_off_type:
-                case 0:  # Regularly scheduled drop off
-                    stop_time.set_down = True
-                case 1:  # "No drop off available"
-                    stop_time.set_down = False
-                case _:
-                    assert False
-
-            if stop := stops.get(line.stop_id):
-                stop_time.stop = stop
-            elif stop := stops_not_created.ge(line.stop_id):
-                stop_time.stop_code = stop.stop_name
-            else:
-                stop_time.stop_code = line.stop_id
-
-            if stop_time.arrival == stop_time.departure:
-                stop_time.arrival = None
-
-            stop_times.append(stop_time)
 
-            if i == 999:
-                StopTime.objects.bulk_create(stop_times)
-                stop_times = []
-                i = 0
-            else:
-                i += 1
-
-        StopTime.objects.bulk_create(stop_times)
+        for trip_id, trip in trips.items():
+            if trip.start is None:
+                logger.warning(f"trip {trip_id} has no stop times")
 
         services = Service.objects.filter(id__in=self.services.keys())
 
@@ -356,6 +358,12 @@ class Command(BaseCommand):
 
         services.update(modified_at=Now())
 
+        # prebuilt timetable layouts, kept in the (Redis) cache -
+        # now that modified_at has changed
+        if redis_client:
+            for service in services.all():
+                service.do_timetable_layouts()
+
         self.source.save(update_fields=["datetime"])
 
         for operator in self.operators.values():
@@ -1,16 +1,18 @@
 import logging
 from pathlib import Path
 
-import gtfs_kit
 from django.conf import settings
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from django.db.models.functions import Now
 
 from busstops.models import DataSource, Operator, Service, StopPoint
 
 from ...download_utils import download_if_modified
+from ...gtfs import Feed
 from ...models import Calendar, CalendarDate, Route, StopTime, Trip
+from ...utils import bulk_copy
 
 logger = logging.getLogger(__name__)
 
@@ -76,7 +78,7 @@ class Command(BaseCommand):
         modified, last_modified = download_if_modified(path, source)
         assert modified
 
-        feed = gtfs_kit.read_feed(path, dist_units="km")
+        feed = Feed(path)
 
         operator = Operator.objects.get(name="Ember")
 
@@ -90,7 +92,9 @@ class Command(BaseCommand):
 
         calendars = get_calendars(feed)
 
-        for row in gtfs_kit.routes.geometrize_routes(feed).itertuples():
+        geometries = feed.get_route_geometries()
+
+        for row in feed.routes.itertuples():
             if row.route_id in existing_services:
                 service = existing_services[row.route_id]
             else:
@@ -108,7 +112,8 @@ class Command(BaseCommand):
             service.current = True
             service.colour_id = operator.colour_id
             # service.region_id = "S"
-            service.geometry = row.geometry.wkt
+            if row.route_id in geometries:
+                service.geometry = geometries[row.route_id].wkt
 
             service.save()
             service.operator.add(operator)
@@ -137,29 +142,31 @@ class Command(BaseCommand):
         del existing_trips
 
         stop_times = []
-        for row in feed.stop_times.itertuples():
-            trip = trips[row.trip_id]
-            if not trip.start:
-                trip.start = row.arrival_time
-            trip.end = row.departure_time
-
-            stop_time = StopTime(
-                arrival=row.arrival_time,
-                departure=row.departure_time,
-                sequence=row.stop_sequence,
-                trip=trip,
-                timing_status="PTP" if row.timepoint else "OTH",
-            )
+        for chunk in feed.iter_stop_times():
+            for row in chunk.itertuples():
+                trip = trips[row.trip_id]
+                if not trip.start:
+                    trip.start = row.arrival_time
+                trip.end = row.departure_time
+
+                stop_time = StopTime(
+                    arrival=row.arrival_time,
+                    departure=row.departure_time,
+                    sequence=row.stop_sequence,
+                    trip=trip,
+                    timing_status="PTP" if row.timepoint else "OTH",
+                )
 
-            stop_time.stop = trip.destination = stops.get(row.stop_id)
+                stop_time.stop = trip.destination = stops.get(row.stop_id)
 
-            if stop_time.stop is None:
-                stop_time.stop_code = row.stop_id
+                if stop_time.stop is None:
+                    stop_time.stop_code = row.stop_id
 
-            stop_times.append(stop_time)
+                stop_times.append(stop_time)
+        feed.close()
 
         with transaction.atomic():
-            Trip.objects.bulk_create([trip for trip in trips.values() if not trip.id])
+            bulk_copy(Trip, [trip for trip in trips.values() if not trip.id])
             existing_trips = [trip for trip in trips.values() if trip.id]
             Trip.objects.bulk_update(
                 existing_trips,
@@ -176,7 +183,11 @@ class Command(BaseCommand):
             )
 
             StopTime.objects.filter(trip__in=existing_trips).delete()
-            StopTime.objects.bulk_create(stop_times)
+            bulk_copy(StopTime, stop_times)
+
+            # now that the stop times have been replaced
+            # (so cached timetables and departure boards aren't used)
+            source.service_set.update(modified_at=Now())
 
             for service in source.service_set.filter(current=True):
                 service.do_stop_usages()
@@ -3,17 +3,19 @@ from datetime import datetime
 from pathlib import Path
 from zoneinfo import ZoneInfo
 
-import gtfs_kit
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.db.models import Min
+from django.db.models.functions import Now
 from django.utils.dateparse import parse_duration
 
 from busstops.models import DataSource, Operator, Service
 
 from ...download_utils import download_if_modified
+from ...gtfs import Feed
 from ...models import Route, StopTime, Trip
+from ...utils import bulk_copy
 from .import_gtfs_ember import get_calendars
 
 logger = logging.getLogger(__name__)
@@ -33,7 +35,7 @@ class Command(BaseCommand):
         if not modified:
             return
 
-        feed = gtfs_kit.read_feed(path, dist_units="km")
+        feed = Feed(path)
 
         feed = feed.restrict_to_routes(
             [route_id for route_id in feed.routes.route_id if route_id.startswith("UK")]
@@ -65,9 +67,10 @@ class Command(BaseCommand):
             for calendar in calendars.values()
         }
 
-        geometries = {}
-        for row in gtfs_kit.routes.geometrize_routes(feed).itertuples():
-            geometries[row.route_id] = row.geometry.wkt
+        geometries = {
+            route_id: geometry.wkt
+            for route_id, geometry in feed.get_route_geometries().items()
+        }
 
         for row in feed.routes.itertuples():
             line_name = row.route_id.removeprefix("UK")
@@ -117,47 +120,49 @@ class Command(BaseCommand):
         del existing_trips
 
         stop_times = []
-        for row in feed.stop_times.itertuples():
-            trip = trips[row.trip_id]
-            offset = utc_offsets[trip.calendar.start_date]
-
-            arrival_time = parse_duration(row.arrival_time) + offset
-            departure_time = parse_duration(row.departure_time) + offset
-
-            if not trip.start:
-                trip.start = arrival_time
-            trip.end = departure_time
-
-            stop_time = StopTime(
-                arrival=arrival_time,
-                departure=departure_time,
-                sequence=row.stop_sequence,
-                trip=trip,
-                timing_status="PTP" if row.timepoint else "OTH",
-            )
-            if row.stop_id in stop_codes:
-                stop_time.stop_id = stop_codes[row.stop_id]
-            else:
-                stop = stops_data[row.stop_id]
-                stop_time.stop_code = stop.stop_name
-                if row.stop_id not in missing_stops:
-                    logger.info(
-                        f"{stop.stop_name} {stop.stop_code} {stop.stop_timezone} {stop.platform_code}"
-                    )
-                    logger.info(
-                        f"https://bustimes.org/map#16/{stop.stop_lat}/{stop.stop_lon}"
-                    )
-                    logger.info(
-                        f"https://bustimes.org/admin/busstops/stopcode/add/?code={stop.stop_id}\n"
-                    )
-                    missing_stops.add(row.stop_id)
-
-            trip.destination_id = stop_time.stop_id
-
-            stop_times.append(stop_time)
+        for chunk in feed.iter_stop_times():
+            for row in chunk.itertuples():
+                trip = trips[row.trip_id]
+                offset = utc_offsets[trip.calendar.start_date]
+
+                arrival_time = parse_duration(row.arrival_time) + offset
+                departure_time = parse_duration(row.departure_time) + offset
+
+                if not trip.start:
+                    trip.start = arrival_time
+                trip.end = departure_time
+
+                stop_time = StopTime(
+                    arrival=arrival_time,
+                    departure=departure_time,
+                    sequence=row.stop_sequence,
+                    trip=trip,
+                    timing_status="PTP" if row.timepoint else "OTH",
+                )
+                if row.stop_id in stop_codes:
+                    stop_time.stop_id = stop_codes[row.stop_id]
+                else:
+                    stop = stops_data[row.stop_id]
+                    stop_time.stop_code = stop.stop_name
+                    if row.stop_id not in missing_stops:
+                        logger.info(
+                            f"{stop.stop_name} {stop.stop_code} {stop.stop_timezone} {stop.platform_code}"
+                        )
+                        logger.info(
+                            f"https://bustimes.org/map#16/{stop.stop_lat}/{stop.stop_lon}"
+                        )
+                        logger.info(
+                            f"https://bustimes.org/admin/busstops/stopcode/add/?code={stop.stop_id}\n"
+                        )
+                        missing_stops.add(row.stop_id)
+
+                trip.destination_id = stop_time.stop_id
+
+                stop_times.append(stop_time)
+        feed.close()
 
         with transaction.atomic():
-            Trip.objects.bulk_create([trip for trip in trips.values() if not trip.id])
+            bulk_copy(Trip, [trip for trip in trips.values() if not trip.id])
             existing_trips = [trip for trip in trips.values() if trip.id]
             Trip.objects.bulk_update(
                 existing_trips,
@@ -174,7 +179,11 @@ class Command(BaseCommand):
             )
 
             StopTime.objects.filter(trip__in=existing_trips).delete()
-            StopTime.objects.bulk_create(stop_times)
+            bulk_copy(StopTime, stop_times)
+
+            # now that the stop times have been replaced
+            # (so cached timetables and departure boards aren't used)
+            source.service_set.update(modified_at=Now())
 
             for service in source.service_set.filter(current=True):
                 service.do_stop_usages()
@@ -136,6 +136,7 @@ class Command(BaseCommand):
                 command.region_id = source.region_id
                 command.service_ids = set()
                 command.route_ids = set()
+                command.service_changes = {}
                 command.garages = {}
 
                 for version in versions:  # newest first
@@ -143,7 +144,8 @@ class Command(BaseCommand):
                         logger.info(version)
                         handle_file(command, version["filename"], qualify_filename=True)
 
-                clean_up(source, sources)
+                for service_id in clean_up(source, sources):
+                    command.service_changed(service_id)
 
                 operator_ids = get_operator_ids(command.source)
                 logger.info(f"  {operator_ids}")
@@ -174,6 +176,10 @@ class Command(BaseCommand):
                     command.service_ids = remaining_services.values_list(
                         "id", flat=True
                     )
+                if old_routes[0]:
+                    # the services might have lost routes
+                    for service_id in command.service_ids:
+                        command.service_changed(service_id)
                 command.finish_services()
 
             command.source.save()
@@ -2,20 +2,34 @@
 Usage:
 
     ./manage.py import_transxchange EA.zip [EM.zip etc]
+    ./manage.py import_transxchange --workers 4 NCSD.zip
 """
 
 import csv
 import datetime
+import hashlib
 import logging
+import multiprocessing
 import os
 import re
 import zipfile
-from functools import cache
+import zlib
+from functools import cache, partial
 
+from django.contrib.gis.db.models import Extent, GeometryField
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError
-from django.db.models import Count, Exists, OuterRef, Q
-from django.db.models.functions import Now, Upper
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import (
+    Count,
+    Exists,
+    FloatField,
+    Func,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+)
+from django.db.models.functions import Coalesce, Now, Upper
 from titlecase import titlecase
 
 from busstops.models import (
@@ -27,6 +41,7 @@ from busstops.models import (
     StopUsage,
 )
 from transxchange.txc import TransXChange
+from vehicles.utils import redis_client
 from vosa.models import Registration
 
 from ...models import (
@@ -43,9 +58,17 @@ from ...models import (
     Trip,
     VehicleType,
 )
+from ...utils import bulk_copy
 
 logger = logging.getLogger(__name__)
 
+# what finish_services works out for each service from its routes and trips:
+# "stops" - StopUsages and geometry, "line_names" - description,
+# "operators" - (for services with more than one) operators,
+# "trips" - modified_at (so cached timetables and departure boards aren't used).
+# handle_service records which might have changed (see Command.service_changed)
+SERVICE_CHANGES = frozenset(("stops", "line_names", "operators", "trips"))
+
 """
 _________________________________________________________________________________________________
 | AllBankHolidays | AllHolidaysExceptChristmas | Holidays             | NewYearsDay              |
@@ -111,6 +134,64 @@ def get_service_code(filename):
             return "-".join(parts[:-1])
 
 
+def get_chunks(filenames, size: int) -> list[list[str]]:
+    """
+    Split an archive's files into chunks of about `size` files for worker processes.
+    Files with the same service code (different revisions, like 'ea_21-45A-_-y08-1.xml'
+    and 'ea_21-45A-_-y08-2.xml') go in the same chunk, so that no two workers are
+    likely to be updating the same service at once
+    """
+    groups = {}
+    for filename in filenames:
+        key = get_service_code(filename) or filename
+        groups.setdefault(key, []).append(filename)
+
+    chunks = [[]]
+    for group in groups.values():
+        if len(chunks[-1]) >= size:
+            chunks.append([])
+        chunks[-1] += group
+    return [chunk for chunk in chunks if chunk]
+
+
+def get_pool(workers: int):
+    # forked worker processes share the parent's (already set up) Django,
+    # but mustn't share its database connection
+    connections.close_all()
+    return multiprocessing.get_context("fork").Pool(workers)
+
+
+def update_geometries(services):
+    """Like Service.update_geometry, but for a QuerySet of services in one query -
+    each geometry becomes the bounding box of the service's stops
+    (or stays the same, if none of them has a location)
+    """
+    bounds = [
+        Func(Extent("stop__latlong"), function=function, output_field=FloatField())
+        for function in ("ST_XMin", "ST_YMin", "ST_XMax", "ST_YMax")
+    ]
+    # the same polygon as Polygon.from_bbox
+    envelope = Func(
+        *bounds,
+        Value(4326),
+        function="ST_MakeEnvelope",
+        output_field=GeometryField(),
+    )
+    envelopes = (
+        StopUsage.objects.filter(service=OuterRef("pk"))
+        .values("service")
+        .annotate(envelope=envelope)
+        .values("envelope")
+    )
+    services.update(geometry=Coalesce(Subquery(envelopes), "geometry"))
+
+
+def update_search_vectors(services):
+    """Like Service.update_search_vector, but for a QuerySet of services in one query"""
+    documents = Service.objects.with_documents().filter(pk=OuterRef("pk"))
+    services.update(search_vector=Subquery(documents.values("document")))
+
+
 def get_operator_name(operator_element):
     "Given an Operator element, returns the operator name or None"
 
@@ -194,21 +275,44 @@ class Command(BaseCommand):
     def add_arguments(parser):
         parser.add_argument("archives", nargs=1, type=str)
         parser.add_argument("files", nargs="*", type=str)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of processes to import files in parallel",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="import files even if they haven't changed since last time",
+        )
 
     def set_up(self):
         self.service_descriptions = {}
         self.calendar_cache = {}
         self.missing_operators = []
         self.notes = {}
+        # calendars and notes waiting to be saved in bulk
+        self.new_calendars = []
+        self.new_calendar_dates = []
+        self.new_calendar_bank_holidays = []
+        self.new_notes = []
         self.garages = {}
+        self.sha1 = None
+        self.skip_unchanged = True
+        self.file_route_ids = []
+        self.previous_routes = {}
+        self.service_changes = {}
+        self.lock_line_names = False
 
     def handle(self, *args, **options):
         self.set_up()
+        self.skip_unchanged = not options["force"]
 
         self.open_data_operators, self.incomplete_operators = get_open_data_operators()
 
         for archive_name in options["archives"]:
-            self.handle_archive(archive_name, options["files"])
+            self.handle_archive(archive_name, options["files"], options["workers"])
 
     def set_region(self, archive_name):
         """
@@ -300,8 +404,8 @@ class Command(BaseCommand):
         if len(operators) > 1:
             journey_operators = {
                 journey.operator
-                for journey in transxchange.journeys
-                if journey.operator and journey.service_ref == service.service_code
+                for journey in transxchange.get_service_journeys(service.service_code)
+                if journey.operator
             }
             journey_operators.add(service.operator)
             operators = [
@@ -351,9 +455,12 @@ class Command(BaseCommand):
                 end_date__lte=self.source.datetime,
             ),
         )
+        routes = list(old_routes)
         # do this first to prevent IntegrityError (VehicleJourney trip field)
         old_routes.update(service=None)
-        for route in old_routes:
+        for route in routes:
+            if route.service_id:
+                self.service_changed(route.service_id)
             route.delete()
 
         old_services = self.source.service_set.filter(current=True, route=None)
@@ -362,6 +469,57 @@ class Command(BaseCommand):
         if deleted:
             logger.info(f"  old services: {deleted}")
 
+    def handle_archive_file(self, archive, filename):
+        if filename.endswith(".zip"):
+            self.handle_sub_archive(archive, filename)
+
+        if filename.endswith(".xml"):
+            with archive.open(filename) as open_file:
+                self.handle_file(open_file, filename)
+
+    def service_changed(self, service_id, changes=SERVICE_CHANGES):
+        """Record that some things about a service (see SERVICE_CHANGES) might have
+        changed, so finish_services needs to work them out again
+        """
+        self.service_changes.setdefault(service_id, set()).update(changes)
+
+    def add_service_changes(self, service_changes: dict):
+        """Merge in the service_changes of another command (in a worker process)"""
+        for service_id, changes in service_changes.items():
+            self.service_changed(service_id, changes)
+
+    @staticmethod
+    def handle_archive_files(archive_name, skip_unchanged, filenames):
+        """
+        Import some of an archive's files, in a worker process (see handle_archive).
+        Returns the ids of the services and routes created or updated,
+        and what might have changed about the services
+        """
+        command = Command()
+        command.set_up()
+        command.skip_unchanged = skip_unchanged
+        command.lock_line_names = True
+        command.open_data_operators, command.incomplete_operators = (
+            get_open_data_operators()
+        )
+        command.set_archive(archive_name)
+
+        with zipfile.ZipFile(archive_name) as archive:
+            command.set_service_descriptions(archive)
+
+            for filename in filenames:
+                with transaction.atomic():
+                    command.handle_archive_file(archive, filename)
+
+        return command.service_ids, command.route_ids, command.service_changes
+
+    @staticmethod
+    def finish_some_services(service_changes, service_ids):
+        command = Command()
+        command.service_ids = service_ids
+        command.service_changes = service_changes
+        command.finish_services()
+
     def handle_sub_archive(self, archive, sub_archive_name):
         if sub_archive_name.startswith("__MACOSX"):
             return
@@ -379,9 +537,10 @@ class Command(BaseCommand):
                 elif filename.endswith(".zip"):
                     self.handle_sub_archive(sub_archive, filename)
 
-    def handle_archive(self, archive_name, filenames):
+    def set_archive(self, archive_name):
         self.service_ids = set()
         self.route_ids = set()
+        self.service_changes = {}
 
         self.set_region(archive_name)
 
@@ -389,6 +548,9 @@ class Command(BaseCommand):
             os.path.getmtime(archive_name), datetime.timezone.utc
         )
 
+    def handle_archive(self, archive_name, filenames, workers=1):
+        self.set_archive(archive_name)
+
         try:
             with zipfile.ZipFile(archive_name) as archive:
                 self.set_service_descriptions(archive)
@@ -402,13 +564,29 @@ class Command(BaseCommand):
                         if filename.startswith("NCSD_TXC_2_4/")
                     ]
 
-                for filename in filenames or namelist:
-                    if filename.endswith(".zip"):
-                        self.handle_sub_archive(archive, filename)
-
-                    if filename.endswith(".xml"):
-                        with archive.open(filename) as open_file:
-                            self.handle_file(open_file, filename)
+                if workers > 1:
+                    # each worker process parses and saves whole files,
+                    # in a transaction per file
+                    chunks = get_chunks(filenames or namelist, 20)
+                    with get_pool(workers) as pool:
+                        for (
+                            service_ids,
+                            route_ids,
+                            service_changes,
+                        ) in pool.imap_unordered(
+                            partial(
+                                self.handle_archive_files,
+                                archive_name,
+                                self.skip_unchanged,
+                            ),
+                            chunks,
+                        ):
+                            self.service_ids |= service_ids
+                            self.route_ids |= route_ids
+                            self.add_service_changes(service_changes)
+                else:
+                    for filename in filenames or namelist:
+                        self.handle_archive_file(archive, filename)
         except zipfile.BadZipfile:
             with open(archive_name) as open_file:
                 self.handle_file(open_file, archive_name)
@@ -419,7 +597,7 @@ class Command(BaseCommand):
                 current=False, geometry__isnull=False
             ).update(geometry=None)
 
-        self.finish_services()
+        self.finish_services(workers)
 
         self.source.save(update_fields=["datetime"])
 
@@ -438,32 +616,71 @@ class Command(BaseCommand):
             )
             client.upload_file(archive_name, "bustimes-data", "TNDS/" + archive_name)
 
-    def finish_services(self):
-        """update/create StopUsages, search_vector and geometry fields"""
+    def finish_services(self, workers=1):
+        """update/create StopUsages, search_vector and geometry fields -
+        only the ones that might have changed, according to service_changes
+        (a service not in there wasn't imported by handle_service, so anything might have)
+        """
+
+        if workers > 1 and len(self.service_ids) > 1:
+            service_ids = sorted(self.service_ids)
+            with get_pool(workers) as pool:
+                pool.map(
+                    partial(self.finish_some_services, self.service_changes),
+                    [service_ids[i : i + 20] for i in range(0, len(service_ids), 20)],
+                )
+            return
 
         services = Service.objects.filter(id__in=self.service_ids)
         services = services.annotate(operator_count=Count("operator"))
 
-        for service in services:
-            service.do_stop_usages()
+        changed_service_ids = []
+        changed_stops_service_ids = []
+        changed_search_service_ids = []
 
-            # using StopUsages
-            service.update_search_vector()
+        for service in services:
+            changes = self.service_changes.get(service.id, SERVICE_CHANGES)
+            if not changes:
+                continue
+            changed_service_ids.append(service.id)
+            if changes - {"trips"}:
+                changed_search_service_ids.append(service.id)
 
-            # using routes
-            service.update_geometry()
+            if "stops" in changes:
+                service.do_stop_usages()
+                changed_stops_service_ids.append(service.id)
 
-            service.update_description()
+            if "line_names" in changes:
+                service.update_description()
 
-            if service.operator_count > 1:
+            if "operators" in changes and service.operator_count > 1:
                 operators = Operator.objects.filter(
                     trip__route__service=service
                 ).distinct()
                 if operators and list(operators) != list(service.operator.all()):
                     service.operator.set(operators)
 
+        # all at once, using StopUsages
+        if changed_stops_service_ids:
+            update_geometries(Service.objects.filter(id__in=changed_stops_service_ids))
+
+        # using StopUsages, routes, operators and descriptions
+        if changed_search_service_ids:
+            update_search_vectors(
+                Service.objects.filter(id__in=changed_search_service_ids)
+            )
+
+        if not changed_service_ids:
+            return
+        services = Service.objects.filter(id__in=changed_service_ids)
         services.update(modified_at=Now())
 
+        # prebuilt timetable layouts, kept in the (Redis) cache -
+        # now that modified_at has changed
+        if redis_client:
+            for service in services:
+                service.do_timetable_layouts()
+
     def get_bank_holiday(self, bank_holiday_name: str):
         if self.bank_holidays is None:
             self.bank_holidays = BankHoliday.objects.in_bulk(field_name="name")
@@ -604,10 +821,9 @@ class Command(BaseCommand):
         if summary:
             calendar.summary = get_summary(summary)
 
-        calendar.save()
+        self.new_calendars.append(calendar)
 
         # filter out calendar dates with no or impossible date ranges
-        good_calendar_dates = []
         for date in calendar_dates:
             date.calendar = calendar
             if not date.start_date:
@@ -616,13 +832,11 @@ class Command(BaseCommand):
             if date.end_date < date.start_date:
                 logger.warning(date)
                 continue
-            good_calendar_dates.append(date)
-
-        CalendarDate.objects.bulk_create(good_calendar_dates)
+            self.new_calendar_dates.append(date)
 
         for bank_holiday in bank_holidays.values():
             bank_holiday.calendar = calendar
-        CalendarBankHoliday.objects.bulk_create(bank_holidays.values())
+            self.new_calendar_bank_holidays.append(bank_holiday)
 
         self.calendar_cache[calendar_hash] = calendar
 
@@ -688,9 +902,40 @@ class Command(BaseCommand):
 
         return stop_time
 
-    @cache
     def get_note(self, note_code, note_text):
-        return Note.objects.get_or_create(code=note_code or "", text=note_text[:255])[0]
+        key = (note_code or "", note_text[:255])
+        if key not in self.notes:
+            self.notes[key] = Note(code=key[0], text=key[1])
+            self.new_notes.append(self.notes[key])
+        return self.notes[key]
+
+    def save_calendars_and_notes(self):
+        """Save the calendars and notes that get_calendar and get_note have
+        created since last time, so trips can refer to them"""
+        if self.new_calendars:
+            Calendar.objects.bulk_create(self.new_calendars)
+            CalendarDate.objects.bulk_create(self.new_calendar_dates)
+            CalendarBankHoliday.objects.bulk_create(self.new_calendar_bank_holidays)
+            self.new_calendars = []
+            self.new_calendar_dates = []
+            self.new_calendar_bank_holidays = []
+
+        if self.new_notes:
+            existing_notes = Note.objects.filter(
+                code__in={note.code for note in self.new_notes},
+                text__in={note.text for note in self.new_notes},
+            )
+            existing_notes = {
+                (note.code, note.text): note.id for note in existing_notes
+            }
+            for note in self.new_notes:
+                note.id = existing_notes.get((note.code, note.text))
+                if note.id:
+                    note._state.adding = False
+            Note.objects.bulk_create(
+                [note for note in self.new_notes if note.id is None]
+            )
+            self.new_notes = []
 
     def handle_journeys(
         self,
@@ -758,6 +1003,7 @@ class Command(BaseCommand):
                 trip.garage = self.garages.get(journey.garage_ref)
 
             blank = False
+            trip_note_keys = set()
             for cell in journey.get_times():
                 stop_time = self.get_stop_time(trip, cell, stops)
                 stop_times.append(stop_time)
@@ -768,13 +1014,8 @@ class Command(BaseCommand):
                 if cell.notes:
                     for note_code, note_text in cell.notes:
                         note = self.get_note(note_code, note_text)
-                        if not (
-                            # trip_notes
-                            # and trip_notes[-1].trip is trip
-                            any(
-                                tn.trip is trip and tn.note is note for tn in trip_notes
-                            )
-                        ):
+                        if (note.code, note.text) not in trip_note_keys:
+                            trip_note_keys.add((note.code, note.text))
                             trip_notes.append(Trip.notes.through(trip=trip, note=note))
                         stop_time_notes.append(
                             StopTime.notes.through(stoptime=stop_time, note=note)
@@ -799,11 +1040,8 @@ class Command(BaseCommand):
 
             for note_code, note_text in journey.notes.items():
                 note = self.get_note(note_code, note_text)
-                if not (
-                    # trip_notes
-                    # and trip_notes[-1].trip is trip
-                    any(tn.trip is trip and tn.note is note for tn in trip_notes)
-                ):
+                if (note.code, note.text) not in trip_note_keys:
+                    trip_note_keys.add((note.code, note.text))
                     trip_notes.append(Trip.notes.through(trip=trip, note=note))
 
             if journey.frequency_interval:
@@ -833,6 +1071,8 @@ class Command(BaseCommand):
                             trip.end = stop_time.arrival_or_departure()
                             trips.append(trip)
 
+        self.save_calendars_and_notes()
+
         if not route_created:
             # reuse trip ids if the number and start times haven't changed
             existing_trips = route.trip_set.order_by("id")
@@ -880,15 +1120,15 @@ class Command(BaseCommand):
             (Trip.notes.through.objects.filter(trip__in=existing_trips).delete(),)
             StopTime.objects.filter(trip__in=existing_trips).delete()
         else:
-            Trip.objects.bulk_create(trips, batch_size=1000)
+            bulk_copy(Trip, trips)
 
-        Trip.notes.through.objects.bulk_create(trip_notes, batch_size=1000)
+        bulk_copy(Trip.notes.through, trip_notes)
 
         for stop_time in stop_times:
             stop_time.trip = stop_time.trip  # set trip_id
-        StopTime.objects.bulk_create(stop_times, batch_size=1000)
+        bulk_copy(StopTime, stop_times)
 
-        StopTime.notes.through.objects.bulk_create(stop_time_notes, batch_size=1000)
+        bulk_copy(StopTime.notes.through, stop_time_notes)
 
     def get_description(self, txc_service):
         description = txc_service.description
@@ -1131,6 +1371,7 @@ class Command(BaseCommand):
             else:
                 service = Service()
                 existing_current_service = False
+            names = (service.line_name, service.line_brand, service.description)
 
             service.line_name = line.line_name
             service.source = self.source
@@ -1261,6 +1502,13 @@ class Command(BaseCommand):
 
             self.service_ids.add(service.id)
 
+            if not existing_current_service:
+                self.service_changed(service.id)
+            elif (service.line_name, service.line_brand, service.description) != names:
+                self.service_changed(service.id, ("line_names",))
+            else:
+                self.service_changed(service.id, ())
+
             journey = journeys[0]
 
             ticket_machine_service_code = (
@@ -1389,11 +1637,21 @@ class Command(BaseCommand):
             )
 
             self.route_ids.add(route.id)
+            self.file_route_ids.append(route.id)
+
+            # unless the route was imported from exactly the same file last time,
+            # for the same service
+            previous_route = self.previous_routes.get(route_code)
+            if route_created or previous_route != (self.sha1, service.id):
+                self.service_changed(service.id)
+                if previous_route and previous_route[1] != service.id:
+                    self.service_changed(previous_route[1])  # lost a route
 
             if not skip_journeys:
                 self.handle_journeys(
                     route, route_created, stops, journeys, txc_service, operators
                 )
+                self.service_changed(service.id, ("trips",))
 
     @staticmethod
     def do_stops(transxchange_stops: dict) -> dict:
@@ -1463,13 +1721,101 @@ class Command(BaseCommand):
                     garage = Garage.objects.create(code=garage_code, name=name)
                 self.garages[garage_code] = garage
 
+    def is_unchanged(self, open_file, filename: str) -> bool:
+        """
+        Whether a file is exactly the same as when its routes were last imported
+        (and they're still current and not expired, and none of their operators has
+        open data), so it needn't be imported again.
+        The routes still count as current for mark_old_services_as_not_current.
+        Either way, remembers the routes' sha1s and services, for handle_service
+        (unless importing even unchanged files, when everything is worked out again)
+        """
+        sha1 = hashlib.sha1()
+        while data := open_file.read(65536):
+            sha1.update(data if type(data) is bytes else data.encode())
+        open_file.seek(0)
+        self.sha1 = sha1.hexdigest()
+
+        if not self.skip_unchanged:
+            return False
+
+        today = self.source.datetime.date()
+        routes = self.source.route_set.filter(
+            Q(code=filename) | Q(code__startswith=f"{filename}#")
+        )
+        if self.is_tnds() and self.source.name != "L":
+            # handle_service might now skip services of operators with open data
+            # (or defer to another source), so it needs to see them again
+            routes = routes.annotate(
+                open_data=Exists(
+                    Service.operator.through.objects.filter(
+                        service=OuterRef("service"),
+                        operator__in=self.open_data_operators
+                        | self.incomplete_operators,
+                    )
+                )
+            )
+        else:
+            routes = routes.annotate(open_data=Value(False))
+        routes = routes.values_list(
+            "id", "code", "sha1", "service", "end_date", "service__current", "open_data"
+        )
+        self.previous_routes = {
+            code: (sha1, service_id) for _, code, sha1, service_id, *_ in routes
+        }
+
+        if routes and all(
+            sha1 == self.sha1
+            and current
+            and not (end_date and end_date < today)
+            and not open_data
+            for _, _, sha1, _, end_date, current, open_data in routes
+        ):
+            self.route_ids.update(route[0] for route in routes)
+            return True
+        return False
+
+    @staticmethod
+    def do_line_name_locks(transxchange, filename: str):
+        """
+        In a worker process (see handle_archive_files, and import_file_in_worker in
+        import_bod_timetables), wait for any other worker
+        importing a file with any of the same line names to finish. Otherwise, as
+        handle_service finds existing services by line name, they might both create
+        the same new service, or both update the same one.
+        The locks last until the end of the file's transaction, and are taken in order
+        so that two workers can't each be waiting for the other
+        """
+        keys = set()
+        for txc_service in transxchange.services.values():
+            for line in txc_service.lines:
+                # same as in handle_service
+                line_name = line.line_name.replace("_", " ")
+                if "FLIX" in filename:
+                    line_name = line_name.removeprefix("UK")
+                keys.add(zlib.crc32(line_name.lower().encode()))
+
+        with connection.cursor() as cursor:
+            for key in sorted(keys):
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [key])
+
     def handle_file(self, open_file, filename: str):
+        self.previous_routes = {}
+
+        if filename and self.is_unchanged(open_file, filename):
+            return
+
+        self.file_route_ids = []
+
         transxchange = TransXChange(open_file)
 
         if not transxchange.journeys:
             logger.warning(f"{filename or open_file} has no journeys")
             return
 
+        if self.lock_line_names:
+            self.do_line_name_locks(transxchange, filename)
+
         self.vehicle_types = {}
 
         today = self.source.datetime.date()
@@ -1480,3 +1826,7 @@ class Command(BaseCommand):
 
         for txc_service in transxchange.services.values():
             self.handle_service(filename, transxchange, txc_service, today, stops)
+
+        # only now that the whole file has been imported successfully
+        if filename and self.file_route_ids:
+            Route.objects.filter(id__in=self.file_route_ids).update(sha1=self.sha1)
@@ -49,9 +49,9 @@ class ImportAtcoCifTest(TestCase):
             write_files_to_zipfile(zipfile_path, ["218 219.cif"])
 
             with time_machine.travel("2019-10-09"):
-                with self.assertNumQueries(360):
+                with self.assertNumQueries(361):
                     call_command("import_atco_cif", zipfile_path)
-                with self.assertNumQueries(368):
+                with self.assertNumQueries(369):
                     call_command("import_atco_cif", zipfile_path)
 
         self.assertEqual(5, Route.objects.count())
@@ -76,7 +76,7 @@ class ImportAtcoCifTest(TestCase):
         self.assertEqual("Goldline Express", trip.operator.name)
         self.assertEqual("1700", trip.ticket_machine_code)
 
-        with time_machine.travel("2019-10-01"), self.assertNumQueries(10):
+        with time_machine.travel("2019-10-01"), self.assertNumQueries(9):
             response = self.client.get(
                 f"/services/{service.id}/timetable?date=2019-10-01"
             )
@@ -87,7 +87,7 @@ class ImportAtcoCifTest(TestCase):
         self.assertNotContains(response, "Sunday")
         self.assertContains(response, '17:05<abbr title="pick up only">p</abbr>')
 
-        with time_machine.travel("2019-08-12"), self.assertNumQueries(7):
+        with time_machine.travel("2019-08-12"), self.assertNumQueries(6):
             response = self.client.get(
                 f"/services/{service.id}/timetable?date=2019-08-12"
             )
@@ -119,7 +119,7 @@ class ImportAtcoCifTest(TestCase):
         self.assertNotContains(response, "Sunday")
 
         # no journeys on this date - CalendarDate with operation = False - so should skip to next date of operation
-        with time_machine.travel("2019-07-20"), self.assertNumQueries(18):
+        with time_machine.travel("2019-07-20"), self.assertNumQueries(17):
             response = self.client.get(
                 "/services/219-belfast-europa-buscentre-ballymena-buscentre"
             )
@@ -128,6 +128,6 @@ class ImportAtcoCifTest(TestCase):
         self.assertContains(response, "set down only")
 
         service = Service.objects.get(service_code="218_GLE")
-        with time_machine.travel("2019-10-01"), self.assertNumQueries(18):
+        with time_machine.travel("2019-10-01"), self.assertNumQueries(17):
             response = self.client.get(service.get_absolute_url() + "?date=2019-10-01")
         self.assertContains(response, "set down only")
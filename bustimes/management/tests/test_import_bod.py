@@ -5,6 +5,7 @@ from tempfile import TemporaryDirectory
 from unittest.mock import patch
 
 import fakeredis
+import numpy as np
 import time_machine
 from ciso8601 import parse_datetime
 from django.contrib.gis.geos import Point
@@ -13,6 +14,7 @@ from django.test import TestCase, override_settings
 from vcr import use_cassette
 
 from accounts.models import User
+from departures import boards
 from busstops.models import (
     AdminArea,
     DataSource,
@@ -26,6 +28,8 @@ from busstops.models import (
 )
 from vehicles.models import VehicleJourney, VehicleLocation
 
+from ..commands import import_bod_timetables
+from ..commands.import_transxchange import Command as TransXChangeCommand
 from ...models import (
     BankHoliday,
     BankHolidayDate,
@@ -247,6 +251,41 @@ Lynx/Bus Open Data Service (BODS)</a>, <time datetime="2020-04-01">1 April 2020<
             response = self.client.get("/stops/2900W0321/times.json?when=yesterday")
         self.assertEqual(400, response.status_code)
 
+        # departure boards
+        with patch(
+            "departures.boards.redis_client", fakeredis.FakeStrictRedis()
+        ) as fake_redis:
+            response = self.client.get("/stops/2900W0321/times.json")
+            self.assertEqual(response.json(), expected_json)
+            self.assertEqual(len(fake_redis.keys("departures:stoppoint:*")), 2)
+
+            # boards already exist
+            response = self.client.get("/stops/2900W0321/times.json")
+            self.assertEqual(response.json(), expected_json)
+
+            # boards with stop times that no longer exist - rebuilt
+            stale_board = np.array([(172799, 0)], dtype=boards.board_dtype).tobytes()
+            for key in fake_redis.keys("departures:stoppoint:*"):
+                fake_redis.set(key, stale_board)
+            response = self.client.get("/stops/2900W0321/times.json")
+            self.assertEqual(response.json(), expected_json)
+            self.assertNotIn(
+                stale_board,
+                [fake_redis.get(key) for key in fake_redis.keys("departures:*")],
+            )
+
+            response = self.client.get("/stops/2900W0321?date=2020-05-02")
+            self.assertEqual(1, len(response.context["departures"]))
+
+        # Redis is down - fall back on the database
+        server = fakeredis.FakeServer()
+        server.connected = False
+        with patch(
+            "departures.boards.redis_client", fakeredis.FakeStrictRedis(server=server)
+        ):
+            response = self.client.get("/stops/2900W0321/times.json")
+            self.assertEqual(response.json(), expected_json)
+
         # with patch(
         #     "departures.live.NorfolkDepartures.get_departures", return_value=[]
         # ) as mocked:
@@ -292,6 +331,22 @@ Lynx/Bus Open Data Service (BODS)</a>, <time datetime="2020-04-01">1 April 2020<
         trip = journey.get_trip(journey_code="0915")
         self.assertEqual(trip.ticket_machine_code, "1")
 
+        # reuse the same trip table
+        trip_tables = {}
+        with self.assertNumQueries(2):
+            trip = journey.get_trip(journey_code="0915", trip_tables=trip_tables)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                journey.get_trip(journey_code="0915", trip_tables=trip_tables), trip
+            )
+
+        # but not after the timetable has been re-imported
+        journey.service.modified_at = parse_datetime("2020-05-02T00:00:00Z")
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                journey.get_trip(journey_code="0915", trip_tables=trip_tables), trip
+            )
+
         trip = journey.get_trip(destination_ref="2900K132")
         self.assertEqual(trip.ticket_machine_code, "1")
 
@@ -395,6 +450,50 @@ Lynx/Bus Open Data Service (BODS)</a>, <time datetime="2020-04-01">1 April 2020<
             ],
         )
 
+    def test_download_all(self):
+        jobs = ["a", "b", "c"]
+
+        self.assertEqual(
+            list(import_bod_timetables.download_all(str.upper, jobs)),
+            [("a", "A"), ("b", "B"), ("c", "C")],
+        )
+
+        # in threads - finishing in any order
+        self.assertEqual(
+            sorted(import_bod_timetables.download_all(str.upper, jobs, workers=3)),
+            [("a", "A"), ("b", "B"), ("c", "C")],
+        )
+
+    @time_machine.travel(datetime.datetime(2020, 5, 1), tick=False)
+    def test_import_file_in_worker(self):
+        source = DataSource.objects.create(
+            name="Lynx",
+            datetime=datetime.datetime(2020, 5, 1, tzinfo=datetime.timezone.utc),
+        )
+
+        with (
+            TemporaryDirectory() as directory,
+            override_settings(DATA_DIR=Path(directory)),
+            patch.object(
+                TransXChangeCommand,
+                "do_line_name_locks",
+                wraps=TransXChangeCommand.do_line_name_locks,
+            ) as do_line_name_locks,
+        ):
+            (Path(directory) / "lynx.xml").write_bytes(
+                (FIXTURES_DIR / "ea_21-13B-B-y08-1.xml").read_bytes()
+            )
+            service_ids, service_changes = import_bod_timetables.import_file_in_worker(
+                None, source, "lynx.xml", "EA"
+            )
+
+        # in a transaction, with locks on the line names, like import_transxchange's
+        # worker processes - as other workers might be importing the same services
+        do_line_name_locks.assert_called_once()
+        self.assertEqual(service_ids, set(Service.objects.values_list("id", flat=True)))
+        self.assertTrue(service_ids)
+        self.assertEqual(set(service_changes), service_ids)
+
     @time_machine.travel(datetime.datetime(2020, 6, 10))
     def test_import_stagecoach(self):
         source = TimetableDataSource.objects.create(
@@ -457,7 +556,7 @@ Lynx/Bus Open Data Service (BODS)</a>, <time datetime="2020-04-01">1 April 2020<
                 "bustimes.management.commands.import_bod_timetables.download_if_modified",
                 return_value=(True, parse_datetime("2020-06-10T12:00:00+01:00")),
             ) as download_if_modified:
-                with self.assertNumQueries(110):
+                with self.assertNumQueries(101):
                     call_command("import_bod_timetables", "stagecoach")
                 download_if_modified.assert_called_with(
                     path, DataSource.objects.get(name="Stagecoach East")
@@ -477,7 +576,7 @@ Lynx/Bus Open Data Service (BODS)</a>, <time datetime="2020-04-01">1 April 2020<
                 with self.assertNumQueries(1):
                     call_command("import_bod_timetables", "stagecoach", "SCOX")
 
-                with self.assertNumQueries(118):
+                with self.assertNumQueries(107):
                     call_command("import_bod_timetables", "stagecoach", "SCCM")
 
                 route_link.refresh_from_db()
@@ -8,12 +8,13 @@ from unittest.mock import patch
 import time_machine
 import vcr
 from django.core.management import call_command
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 
 from busstops.models import AdminArea, DataSource, Operator, Region, Service, StopPoint
 
-from ...models import Route
+from ...models import Route, StopTime
 from ...download_utils import download_if_modified
+from ...gtfs import Feed
 
 FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
 
@@ -137,6 +138,18 @@ class GTFSTest(TestCase):
         self.assertEqual(len(timetable.groupings[0].rows), 18)
         self.assertEqual(len(timetable.groupings[1].rows), 14)
 
+        stop_time = StopTime.objects.filter(
+            trip__ticket_machine_code="1.Mo-Fr.20-165-y11-1.1.O"
+        ).first()
+        self.assertEqual(stop_time.stop_id, "8220DB002087")
+        self.assertEqual(stop_time.stop_code, "")
+        self.assertIsNone(stop_time.arrival)
+        self.assertEqual(stop_time.departure, datetime.timedelta(hours=7, minutes=45))
+        self.assertEqual(stop_time.sequence, 1)
+        self.assertEqual(stop_time.timing_status, "PTP")
+        self.assertTrue(stop_time.pick_up)
+        self.assertFalse(stop_time.set_down)
+
         self.assertContains(
             response,
             '<a href="https://www.transportforireland.ie/transitData/PT_Data.html#:~:text=Mortons" rel="nofollow">'
@@ -150,7 +163,7 @@ class GTFSTest(TestCase):
             datetime.date(2020, 12, 3),
         ):
             with time_machine.travel(day):
-                with self.assertNumQueries(15):
+                with self.assertNumQueries(14):
                     response = self.client.get(f"/services/165?date={day}")
                 timetable = response.context_data["timetable"]
                 self.assertEqual(day, timetable.date)
@@ -229,3 +242,52 @@ class GTFSTest(TestCase):
             call_command("import_gtfs", "Wexford Bus")
 
         self.assertFalse(Route.objects.all())
+
+
+class FeedTest(SimpleTestCase):
+    def test_iter_stop_times(self):
+        with TemporaryDirectory() as directory:
+            make_zipfile(directory, "Wexford_Bus")
+
+            with Feed(Path(directory) / "GTFS_Wexford_Bus.zip", chunk_size=40) as feed:
+                self.assertEqual(len(feed.trips), 8)
+
+                chunks = list(feed.iter_stop_times(columns=("stop_id",)))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [38, 40, 20, 20])
+        self.assertEqual(list(chunks[0].columns), ["trip_id", "stop_id"])
+
+        # each trip's stop times are all in one chunk
+        trip_ids = [trip_id for chunk in chunks for trip_id in chunk.trip_id.unique()]
+        self.assertEqual(len(trip_ids), 7)
+        self.assertEqual(len(set(trip_ids)), 7)
+
+    def test_iter_stop_times_not_grouped_by_trip(self):
+        dir_path = FIXTURES_DIR / "GTFS_Wexford_Bus"
+        header, *rows = (dir_path / "stop_times.txt").read_text().splitlines()
+
+        with TemporaryDirectory() as directory:
+            feed_path = Path(directory) / "GTFS_Wexford_Bus.zip"
+            with zipfile.ZipFile(feed_path, "a") as open_zipfile:
+                for item in dir_path.iterdir():
+                    open_zipfile.write(item, item.name)
+                # stop times in reverse order
+                open_zipfile.writestr(
+                    "stop_times.txt", "\n".join([header, *reversed(rows)])
+                )
+
+            with Feed(feed_path, chunk_size=40) as feed:
+                self.assertFalse(feed.is_grouped_by_trip())
+
+                chunks = list(feed.iter_stop_times(columns=("stop_sequence",)))
+
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 118)
+        self.assertEqual(list(chunks[0].columns), ["trip_id", "stop_sequence"])
+
+        # each trip's stop times are all in one chunk, in order
+        trip_ids = [trip_id for chunk in chunks for trip_id in chunk.trip_id.unique()]
+        self.assertEqual(len(trip_ids), 7)
+        self.assertEqual(len(set(trip_ids)), 7)
+        for chunk in chunks:
+            for _, stop_sequences in chunk.groupby("trip_id").stop_sequence:
+                self.assertTrue(stop_sequences.is_monotonic_increasing)
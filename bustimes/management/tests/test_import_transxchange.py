@@ -22,6 +22,7 @@ from busstops.models import (
     ServiceColour,
     StopPoint,
 )
+from transxchange.txc import TransXChange
 from vosa.models import Licence, Registration
 
 from ...models import (
@@ -108,9 +109,10 @@ class ImportTransXChangeTest(TestCase):
         cls.user = User.objects.create()
 
     @staticmethod
-    def handle_files(archive_name, filenames):
+    def handle_files(archive_name, filenames, skip_unchanged=True):
         command = import_transxchange.Command()
         command.set_up()
+        command.skip_unchanged = skip_unchanged
         command.service_ids = set()
         command.route_ids = set()
         command.open_data_operators = set()
@@ -123,6 +125,7 @@ class ImportTransXChangeTest(TestCase):
             with open(path, "r") as open_file:
                 command.handle_file(open_file, filename)
         command.finish_services()
+        return command
 
     @classmethod
     def write_files_to_zipfile_and_import(cls, zipfile_name, filenames):
@@ -137,6 +140,30 @@ class ImportTransXChangeTest(TestCase):
     def write_file_to_zipfile(open_zipfile, filename, arcname=None):
         open_zipfile.write(FIXTURES_DIR / filename, arcname=arcname or filename)
 
+    @time_machine.travel("3 October 2016")
+    def test_unchanged_file_of_open_data_operator(self):
+        whippet = Operator.objects.create(
+            noc="WHIP", region_id="EA", name="Whippet Coaches"
+        )
+        filename = "ea_20-12-_-y08-1.xml"
+        self.handle_files("EA.zip", [filename])
+        self.assertEqual(Route.objects.get().service.operator.get(), whippet)
+
+        command = import_transxchange.Command()
+        command.set_up()
+        command.route_ids = set()
+        command.open_data_operators = set()
+        command.incomplete_operators = set()
+        command.set_region("EA.zip")
+        command.source.datetime = timezone.now()
+
+        with open(FIXTURES_DIR / filename) as open_file:
+            self.assertTrue(command.is_unchanged(open_file, filename))
+
+            # handle_service should get a chance to skip the operator's services
+            command.open_data_operators = {"WHIP"}
+            self.assertFalse(command.is_unchanged(open_file, filename))
+
     @time_machine.travel("3 October 2016")
     def test_east_anglia(self):
         self.handle_files("EA.zip", ["ea_20-12-_-y08-1.xml", "ea_21-13B-B-y08-1.xml"])
@@ -918,6 +945,18 @@ class ImportTransXChangeTest(TestCase):
         self.assertEqual(1, feet[4].span)
         self.assertEqual(6, feet[5].span)
 
+        # importing again should reuse the existing notes
+        self.assertEqual(Note.objects.count(), 3)
+        with self.assertLogs(
+            "bustimes.management.commands.import_transxchange", "WARNING"
+        ), patch("os.path.getmtime", return_value=0):
+            call_command(
+                "import_transxchange",
+                FIXTURES_DIR / "twm_3-74-_-y11-1.xml",
+                force=True,
+            )
+        self.assertEqual(Note.objects.count(), 3)
+
     @time_machine.travel("2021-07-07")
     def test_multiple_lines(self):
         call_command(
@@ -991,13 +1030,13 @@ class ImportTransXChangeTest(TestCase):
         service.geometry = "SRID=4326;MULTILINESTRING((1.31326925542 51.1278853356,1.08276947772 51.2766792559))"
         service.save(update_fields=["geometry"])
 
-        with self.assertNumQueries(15):
+        with self.assertNumQueries(14):
             res = self.client.get(service.get_absolute_url() + "?date=2017-09-01")
         self.assertEqual(str(res.context_data["timetable"].date), "2017-09-01")
         # self.assertContains(res, 'Timetable changes from <a href="?date=2017-09-03">Sunday 3 September 2017</a>')
         # self.assertContains(res, f'data-service="{service.id},{duplicate.id}"></div')
 
-        with time_machine.travel("1 October 2017"), self.assertNumQueries(17):
+        with time_machine.travel("1 October 2017"), self.assertNumQueries(16):
             res = self.client.get(service.get_absolute_url())
         # self.assertContains(res, """
         #         <thead>
@@ -1033,7 +1072,7 @@ class ImportTransXChangeTest(TestCase):
             "Glossop - Piccadilly Gardens, Manchester City Centre or Ashton Under Lyne",
         )
 
-        with time_machine.travel("1 October 2017"), self.assertNumQueries(11):
+        with time_machine.travel("1 October 2017"), self.assertNumQueries(10):
             timetable = service.get_timetable(date(2017, 10, 3)).render()
         self.assertEqual(str(timetable.date), "2017-10-03")
         self.assertEqual(27, len(timetable.groupings[1].trips))
@@ -1141,6 +1180,12 @@ class ImportTransXChangeTest(TestCase):
         service = Service.objects.get(line_name="N17")
         self.assertEqual(service.operator.count(), 1)
 
+        # re-import the same file on purpose - everything is worked out again
+        command = self.handle_files("S.zip", ["SVRABBN017.xml"], skip_unchanged=False)
+        self.assertEqual(
+            command.service_changes[service.id], import_transxchange.SERVICE_CHANGES
+        )
+
     @time_machine.travel("22 January 2017")
     def test_megabus(self):
         # simulate a National Coach Service Database zip file
@@ -1173,7 +1218,7 @@ class ImportTransXChangeTest(TestCase):
             with self.assertLogs(
                 "bustimes.management.commands.import_transxchange", "WARNING"
             ):
-                call_command("import_transxchange", zipfile_path)
+                call_command("import_transxchange", zipfile_path, force=True)
 
             # ids should have kept the same
             self.assertEqual(
@@ -1184,6 +1229,13 @@ class ImportTransXChangeTest(TestCase):
                 m12_trip_ids, Trip.objects.filter(route__line_name="M12").last().id
             )
 
+            # unchanged files should be skipped
+            with patch.object(
+                import_transxchange.Command, "handle_service"
+            ) as handle_service:
+                call_command("import_transxchange", zipfile_path)
+            handle_service.assert_not_called()
+
         # M11A
 
         res = self.client.get(
@@ -1343,6 +1395,33 @@ class ImportTransXChangeTest(TestCase):
             )
         )
 
+    def test_get_chunks(self):
+        self.assertEqual(
+            import_transxchange.get_chunks(
+                [
+                    "ea_21-2-_-y08-1.xml",
+                    "NATX_330.xml",
+                    "ea_21-2-_-y08-2.xml",
+                    "ea_21-27-D-y08-1.xml",
+                ],
+                2,
+            ),
+            [
+                ["ea_21-2-_-y08-1.xml", "ea_21-2-_-y08-2.xml"],
+                ["NATX_330.xml", "ea_21-27-D-y08-1.xml"],
+            ],
+        )
+
+    def test_do_line_name_locks(self):
+        with open(FIXTURES_DIR / "ea_20-12-_-y08-1.xml") as open_file:
+            transxchange = TransXChange(open_file)
+
+        # one line name, one lock
+        with self.assertNumQueries(1):
+            import_transxchange.Command.do_line_name_locks(
+                transxchange, "ea_20-12-_-y08-1.xml"
+            )
+
     @time_machine.travel("2023-07-24")
     def test_pick_up_and_set_down(self):
         with patch("os.path.getmtime", return_value=1690162625):
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2024-06-01 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0003_rename_calendar_start_date_end_date_bustimes_ca_start_d_3f135c_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='sha1',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
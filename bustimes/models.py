@@ -50,6 +50,7 @@ class Route(models.Model):
         "busstops.Service", models.CASCADE, null=True, blank=True
     )
     public_use = models.BooleanField(null=True)
+    sha1 = models.CharField(max_length=40, null=True, blank=True)  # of the file
 
     def contains(self, date):
         if not self.start_date or self.start_date <= date:
@@ -160,31 +161,80 @@ class Calendar(models.Model):
                 return True
         return False
 
-    def allows(self, date) -> bool:
-        if not self.contains(date):
-            return False
-
-        if getattr(self, f"{date:%a}".lower()):
-            for calendar_date in self.calendardate_set.all():
-                if not calendar_date.operation and calendar_date.contains(date):
-                    return False
-            return True
-
+    def get_runs_on(self, start_date, days: int) -> int:
+        """Which of the `days` days from `start_date` this calendar runs on, as the bits
+        of an int (bit 0 is `start_date`). Follows the same rules as
+        bustimes.utils.get_calendars, but uses the prefetched calendardate_set and the
+        bank_holiday_inclusions and bank_holiday_exclusions annotations (see Timetable)
+        """
+
+        def bits(from_date, to_date) -> int:
+            first = max((from_date - start_date).days, 0)
+            last = days - 1
+            if to_date:
+                last = min((to_date - start_date).days, last)
+            if last < first:
+                return 0
+            return ((1 << (last - first + 1)) - 1) << first
+
+        def dates_bits(dates) -> int:
+            offsets = {(date - start_date).days for date in dates}
+            return sum(1 << offset for offset in offsets if 0 <= offset < days)
+
+        day_values = self.get_day_values()
+        weekday = start_date.weekday()
+        day_of_week = 0
+        for i in range(days):
+            if day_values[(weekday + i) % 7]:
+                day_of_week |= 1 << i
+
+        exclusions = inclusions = special_inclusions = 0
+        only_certain_dates = False
         for calendar_date in self.calendardate_set.all():
-            if (
-                calendar_date.operation
-                and calendar_date.special
-                and calendar_date.contains(date)
-            ):
-                return True
+            calendar_date_bits = bits(calendar_date.start_date, calendar_date.end_date)
+            if not calendar_date.operation:
+                exclusions |= calendar_date_bits
+            else:
+                inclusions |= calendar_date_bits
+                if calendar_date.special:
+                    special_inclusions |= calendar_date_bits
+                else:
+                    only_certain_dates = True
+        if only_certain_dates:
+            day_of_week &= inclusions
+
+        bank_holiday_inclusions = dates_bits(self.bank_holiday_inclusions)
+        bank_holiday_exclusions = dates_bits(self.bank_holiday_exclusions)
+
+        return (
+            bits(self.start_date, self.end_date)
+            & ~exclusions
+            & (
+                day_of_week & ~bank_holiday_exclusions
+                | special_inclusions
+                | bank_holiday_inclusions & ~bank_holiday_exclusions
+            )
+        )
 
-        if date in self.bank_holiday_exclusions:
-            return False
-        if date in self.bank_holiday_inclusions:
-            return True
+    def allows(self, date) -> bool:
+        # compile a few weeks around the date, and reuse that for nearby dates
+        # (unless start_date or end_date have been changed in the meantime)
+        runs_on = getattr(self, "_runs_on", None)
+        if (
+            runs_on is None
+            or runs_on[0] != (self.start_date, self.end_date)
+            or not 0 <= (date - runs_on[1]).days < 64
+        ):
+            window_start = date - timedelta(days=7)
+            runs_on = self._runs_on = (
+                (self.start_date, self.end_date),
+                window_start,
+                self.get_runs_on(window_start, 64),
+            )
+        return bool(runs_on[2] >> (date - runs_on[1]).days & 1)
 
-    def get_days(self) -> list:
-        day_values = (
+    def get_day_values(self) -> tuple:
+        return (
             self.mon,
             self.tue,
             self.wed,
@@ -193,6 +243,9 @@ class Calendar(models.Model):
             self.sat,
             self.sun,
         )
+
+    def get_days(self) -> list:
+        day_values = self.get_day_values()
         return [day_keys[i] for i, value in enumerate(day_values) if value]
 
     def get_order(self) -> list:
@@ -1,14 +1,20 @@
+import graphlib
 import os
 from datetime import date, datetime, timedelta, timezone
+from unittest.mock import patch
 
-from django.test import TestCase
+import numpy as np
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from vcr import use_cassette
 
 from busstops.models import DataSource, Service
 from vehicles.models import Livery, Vehicle, VehicleCode
 
 from .models import Calendar, CalendarDate, Garage, Route, StopTime, Trip
-from .utils import get_routes
+from .timetables import Grouping, SequenceMerger, Timetable, get_column_order
+from .utils import bulk_copy, get_routes
 
 
 class BusTimesTest(TestCase):
@@ -191,6 +197,165 @@ class BusTimesTest(TestCase):
 
         self.assertEqual(str(trip), "01:47")
 
+    def test_get_column_order(self):
+        # trip 1 is before all the others, trip 0 is before trip 2,
+        # trip 3 is only after trip 1, and trip 2 (which ends where trip 3 starts)
+        order = np.array(
+            [[0, 1, -1, 0], [-1, 0, -1, -1], [1, 1, 0, 0], [0, 1, 0, 0]], dtype=np.int8
+        )
+        ties = np.zeros((4, 4), dtype=bool)
+        ties[2, 3] = True
+
+        sorter = graphlib.TopologicalSorter()
+        for a in range(4):
+            for b in range(4):
+                if order[a, b] > 0:
+                    sorter.add(a, b)
+                elif order[a, b] < 0 or ties[a, b]:
+                    sorter.add(b, a)
+
+        self.assertEqual(get_column_order(order, ties), list(sorter.static_order()))
+
+        # cycle
+        order = np.array([[0, -1, 1], [1, 0, -1], [-1, 1, 0]], dtype=np.int8)
+        self.assertIsNone(get_column_order(order, np.zeros((3, 3), dtype=bool)))
+
+    def test_sequence_merger(self):
+        merger = SequenceMerger()
+        self.assertEqual(merger.merge(["A", "B", "C"]), ([0, 1, 2], [0, 1, 2]))
+        self.assertEqual(merger.merge(["A", "D", "C"]), ([0, 2, 3], [1]))
+        self.assertEqual(merger.keys, ["A", "B", "D", "C"])
+        self.assertEqual(merger.merge(["A", "B", "C"]), ([0, 1, 3], []))
+
+        # C is in the rows twice now
+        self.assertEqual(merger.merge(["C", "A"]), ([0, 1], [0]))
+        self.assertEqual(merger.merge(["C", "A"]), ([0, 1], []))
+        self.assertEqual(merger.keys, ["C", "A", "B", "D", "C"])
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_timetable_layout(self):
+        source = DataSource.objects.create(name="Lynx")
+        service = Service.objects.create(line_name="55")
+        route = Route.objects.create(
+            service=service, source=source, code="55", line_name="55"
+        )
+        calendar = Calendar.objects.create(
+            mon=True,
+            tue=True,
+            wed=True,
+            thu=True,
+            fri=True,
+            sat=True,
+            sun=True,
+            start_date=date(2022, 1, 1),
+        )
+        for hour in (10, 9):
+            trip = Trip.objects.create(
+                route=route,
+                calendar=calendar,
+                start=timedelta(hours=hour),
+                end=timedelta(hours=hour, minutes=10),
+            )
+            StopTime.objects.bulk_create(
+                [
+                    StopTime(trip=trip, stop_code="A", departure=trip.start),
+                    StopTime(trip=trip, stop_code="B", arrival=trip.end),
+                ]
+            )
+
+        service.do_timetable_layouts()
+
+        timetable = service.get_timetable()
+        rows, trip_ids, positions = cache.get(timetable.get_layout_key())[0]
+        self.assertEqual([row[0] for row in rows], ["A", "B"])
+        self.assertEqual(len(trip_ids), 2)
+        self.assertEqual(positions, [[0, 1], [0, 1]])
+
+        # the prebuilt layout is used instead of working out the rows again
+        with patch.object(Grouping, "sort_rows") as sort_rows:
+            timetable.render()
+        sort_rows.assert_not_called()
+
+        grouping = timetable.groupings[0]
+        self.assertEqual(str(grouping.rows[0].times), "[09:00, 10:00]")
+        self.assertEqual(str(grouping.rows[1].times), "[09:10, 10:10]")
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_timetable_layouts_by_date(self):
+        source = DataSource.objects.create(name="Lynx")
+        service = Service.objects.create(line_name="55")
+        route = Route.objects.create(
+            service=service, source=source, code="55", line_name="55"
+        )
+        every_day = Calendar.objects.create(
+            mon=True,
+            tue=True,
+            wed=True,
+            thu=True,
+            fri=True,
+            sat=True,
+            sun=True,
+            start_date=date(2022, 1, 1),
+        )
+        weekdays = Calendar.objects.create(
+            mon=True,
+            tue=True,
+            wed=True,
+            thu=True,
+            fri=True,
+            sat=False,
+            sun=False,
+            start_date=date(2022, 1, 1),
+        )
+        for hour, calendar in ((9, every_day), (10, weekdays)):
+            trip = Trip.objects.create(
+                route=route,
+                calendar=calendar,
+                start=timedelta(hours=hour),
+                end=timedelta(hours=hour, minutes=10),
+            )
+            StopTime.objects.bulk_create(
+                [
+                    StopTime(trip=trip, stop_code="A", departure=trip.start),
+                    StopTime(trip=trip, stop_code="B", arrival=trip.end),
+                ]
+            )
+
+        # three weeks of dates to choose from, but only weekdays and weekends differ
+        with patch("busstops.models.Timetable", wraps=Timetable) as timetable_class:
+            service.do_timetable_layouts()
+        self.assertEqual(timetable_class.call_count, 2)
+
+        timetable = service.get_timetable()
+        self.assertGreater(len(timetable.date_options), 7)
+        for day in timetable.date_options:
+            timetable = service.get_timetable(day)
+            self.assertIsNotNone(cache.get(timetable.get_layout_key()))
+
+    def test_bulk_copy(self):
+        source = DataSource.objects.create(name="Lynx")
+        route = Route.objects.create(source=source, code="55")
+        trip = Trip(route=route, start=timedelta(hours=25), end=timedelta(hours=26))
+        stop_times = [
+            StopTime(trip=trip, stop_code="A\tB", departure=trip.start, sequence=1),
+            StopTime(trip=trip, stop_code="C", arrival=trip.end, set_down=False),
+        ]
+
+        bulk_copy(Trip, [trip])
+        bulk_copy(StopTime, stop_times)
+
+        self.assertIsNotNone(trip.id)
+        trip = Trip.objects.get()
+        self.assertEqual(trip.end, timedelta(hours=26))
+        self.assertEqual(
+            list(trip.stoptime_set.values_list("id", "stop_code", "set_down")),
+            [(stop_times[0].id, "A\tB", True), (stop_times[1].id, "C", False)],
+        )
+
     def test_stop_time(self):
         time = StopTime(departure=timedelta(hours=10, minutes=47, seconds=30))
         self.assertEqual(str(time), "10:47")
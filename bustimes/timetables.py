@@ -3,10 +3,13 @@ import graphlib
 from dataclasses import dataclass
 from difflib import Differ
 from functools import cached_property, cmp_to_key, partial
+from itertools import pairwise
 
+import numpy as np
 from django.conf import settings
 from django.contrib.postgres.aggregates import ArrayAgg
-from django.db.models import Prefetch, Q
+from django.core.cache import cache
+from django.db.models import F, Prefetch, Q
 from django.utils.html import format_html
 from django.utils.timezone import localdate
 from sql_util.utils import Exists
@@ -18,8 +21,78 @@ from .utils import get_calendars, get_descriptions, get_routes
 differ = Differ(charjunk=lambda _: True)
 
 
+class SequenceMerger:
+    """Merges trips' sequences of stops into one sequence of rows.
+
+    Each sequence is lined up with the rows so far the same way difflib.Differ
+    would line it up (which decides where any new rows go), but difflib is skipped
+    when the answer is already known - when the rows are all different stops and
+    the sequence visits them in order, or when the same sequence has already been
+    lined up with the same rows
+    """
+
+    def __init__(self, keys=()):
+        self.keys = list(keys)
+        self.alignments = {}
+        self.update_indices()
+
+    def update_indices(self):
+        self.indices = {key: i for i, key in enumerate(self.keys)}
+        if len(self.indices) < len(self.keys):
+            self.indices = None  # some stops are in the rows more than once
+
+    def merge(self, sequence) -> tuple[list[int], list[int]]:
+        """Adds any stops in a sequence that aren't in the rows already.
+        Returns the row index for each item in the sequence,
+        and the indices of the items that were added as new rows
+        """
+        if self.indices is not None:
+            try:
+                positions = [self.indices[key] for key in sequence]
+            except KeyError:
+                pass
+            else:
+                if all(a < b for a, b in pairwise(positions)):
+                    return positions, []
+
+        sequence = tuple(sequence)
+        alignment = self.alignments.get(sequence)
+        if alignment and alignment[0] == len(self.keys):
+            return alignment[1], []
+
+        diff = differ.compare(self.keys.copy(), sequence)
+        positions = []
+        inserted = []
+
+        y = 0  # how many rows down we are
+        for i, key in enumerate(sequence):
+            instruction = next(diff)
+
+            while instruction[0] in "-?":
+                if instruction[0] == "-":
+                    y += 1
+                instruction = next(diff)
+
+            assert instruction[2:] == key
+
+            if instruction[0] == "+":
+                self.keys.insert(y, key)
+                inserted.append(i)
+            positions.append(y)
+
+            y += 1
+
+        if inserted:
+            self.update_indices()
+        else:
+            self.alignments[sequence] = (len(self.keys), positions)
+
+        return positions, inserted
+
+
 def get_stop_usages(trips):
     groupings = [[], []]
+    mergers = [SequenceMerger(), SequenceMerger()]
 
     trips = trips.prefetch_related(
         Prefetch(
@@ -39,75 +112,96 @@ def get_stop_usages(trips):
 
         stop_times = trip.stoptime_set.all()
 
-        old_rows = [stop_time.stop_id for stop_time in grouping]
-        new_rows = [stop_time.stop_id for stop_time in stop_times]
-        diff = differ.compare(old_rows, new_rows)
-
-        y = 0  # how many rows down we are
-
-        for stop_time in stop_times:
-            if y < len(old_rows):
-                existing_row = old_rows[y]
-            else:
-                existing_row = None
-
-            instruction = next(diff)
-
-            while instruction[0] in "-?":
-                if instruction[0] == "-":
-                    y += 1
-                    if y < len(old_rows):
-                        existing_row = old_rows[y]
-                    else:
-                        existing_row = None
-                instruction = next(diff)
-
-            assert instruction[2:] == stop_time.stop_id
-
-            if instruction[0] == "+":
-                if not existing_row:
-                    grouping.append(stop_time)
-                    old_rows.append(stop_time.stop_id)
-                else:
-                    grouping = grouping[:y] + [stop_time] + grouping[y:]
-                    old_rows = old_rows[:y] + [stop_time.stop_id] + old_rows[y:]
-            else:
-                assert instruction[2:] == existing_row
+        positions, inserted = mergers[grouping_id].merge(
+            [stop_time.stop_id for stop_time in stop_times]
+        )
+        for i in inserted:
+            grouping.insert(positions[i], stop_times[i])
 
-            y += 1
+    return groupings
 
-        groupings[grouping_id] = grouping
 
-    return groupings
+def get_column_order(order, ties):
+    """Topologically sort trips, given the matrices worked out by Grouping.sort_columns.
 
+    Gives exactly the order graphlib.TopologicalSorter.static_order() would,
+    if for each trip a, for each other trip b, sorter.add(later, earlier) was called
+    (as sort_columns used to) - but without adding each of the (trips²) edges one by one.
+    Returns None if there's a cycle, or a trip that can't be compared to any other
+    """
+    n = len(order)
+    indices = np.arange(n)
 
-def compare_trips(rows, trip_ids, a, b):
-    a_time = None
-    b_time = None
+    # pairs (a, b) for which sorter.add() would have been called
+    edges = (order != 0) | ties
+    if not (edges.any(axis=0) | edges.any(axis=1)).all():
+        return
 
-    a_top = rows.index(a.top)
-    a_bottom = rows.index(a.bottom)
-    b_top = rows.index(b.top)
-    b_bottom = rows.index(b.bottom)
+    # the order in which sorter.add() would have first seen each trip
+    # (either as the first "node" argument or the second "predecessor" argument)
+    first_b = edges.argmax(axis=1)
+    first_a = edges.argmax(axis=0)
+    seen = np.minimum(
+        np.where(
+            edges.any(axis=1),
+            (indices * n + first_b) * 2 + (order[indices, first_b] <= 0),
+            n * n * 2,
+        ),
+        np.where(
+            edges.any(axis=0),
+            (first_a * n + indices) * 2 + (order[first_a, indices] <= 0),
+            n * n * 2,
+        ),
+    )
+    seen_order = np.argsort(seen)
+
+    # before[p, s]: trip p is a predecessor of trip s
+    before = (order < 0) | ties
+    # when p was (last) added as a predecessor of s,
+    # which decides the order of p's successors
+    added = indices[:, None] * n + indices[None, :]
+    added = np.where(ties, added, np.maximum(added, added.T))
+
+    remaining = before.sum(axis=0)
+    ready = seen_order[remaining[seen_order] == 0]
+    result = []
+    while len(ready):
+        result += ready.tolist()
+
+        successors = before[ready]
+        remaining -= successors.sum(axis=0)
+        new = np.flatnonzero((remaining == 0) & successors.any(axis=0))
+
+        # nodes become ready in the order they were added as successors of
+        # the last of their predecessors to be done
+        last = np.where(successors[:, new], np.arange(len(ready))[:, None], -1).max(
+            axis=0
+        )
+        ready = new[np.argsort(last * n * n + added[ready[last], new], kind="stable")]
 
-    a_index = trip_ids.index(a.id)
-    b_index = trip_ids.index(b.id)
+    if len(result) == n:
+        return result
 
-    for row in rows[max(a_top, b_top) : min(a_bottom, b_bottom) + 1]:
-        if row.times[a_index] and row.times[b_index]:
-            a_time = row.times[a_index].departure_or_arrival()
-            b_time = row.times[b_index].departure_or_arrival()
-            return (a_time - b_time).total_seconds()
 
-    if a_top > b_bottom:  # b is above a
-        a_time = a.start
-        b_time = b.end
-    elif b_top > a_bottom:  # a is above b
-        a_time = a.end
-        b_time = b.start
+def compare_trips(trips, order, shared, tops, bottoms, a, b):
+    """Compare two trips (by index), for when Grouping.sort_columns couldn't work out
+    a consistent order
+    """
+    if shared[a, b]:
+        return int(order[a, b])
+
+    a_trip = trips[a]
+    b_trip = trips[b]
+
+    if tops[a] > bottoms[b]:  # b is above a
+        a_time = a_trip.start
+        b_time = b_trip.end
+    elif tops[b] > bottoms[a]:  # a is above b
+        a_time = a_trip.end
+        b_time = b_trip.start
     else:
-        a_time = a.start
-        b_time = b.start
+        a_time = a_trip.start
+        b_time = b_trip.start
 
     if a_time and b_time:
         return (a_time - b_time).total_seconds()
@@ -121,10 +215,17 @@ class Timetable:
 
         self.operators = operators
 
-        routes = list(routes.order_by("id").select_related("source"))
+        routes = list(
+            routes.order_by("id")
+            .select_related("source")
+            .annotate(service_modified_at=F("service__modified_at"))
+        )
         self.routes = self.current_routes = routes
         # self.current_routes is a subset of self.routes
 
+        # for telling whether a prebuilt layout is out of date
+        self.modified_at = {route.id: route.service_modified_at for route in routes}
+
         self.date = date
         self.detailed = detailed
 
@@ -204,12 +305,78 @@ class Timetable:
 
         if not self.calendar:
             if self.calendars:
-                calendar_ids = [calendar.id for calendar in self.calendars]
-                self.calendar_ids = list(
-                    get_calendars(self.date, calendar_ids).values_list("id", flat=True)
-                )
+                if self.today <= self.date <= four_weeks_time:
+                    # bank holidays in this range have already been fetched,
+                    # so there's no need to ask the database
+                    self.calendar_ids = [
+                        calendar.id
+                        for calendar in self.calendars
+                        if calendar.allows(self.date)
+                    ]
+                else:
+                    calendar_ids = [calendar.id for calendar in self.calendars]
+                    self.calendar_ids = list(
+                        get_calendars(self.date, calendar_ids).values_list(
+                            "id", flat=True
+                        )
+                    )
+
+    def get_date_key(self, date) -> tuple | None:
+        """What a Timetable of the same routes for another `date` would depend on
+        (its calendars, and which routes are current - see get_routes),
+        without asking the database. None if that can't be done
+        """
+        if len(self.routes) != len(self.modified_at):
+            return  # expired routes have been ignored
+        if not self.today <= date <= self.today + datetime.timedelta(days=28):
+            return  # bank holidays haven't been fetched
+
+        prefixes = set()  # Passenger
+        for route in self.routes:
+            if route.source.settings:
+                for prefix, dates in route.source.settings.items():
+                    if (
+                        datetime.date.fromisoformat(dates[0])
+                        <= date
+                        < datetime.date.fromisoformat(dates[1])
+                    ):
+                        prefixes.add(prefix)
+
+        return (
+            tuple(calendar.id for calendar in self.calendars if calendar.allows(date)),
+            tuple(
+                route.id
+                for route in self.routes
+                if not route.start_date or route.start_date <= date
+            ),
+            tuple(route.id for route in self.routes if route.contains(date)),
+            tuple(sorted(prefixes)),
+        )
+
+    def get_layout_key(self) -> str:
+        key = ["timetable-layout"]
+        for route in self.current_routes:
+            modified_at = self.modified_at[route.id]
+            key.append(f"{route.id}:{modified_at and modified_at.timestamp()}")
+
+        # same as the filtering of trips in render()
+        if not self.calendar:
+            if self.calendars:
+                key.append("dates")
+                key += [str(calendar_id) for calendar_id in self.calendar_ids]
+            else:
+                key.append("none")
+        elif self.calendar_options:
+            key.append(f"calendar:{self.calendar.id}")
+        else:
+            key.append("all")
 
-    def render(self):
+        return ":".join(key)
+
+    def render(self, save_layout=False):
+        """save_layout: store the grid (which rows each trip has times at, and the order
+        of trips), for later renders of the same trips to reuse (see Grouping.get_layout)
+        """
         trips = Trip.objects.filter(route__in=self.current_routes)
         if not self.calendar:
             if self.calendars:
@@ -222,13 +389,6 @@ class Timetable:
             trips = trips.filter(calendar=self.calendar)
 
         trips = trips.prefetch_related(
-            Prefetch(
-                "stoptime_set",
-                queryset=StopTime.objects.annotate(note_ids=ArrayAgg("notes"))
-                .filter(Q(pick_up=True) | Q(set_down=True))
-                .order_by("trip_id", "id"),
-                to_attr="times",
-            ),
             Prefetch(
                 "notes", queryset=Note.objects.annotate(stoptimes=Exists("stoptime"))
             ),
@@ -241,6 +401,20 @@ class Timetable:
             self.date = None
             return
 
+        # plain tuples rather than StopTime model instances, there can be lots
+        stop_times = (
+            StopTime.objects.filter(trip__in=[trip.id for trip in trips])
+            .filter(Q(pick_up=True) | Q(set_down=True))
+            .annotate(note_ids=ArrayAgg("notes"))
+            .order_by("trip_id", "id")
+            .values_list(*TimetableStopTime.fields)
+        )
+        times = {trip.id: [] for trip in trips}
+        for values in stop_times:
+            times[values[0]].append(TimetableStopTime(*values))
+        for trip in trips:
+            trip.times = times[trip.id]
+
         if len(self.current_routes) > 1 and self.has_operators:
             # merged services: correct mismatched inbound/outbound direction
             inbound_dests = {
@@ -278,21 +452,36 @@ class Timetable:
 
         del trips
 
-        for grouping in self.groupings:
+        layouts = None
+        if not self.detailed:
+            layout_key = self.get_layout_key()
+            if save_layout:
+                new_layouts = []
+            else:
+                layouts = cache.get(layout_key)
+
+        for i, grouping in enumerate(self.groupings):
             if not self.detailed:
                 grouping.trips.sort(key=lambda t: t.start)
                 grouping.merge_split_trips()
 
-            grouping.sort_rows()
+            if not (layouts and grouping.apply_layout(layouts[i])):
+                grouping.sort_rows()
 
-            # build the table
-            for trip in grouping.trips:
-                grouping.handle_trip(trip)
+                # build the table
+                for trip in grouping.trips:
+                    grouping.handle_trip(trip)
 
-            grouping.sort_columns()
+                grouping.sort_columns()
+
+                if save_layout and not self.detailed:
+                    new_layouts.append(grouping.get_layout())
 
             grouping.do_heads_and_feet(self.detailed)
 
+        if save_layout and not self.detailed:
+            cache.set(layout_key, new_layouts, 86400 * 28)
+
         (
             self.inbound_outbound_descriptions,
             self.origins_and_destinations,
@@ -448,14 +637,19 @@ class Timetable:
                     self.date = date
                 date = end_date - datetime.timedelta(days=7)
 
+        # which days any of the calendars run on
+        runs_on = 0
+        days = (end_date - date).days + 1
+        if days > 0:
+            for calendar in self.calendars:
+                runs_on |= calendar.get_runs_on(date, days)
+
         if self.date and self.date < date:
             yield self.date
         while date <= end_date:
-            if (
-                any(calendar.allows(date) for calendar in self.calendars)
-                or date == self.date
-            ):
+            if runs_on & 1 or date == self.date:
                 yield date
+            runs_on >>= 1
             date += datetime.timedelta(days=1)
         if self.date and self.date >= date:
             yield self.date
@@ -570,7 +764,7 @@ class Grouping:
     def txt(self):
         width = max(len(str(row.stop)) for row in self.rows)
         return "\n".join(
-            f'{str(row.stop):<{width}}  {"  ".join(str(time) or "     " for time in row.times)}'
+            f"{str(row.stop):<{width}}  {'  '.join(str(time) or '     ' for time in row.times)}"
             for row in self.rows
         )
 
@@ -672,54 +866,126 @@ class Grouping:
                 for key in sorter.static_order()
             ]
         except graphlib.CycleError:
-            # cycle detected, so we will use difflib later
+            # cycle detected, so rows will be added by handle_trip instead
             # longest trips first, to minimise duplicate rows
             self.trips.sort(key=lambda t: -len(t.times))
         else:
             for row in self.rows:
                 row.timing_status = stop_times[row.stop.stop_code].timing_status
 
+        self.merger = SequenceMerger(row.stop.stop_code for row in self.rows)
+
     def sort_columns(self):
         rows = self.rows
+        trips = self.trips
+        n = len(trips)
+        if not n:
+            return
 
-        sorter = graphlib.TopologicalSorter()
-        for a_index, a in enumerate(self.trips):
-            a_top = rows.index(a.top)
-            a_bottom = rows.index(a.bottom)
-
-            for b_index, b in enumerate(self.trips):
-                if a_index == b_index:
-                    continue
+        row_indices = {row: y for y, row in enumerate(rows)}
+        tops = np.array([row_indices[trip.top] for trip in trips], dtype=np.int32)
+        bottoms = np.array([row_indices[trip.bottom] for trip in trips], dtype=np.int32)
+
+        has_time = np.array([[bool(cell) for cell in row.times] for row in rows])
+        seconds = np.array(
+            [
+                [
+                    cell.departure_or_arrival().total_seconds() if cell else 0
+                    for cell in row.times
+                ]
+                for row in rows
+            ]
+        )
 
-                b_top = rows.index(b.top)
-                b_bottom = rows.index(b.bottom)
-
-                for row in rows[max(a_top, b_top) : min(a_bottom, b_bottom) + 1]:
-                    if row.times[a_index] and row.times[b_index]:
-                        a_time = row.times[a_index].departure_or_arrival()
-                        b_time = row.times[b_index].departure_or_arrival()
-                        if a_time > b_time:  # a after b
-                            sorter.add(a.id, b.id)
-                        elif a_time < b_time:  # a before b
-                            sorter.add(b.id, a.id)
-                        elif b.top is a.bottom:
-                            sorter.add(b.id, a.id)
-                        break
+        # compare each pair of trips at the first row where they both have a time:
+        # order[a, b] is 1 if trip a is after trip b, -1 if before, 0 if the same time
+        order = np.zeros((n, n), dtype=np.int8)
+        shared = np.zeros((n, n), dtype=bool)
+        # 64 rows at a time, as a bitmask of which rows each trip has a time at
+        for start in range(0, len(rows), 64):
+            chunk = has_time[start : start + 64].astype(np.uint64)
+            bits = np.bitwise_or.reduce(
+                chunk << np.arange(len(chunk), dtype=np.uint64)[:, None], axis=0
+            )
+            common = bits[:, None] & bits[None, :]
+            a, b = np.nonzero((common != 0) & ~shared)
+            common = common[a, b]
+            # lowest bit set = first row in common
+            y = (
+                start
+                + np.frexp((common & (~common + np.uint64(1))).astype(float))[1]
+                - 1
+            )
+            order[a, b] = np.sign(seconds[y, a] - seconds[y, b])
+            shared[a, b] = True
+        np.fill_diagonal(shared, False)
+
+        # trips with the same time at the end of one and the start of the other
+        ties = shared & (order == 0) & (bottoms[:, None] == tops[None, :])
+
+        indices = get_column_order(order, ties)
+        if indices is None:
+            indices = sorted(
+                range(n),
+                key=cmp_to_key(
+                    partial(compare_trips, trips, order, shared, tops, bottoms)
+                ),
+            )
 
-        trip_ids = [trip.id for trip in self.trips]
-        try:
-            indices = [trip_ids.index(trip_id) for trip_id in sorter.static_order()]
-            assert len(trip_ids) == len(indices)
-            self.trips = [self.trips[i] for i in indices]
-        except (graphlib.CycleError, AssertionError):
-            self.trips.sort(key=cmp_to_key(partial(compare_trips, self.rows, trip_ids)))
-            new_trip_ids = [trip.id for trip in self.trips]
-            indices = [trip_ids.index(trip_id) for trip_id in new_trip_ids]
+        self.trips = [trips[i] for i in indices]
 
         for row in rows:
             # reassemble in order
             row.times = [row.times[i] for i in indices]
 
+    def get_layout(self) -> tuple:
+        """The rows, the order of trips, and which rows each trip has times at -
+        everything handle_trip and sort_columns work out
+        """
+        rows = [
+            (row.stop.atco_code, row.stop.stop_code, row.timing_status)
+            for row in self.rows
+        ]
+        trip_ids = [trip.id for trip in self.trips]
+        positions = [
+            [y for y, row in enumerate(self.rows) if row.times[x]]
+            for x in range(len(self.trips))
+        ]
+        return rows, trip_ids, positions
+
+    def apply_layout(self, layout) -> bool:
+        """Build the table from a layout made earlier by get_layout,
+        if it's for the same trips, instead of working it out again
+        """
+        rows, trip_ids, positions = layout
+
+        trips = {trip.id: trip for trip in self.trips}
+        if len(trip_ids) != len(self.trips) or trips.keys() != set(trip_ids):
+            return False
+        trips = [trips[trip_id] for trip_id in trip_ids]
+        if any(len(trip.times) != len(ys) for trip, ys in zip(trips, positions)):
+            return False
+
+        self.rows = []
+        for stop_id, stop_code, timing_status in rows:
+            row = Row(Stop(stop_id, stop_code), [""] * len(trips))
+            row.timing_status = timing_status
+            self.rows.append(row)
+
+        for x, (trip, ys) in enumerate(zip(trips, positions)):
+            for stoptime, y in zip(trip.times, ys):
+                self.rows[y].times[x] = Cell(
+                    stoptime, stoptime.arrival, stoptime.departure
+                )
+            if ys:
+                trip.top = self.rows[ys[0]]
+                trip.top.times[x].first = True
+                trip.bottom = self.rows[ys[-1]]
+                trip.bottom.times[x].last = True
+
+        self.trips = trips
+        return True
+
     def merge_split_trips(self):
         zero = datetime.timedelta()
         fifteen = datetime.timedelta(minutes=15)
@@ -782,63 +1048,24 @@ class Grouping:
             x = len(rows[0].times)  # number of existing columns
         else:
             x = 0
-        previous_list = [row.stop.stop_code for row in rows]
-        current_list = [stoptime.get_key() for stoptime in trip.times]
-        if current_list == previous_list:
-            diff = None
-        else:
-            diff = differ.compare(previous_list, current_list)
-
-        y = 0  # how many rows along we are
-        first = True
-
-        for stoptime in trip.times:
-            key = stoptime.get_key()
-
-            if y < len(rows):
-                existing_row = rows[y]
-            else:
-                existing_row = None
-
-            if diff:
-                instruction = next(diff)
 
-                while instruction[0] in "-?":
-                    if instruction[0] == "-":
-                        y += 1
-                        if y < len(rows):
-                            existing_row = rows[y]
-                        else:
-                            existing_row = None
-                    instruction = next(diff)
-
-                assert instruction[2:] == key
-
-                if instruction[0] == "+":
-                    row = Row(Stop(stoptime.stop_id, stoptime.stop_code), [""] * x)
-                    row.timing_status = stoptime.timing_status
-                    if not existing_row:
-                        rows.append(row)
-                    else:
-                        rows = self.rows = rows[:y] + [row] + rows[y:]
-                else:
-                    row = existing_row
-                    assert instruction[2:] == existing_row.stop.stop_code
-            else:
-                row = existing_row
-
-            cell = Cell(stoptime, stoptime.arrival, stoptime.departure)
-            if first:
-                cell.first = True
-                trip.top = row
-                first = False
-            row.times.append(cell)
+        positions, inserted = self.merger.merge(
+            [stoptime.get_key() for stoptime in trip.times]
+        )
+        for i in inserted:
+            stoptime = trip.times[i]
+            row = Row(Stop(stoptime.stop_id, stoptime.stop_code), [""] * x)
+            row.timing_status = stoptime.timing_status
+            rows.insert(positions[i], row)
 
-            y += 1
+        for stoptime, y in zip(trip.times, positions):
+            rows[y].times.append(Cell(stoptime, stoptime.arrival, stoptime.departure))
 
-        if not first:  # (there was at least 1 stoptime in the trip)
-            cell.last = True
-            trip.bottom = row
+        if positions:  # (there was at least 1 stoptime in the trip)
+            trip.top = rows[positions[0]]
+            trip.top.times[-1].first = True
+            trip.bottom = rows[positions[-1]]
+            trip.bottom.times[-1].last = True
 
         for row in rows:
             if len(row.times) == x:
@@ -1009,6 +1236,51 @@ class Stop:
         return self.stop_code or self.atco_code
 
 
+class TimetableStopTime:
+    """The parts of a StopTime needed for a timetable"""
+
+    __slots__ = (
+        "trip_id",
+        "stop_id",
+        "stop_code",
+        "arrival",
+        "departure",
+        "timing_status",
+        "pick_up",
+        "set_down",
+        "note_ids",
+        "note",
+    )
+    fields = __slots__[:-1]
+
+    def __init__(
+        self,
+        trip_id,
+        stop_id,
+        stop_code,
+        arrival,
+        departure,
+        timing_status,
+        pick_up,
+        set_down,
+        note_ids,
+    ):
+        self.trip_id = trip_id
+        self.stop_id = stop_id
+        self.stop_code = stop_code
+        self.arrival = arrival
+        self.departure = departure
+        self.timing_status = timing_status
+        self.pick_up = pick_up
+        self.set_down = set_down
+        self.note_ids = note_ids
+        self.note = None
+
+    get_key = StopTime.get_key
+    departure_or_arrival = StopTime.departure_or_arrival
+    is_minor = StopTime.is_minor
+
+
 class Cell:
     def __init__(self, stoptime, arrival, departure):
         self.first = False
@@ -1,16 +1,17 @@
 import logging
 from datetime import date, datetime, timedelta
 from difflib import Differ
+from time import monotonic
 
+import numpy as np
 from ciso8601 import parse_datetime
+from django.db import connection
 from django.db.models import (
-    Case,
     DateTimeField,
     ExpressionWrapper,
     F,
     Q,
     Value,
-    When,
     OuterRef,
 )
 from django.utils import timezone
@@ -33,6 +34,81 @@ class log_time_taken:
         self.logger.info(f"  ⏱️ {datetime.now() - self.start}")
 
 
+def allocate_ids(model, objects: list):
+    """Give some unsaved objects ids from the table's sequence,
+    so that other objects can refer to them before they're saved
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [model._meta.db_table, model._meta.pk.column, len(objects)],
+        )
+        for obj, (pk,) in zip(objects, cursor.fetchall()):
+            obj.pk = pk
+
+
+def bulk_copy(model, objects: list):
+    """Like model.objects.bulk_create(objects), including setting the objects' ids,
+    but using COPY, which is much quicker for lots of rows (like StopTimes)
+    """
+    if not objects:
+        return
+
+    new_objects = [obj for obj in objects if obj.pk is None]
+    if new_objects:
+        allocate_ids(model, new_objects)
+
+    fields = model._meta.concrete_fields
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+
+    with (
+        connection.cursor() as cursor,
+        cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy,
+    ):
+        for obj in objects:
+            # set foreign key ids from related objects saved since (like bulk_create)
+            obj._prepare_related_fields_for_save(operation_name="bulk_copy")
+            copy.write_row(
+                [
+                    field.get_db_prep_save(field.pre_save(obj, True), connection)
+                    for field in fields
+                ]
+            )
+            obj._state.adding = False
+            obj._state.db = connection.alias
+
+
+def copy_dataframe(model, dataframe, chunk_size=100_000):
+    """Like bulk_copy, but for rows in a pandas DataFrame (with columns named after
+    the model's database columns), so no model instances are created at all.
+    Ids are left to the database
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    columns = ", ".join(quote_name(column) for column in dataframe.columns)
+    options = "FORMAT csv"
+    # empty strings in NOT NULL columns (like stop_code) are empty strings, not nulls
+    not_null = [
+        quote_name(field.column)
+        for field in model._meta.concrete_fields
+        if not field.null and field.column in dataframe.columns
+    ]
+    if not_null:
+        options += f", FORCE_NOT_NULL ({', '.join(not_null)})"
+
+    with (
+        connection.cursor() as cursor,
+        cursor.copy(f"COPY {table} ({columns}) FROM STDIN ({options})") as copy,
+    ):
+        for start in range(0, len(dataframe), chunk_size):
+            copy.write(
+                dataframe.iloc[start : start + chunk_size].to_csv(
+                    header=False, index=False
+                )
+            )
+
+
 def get_routes(routes, when=None, from_date=None):
     if when:
         if type(routes) is list:
@@ -128,6 +204,10 @@ def get_routes(routes, when=None, from_date=None):
 
 
 def get_calendars(when: date | datetime, calendar_ids=None):
+    """Calendars that run on a date, worked out in SQL - for stop departures, trip
+    tables, and timetables for dates more than four weeks away. (Otherwise Timetable
+    uses Calendar.get_runs_on bitmaps, built from rows it has already loaded)
+    """
     between_dates = Q(start_date__lte=when) & (Q(end_date__gte=when) | Q(end_date=None))
 
     calendars = Calendar.objects.filter(between_dates)
@@ -259,6 +339,104 @@ def get_descriptions(routes):
     return inbound_outbound_descriptions, origins_and_destinations
 
 
+class TripTable:
+    """A service's trips on a date, as compact arrays,
+    so get_trip can score them without a database query each time
+    """
+
+    fields = [
+        field.attname
+        for field in Trip._meta.concrete_fields
+        if field.name
+        in (
+            "id",
+            "route",
+            "inbound",
+            "vehicle_journey_code",
+            "ticket_machine_code",
+            "block",
+            "destination",
+            "calendar",
+            "start",
+            "end",
+            "garage",
+            "operator",
+        )
+    ]
+
+    def __init__(self, trips, date):
+        self.date = date
+        self.created_at = monotonic()
+        self.running_calendar_ids = None
+
+        self.rows = list(trips.values_list(*self.fields).order_by("id"))
+        columns = dict(zip(self.fields, zip(*self.rows)))
+
+        def column(name, default, dtype):
+            values = columns.get(name, ())
+            return np.array(
+                [default if value is None else value for value in values], dtype=dtype
+            )
+
+        self.ids = column("id", 0, np.int64)
+        self.inbound = column("inbound", False, bool)
+        self.vehicle_journey_codes = column("vehicle_journey_code", "", str)
+        self.ticket_machine_codes = column("ticket_machine_code", "", str)
+        self.blocks = column("block", "", str)
+        self.destinations = column("destination_id", "", str)
+        self.calendars = column("calendar_id", 0, np.int64)
+        self.starts = np.array(
+            [value.total_seconds() for value in columns.get("start", ())],
+            dtype=np.int32,
+        )
+        self.ends = np.array(
+            [value.total_seconds() for value in columns.get("end", ())],
+            dtype=np.int32,
+        )
+
+    def get_trip(self, i):
+        return Trip.from_db("default", self.fields, self.rows[i])
+
+    def get_running_calendar_ids(self):
+        if self.running_calendar_ids is None:
+            calendar_ids = {int(calendar_id) for calendar_id in self.calendars}
+            calendar_ids.discard(0)
+            self.running_calendar_ids = np.array(
+                get_calendars(self.date, calendar_ids).values_list("id", flat=True),
+                dtype=np.int64,
+            )
+        return self.running_calendar_ids
+
+
+def get_trip_table(service, date, trip_tables=None):
+    """trip_tables is an optional dict, for a long-running process (e.g. a live
+    vehicle locations importer) to keep tables in, to reuse for up to 10 minutes
+    (or until the service's timetable is re-imported, updating its modified_at)
+    """
+    if trip_tables is not None:
+        key = (service.id, service.modified_at, date)
+        table = trip_tables.get(key)
+        now = monotonic()
+        if table and now - table.created_at < 600:
+            return table
+
+        # forget old tables
+        for other_key, other_table in list(trip_tables.items()):
+            if now - other_table.created_at >= 600:
+                del trip_tables[other_key]
+
+    routes = get_routes(service.route_set.select_related("source"), date)
+    if routes:
+        trips = Trip.objects.filter(route__in=routes)
+    else:
+        trips = Trip.objects.filter(route__service=service)
+
+    table = TripTable(trips, date)
+    if trip_tables is not None:
+        trip_tables[key] = table
+    return table
+
+
 def get_trip(
     journey,
     datetime=None,
@@ -270,6 +448,7 @@ def get_trip(
     arrival_time=None,
     journey_code="",
     block_ref=None,
+    trip_tables=None,
 ):
     if not journey.service:
         return
@@ -279,58 +458,53 @@ def get_trip(
     if not date:
         date = (departure_time or datetime).date()
 
-    routes = get_routes(journey.service.route_set.select_related("source"), date)
-    if routes:
-        trips = Trip.objects.filter(route__in=routes)
-    else:
-        trips = Trip.objects.filter(route__service=journey.service)
+    table = get_trip_table(journey.service, date, trip_tables)
 
     if destination_ref and " " not in destination_ref and destination_ref[:3].isdigit():
-        destination = Q(destination=destination_ref)
+        destination = table.destinations == destination_ref
     else:
-        destination = Q()
+        destination = None
 
     if journey.direction == "outbound":
-        direction = Q(inbound=False)
+        direction = ~table.inbound
     elif journey.direction == "inbound":
-        direction = Q(inbound=True)
+        direction = table.inbound
     else:
-        direction = Q()
+        direction = None
 
     if departure_time:
         start_time = timezone.localtime(departure_time)
-        start = Q(start=timedelta(hours=start_time.hour, minutes=start_time.minute))
+        start_seconds = start_time.hour * 3600 + start_time.minute * 60
+        start = table.starts == start_seconds
         if start_time.hour < 6:
-            start |= Q(
-                start=timedelta(
-                    days=1, hours=start_time.hour, minutes=start_time.minute
-                )
-            )
+            start |= table.starts == start_seconds + 86400
     elif len(journey_code) == 4 and journey_code.isdigit() and int(journey_code) < 2400:
         hours = int(journey_code[:-2])
         minutes = int(journey_code[-2:])
-        start = Q(start=timedelta(hours=hours, minutes=minutes))
+        start = table.starts == hours * 3600 + minutes * 60
     else:
-        start = Q()
+        start = None
 
     if arrival_time:
         arrival_time = timezone.localtime(arrival_time)
-        end = Q(end=timedelta(hours=arrival_time.hour, minutes=arrival_time.minute))
+        end_seconds = arrival_time.hour * 3600 + arrival_time.minute * 60
+        end = table.ends == end_seconds
         if arrival_time.hour < 6:
-            end |= Q(
-                end=timedelta(
-                    days=1, hours=arrival_time.hour, minutes=arrival_time.minute
-                )
-            )
+            end |= table.ends == end_seconds + 86400
 
     # special strategy for TfL data
-    if operator_ref == "TFLO" and departure_time and origin_ref and destination:
+    if (
+        operator_ref == "TFLO"
+        and departure_time
+        and origin_ref
+        and destination is not None
+    ):
+        trips = Trip.objects.filter(id__in=table.ids[start].tolist())
         try:
             try:
                 trips = trips.filter(
                     Exists("stoptime", filter=Q(stop=origin_ref)),
                     Exists("stoptime", filter=Q(stop=destination_ref)),
-                    start,
                 )
                 return trips.get()
             except Trip.MultipleObjectsReturned:
@@ -340,39 +514,56 @@ def get_trip(
             return
 
     if journey.code:
-        code = Q(ticket_machine_code=journey.code) | Q(
-            vehicle_journey_code=journey.code
+        code = (table.ticket_machine_codes == journey.code) | (
+            table.vehicle_journey_codes == journey.code
         )
     else:
-        code = Q()
+        code = None
 
     if operator_ref == "NT" and len(journey_code) > 30:
-        code = Q()
+        code = None
 
-    score = 0
-    if code:
-        score += Case(When(code, then=1), default=0)
+    score = np.zeros(len(table.ids), dtype=np.int8)
+    if code is not None:
+        score += code
     if block_ref:
-        score += Case(When(block=block_ref, then=1), default=0)
-    if start:
-        score += Case(When(start, then=1), default=0)
+        score += table.blocks == block_ref
+    if start is not None:
+        score += start
     if arrival_time:
-        score += Case(When(end, then=1), default=0)
-    if direction:
-        score += Case(When(direction, then=1), default=0)
-    if destination:
-        score += Case(When(destination, then=1), default=0)
-
-    condition = code | start
-    if direction:
-        condition &= destination | direction
+        score += end
+    if direction is not None:
+        score += direction
+    if destination is not None:
+        score += destination
+
+    # (like combining Q objects, where an empty Q() doesn't filter anything)
+    def either(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a | b
+
+    condition = either(code, start)
+    if direction is not None:
+        direction = either(destination, direction)
+        condition = direction if condition is None else condition & direction
+
+    if condition is None:
+        indices = np.arange(len(table.ids))
+    else:
+        indices = np.flatnonzero(condition)
 
-    trips = trips.filter(condition).annotate(score=score).order_by("-score")
+    # highest score first (then lowest id)
+    indices = indices[np.argsort(-score[indices], kind="stable")]
 
-    if trips:
-        if len(trips) > 1 and trips[0].score == trips[1].score:
-            filtered_trips = trips.filter(calendar__in=get_calendars(date))
-            if filtered_trips:
-                trips = filtered_trips
+    if len(indices):
+        if len(indices) > 1 and score[indices[0]] == score[indices[1]]:
+            filtered_indices = indices[
+                np.isin(table.calendars[indices], table.get_running_calendar_ids())
+            ]
+            if len(filtered_indices):
+                indices = filtered_indices
 
-        return trips[0]
+        return table.get_trip(indices[0])
@@ -317,7 +317,7 @@ def stop_times_json(request, atco_code):
     # any journeys that started yesterday
     yesterday_date = (when - timedelta(1)).date()
     yesterday_time = time_since_midnight + timedelta(1)
-    stop_times = departures.get_times(yesterday_date, yesterday_time)
+    stop_times = departures.get_times(yesterday_date, yesterday_time, limit=limit)
 
     for stop_time in stop_times.select_related(
         "trip__destination__locality", "trip__route__service", "trip__operator"
@@ -333,7 +333,7 @@ def stop_times_json(request, atco_code):
         )[:limit]:
             times.append(stop_time_json(stop_time, when.date()))
 
-    stop_times = departures.get_times(when.date(), time_since_midnight)
+    stop_times = departures.get_times(when.date(), time_since_midnight, limit=limit)
     for stop_time in stop_times.select_related(
         "trip__destination__locality", "trip__route__service", "trip__operator"
     )[:limit]:
@@ -0,0 +1,81 @@
+"""Departure boards: each stop's timetabled departures on a date, worked out once and
+kept in Redis as a compact array sorted by departure time, so that a stop page only
+needs to look up the next few stop times by id
+"""
+
+import hashlib
+
+import numpy as np
+from redis.exceptions import ConnectionError, TimeoutError
+
+from bustimes.models import StopTime
+from bustimes.utils import get_stop_times
+from vehicles.utils import redis_client
+
+board_dtype = np.dtype([("departure", "<i4"), ("id", "<i8")])
+
+
+def get_board_key(stop, date, services) -> str:
+    # re-importing a service's timetable updates its modified_at,
+    # so a board is never used after the stop times in it have changed
+    services_version = hashlib.md5(
+        ",".join(
+            sorted(
+                f"{service.id}:{service.modified_at and service.modified_at.timestamp()}"
+                for service in services
+                if not service.timetable_wrong
+            )
+        ).encode()
+    ).hexdigest()
+    return f"departures:{stop._meta.model_name}:{stop.pk}:{date}:{services_version}"
+
+
+def get_board(stop, date, routes, services, rebuild=False):
+    key = get_board_key(stop, date, services)
+
+    if not rebuild:
+        board = redis_client.get(key)
+        if board is not None:
+            return np.frombuffer(board, dtype=board_dtype)
+
+    stop_times = (
+        get_stop_times(date, None, stop, routes)
+        .order_by("departure", "id")
+        .values_list("departure", "id")
+    )
+    board = np.array(
+        [
+            (departure.total_seconds(), stop_time_id)
+            for departure, stop_time_id in stop_times
+        ],
+        dtype=board_dtype,
+    )
+    redis_client.set(key, board.tobytes(), ex=172800)  # 48 hours
+    return board
+
+
+def get_stop_time_ids(stop, date, time, routes, services, limit=None):
+    """The ids of up to `limit` stop times at `stop` on `date`, departing at or after
+    `time` – or None if there's no Redis to keep departure boards in (or it's down)
+    """
+    if not redis_client:
+        return
+
+    def get_ids(board):
+        start = np.searchsorted(board["departure"], time.total_seconds())
+        end = None if limit is None else start + limit
+        return board["id"][start:end].tolist()
+
+    try:
+        board = get_board(stop, date, routes, services)
+        stop_time_ids = get_ids(board)
+        if stop_time_ids:
+            count = StopTime.objects.filter(id__in=stop_time_ids).count()
+            if count < len(stop_time_ids):
+                # some of the stop times have been deleted by a timetable import
+                # (which hasn't finished yet, so hasn't updated modified_at)
+                board = get_board(stop, date, routes, services, rebuild=True)
+                stop_time_ids = get_ids(board)
+    except (ConnectionError, TimeoutError):
+        return
+    return stop_time_ids
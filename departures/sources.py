@@ -9,12 +9,16 @@ import requests
 import xmltodict
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Value
 from django.db.models.functions import Coalesce
 from django.utils import timezone
 
+from bustimes.models import StopTime
 from bustimes.utils import get_stop_times
 from vehicles.models import Vehicle
 
+from . import boards
+
 
 TIMEZONE = ZoneInfo("Europe/London")
 
@@ -271,10 +275,22 @@ class TimetableDepartures(Departures):
             "stop_time": stop_time,
         }
 
-    def get_times(self, date, time=None, trips=None):
+    def get_times(self, date, time=None, trips=None, limit=None):
+        stop_time_ids = None
+        if time is not None and not trips:
+            stop_time_ids = boards.get_stop_time_ids(
+                self.stop, date, time, self.routes, self.services, limit
+            )
+
+        if stop_time_ids is not None:
+            times = StopTime.objects.filter(id__in=stop_time_ids).annotate(
+                date=Value(date)
+            )
+        else:
+            times = get_stop_times(date, time, self.stop, self.routes, trips)
+
         return (
-            get_stop_times(date, time, self.stop, self.routes, trips)
-            .select_related("trip")
+            times.select_related("trip")
             .annotate(
                 destination=Coalesce(
                     "trip__destination__locality__name",
@@ -293,9 +309,10 @@ class TimetableDepartures(Departures):
         yesterday_date = (self.now - one_day).date()
         yesterday_time = time_since_midnight + one_day
 
-        all_today_times = self.get_times(yesterday_date, yesterday_time).union(
-            self.get_times(date, time_since_midnight), all=True
-        )
+        limit = self.per_page + 8
+        all_today_times = self.get_times(
+            yesterday_date, yesterday_time, limit=limit
+        ).union(self.get_times(date, time_since_midnight, limit=limit), all=True)
         today_times = list(all_today_times[: self.per_page])
 
         if self.trips:
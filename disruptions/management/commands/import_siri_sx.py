@@ -1,6 +1,5 @@
 import io
 import logging
-import xml.etree.cElementTree as ET
 import zipfile
 
 import requests
@@ -10,6 +9,7 @@ from django.db.backends.postgresql.psycopg_any import DateTimeTZRange
 from django.db.models import Q
 
 from busstops.models import DataSource, Operator, Service, StopPoint
+from transxchange.parser import iterparse, tostring
 
 from ...models import Consequence, Link, Situation, ValidityPeriod
 
@@ -34,7 +34,7 @@ def handle_item(item, source):
 
     item.find("Source/TimeOfCommunication").text = None
 
-    xml = ET.tostring(item, encoding="unicode")
+    xml = tostring(item)
 
     created_time = parse_datetime(item.find("CreationTime").text)
 
@@ -103,7 +103,7 @@ def handle_item(item, source):
                 pass
 
         consequence.text = consequence_element.find("Advice/Details").text
-        consequence.data = ET.tostring(consequence_element, encoding="unicode")
+        consequence.data = tostring(consequence_element)
         consequence.save()
 
         stops = consequence_element.findall("Affects/StopPoints/AffectedStopPoint")
@@ -166,13 +166,11 @@ class Command(BaseCommand):
         assert len(namelist) == 1
         open_file = archive.open(namelist[0])
 
-        for _, element in ET.iterparse(open_file):
-            if element.tag[:29] == "{http://www.siri.org.uk/siri}":
-                element.tag = element.tag[29:]
-
-            if element.tag.endswith("PtSituationElement"):
-                situations.append(handle_item(element, source))
-                element.clear()
+        for _, element in iterparse(
+            open_file, "http://www.siri.org.uk/siri", ("PtSituationElement",)
+        ):
+            situations.append(handle_item(element, source))
+            element.clear()
 
         source.situation_set.filter(current=True).exclude(id__in=situations).update(
             current=False
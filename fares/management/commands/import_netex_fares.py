@@ -1,6 +1,5 @@
 import io
 import logging
-import xml.etree.cElementTree as ET
 import zipfile
 from datetime import datetime, timezone
 from functools import cache
@@ -16,6 +15,7 @@ from sql_util.utils import Exists
 
 from busstops.models import Operator, Service
 from bustimes.utils import log_time_taken
+from transxchange.parser import ParseError, iterparse
 
 from ... import models
 
@@ -115,17 +115,16 @@ class Command(BaseCommand):
     base_url = "https://data.bus-data.dft.gov.uk"
 
     def handle_file(self, source, open_file, filename=None):
-        iterator = ET.iterparse(open_file)
+        # remove NeTEx namespace for simplicity's sake:
+        iterator = iterparse(open_file, "http://www.netex.org.uk/netex")
 
         if not filename:
             filename = open_file.name
 
         try:
             for _, element in iterator:
-                # remove NeTEx namespace for simplicity's sake:
-                if element.tag[:31] == "{http://www.netex.org.uk/netex}":
-                    element.tag = element.tag[31:]
-        except ET.ParseError as e:
+                pass
+        except ParseError as e:
             logger.exception(e)
             return
 
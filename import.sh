@@ -47,12 +47,12 @@ cd ../..
 
 if [[ $ncsd_old != $ncsd_new ]]; then
     echo 'NCSD.zip'
-    ./manage.py import_transxchange data/TNDS/NCSD.zip
+    ./manage.py import_transxchange --workers "$(nproc)" data/TNDS/NCSD.zip
 fi
 
 if [[ $tfl_old != $tfl_new ]]; then
     echo 'L.zip'
-    ./manage.py import_transxchange data/TNDS/L.zip
+    ./manage.py import_transxchange --workers "$(nproc)" data/TNDS/L.zip
 fi
 
 
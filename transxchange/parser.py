@@ -0,0 +1,79 @@
+"""Streaming XML parsing for the big TransXChange, NaPTAN, NeTEx and SIRI files we import.
+
+Element tags have the document's namespace removed, so that elements can be found
+with plain paths like element.findtext("StopPointRef").
+
+The standard library's parser is used by default. lxml's iterparse does less work in
+Python, but reading lxml elements from Python is slower, so for the way we use them
+it's been slower overall - see the benchmark_xml command. With use_lxml=True, the
+standard library's parser is still used if lxml isn't installed or the file has been
+opened in text mode
+"""
+
+import io
+from copy import deepcopy
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+if etree:
+    ParseError = (ET.ParseError, etree.XMLSyntaxError)
+else:
+    ParseError = (ET.ParseError,)
+
+
+def tostring(element) -> str:
+    if etree and isinstance(element, etree._Element):
+        # a copy won't inherit the document's namespace declarations
+        return etree.tostring(deepcopy(element), encoding="unicode")
+    return ET.tostring(element, encoding="unicode")
+
+
+def iterparse(source, namespace: str, tags=None, events=("end",), use_lxml=False):
+    """Like ElementTree.iterparse, but with `namespace` removed from the tags of
+    elements (and their descendants) by the time their "end" event is yielded.
+
+    If `tags` (local names) is given, only events for elements with those tags are
+    yielded - with lxml, the others are skipped without any Python code running
+    """
+    prefix = f"{{{namespace}}}"
+    if use_lxml and etree and not isinstance(source, io.TextIOBase):
+        return _lxml_iterparse(source, prefix, tags, events)
+    return _stdlib_iterparse(source, prefix, tags, events)
+
+
+def _stdlib_iterparse(source, prefix, tags, events):
+    for event, element in ET.iterparse(source, events):
+        if event == "end":
+            element.tag = tag = element.tag.removeprefix(prefix)
+        else:
+            tag = element.tag.removeprefix(prefix)
+        if tags is None or tag in tags:
+            yield event, element
+
+
+def _lxml_iterparse(source, prefix, tags, events):
+    if tags is not None:
+        tags = [f"{{*}}{tag}" for tag in tags]
+    iterator = etree.iterparse(
+        source,
+        events,
+        tag=tags,
+        remove_comments=True,
+        remove_pis=True,
+        huge_tree=True,
+    )
+    start = len(prefix)
+    for event, element in iterator:
+        if event == "end":
+            if tags is None:
+                # descendants will already have been yielded
+                if element.tag[:start] == prefix:
+                    element.tag = element.tag[start:]
+            else:
+                for descendant in element.iter(f"{prefix}*"):
+                    descendant.tag = descendant.tag[start:]
+        yield event, element
@@ -2,8 +2,18 @@
 
 import xml.etree.cElementTree as ET
 from datetime import date
+from pathlib import Path
+
 from django.test import TestCase
-from . import txc
+from . import parser, txc
+
+FIXTURES_DIR = (
+    Path(__file__).resolve().parent.parent
+    / "bustimes"
+    / "management"
+    / "tests"
+    / "fixtures"
+)
 
 
 class DateRangeTest(TestCase):
@@ -68,3 +78,38 @@ class DateRangeTest(TestCase):
         )
         operating_profile = txc.OperatingProfile(element, None)
         self.assertEqual(str(operating_profile.regular_days), "[Saturday, Sunday]")
+
+
+class TransXChangeTest(TestCase):
+    def test_get_journeys(self):
+        with open(FIXTURES_DIR / "22A 22B 22C 08032021.xml", "rb") as open_file:
+            transxchange = txc.TransXChange(open_file)
+
+        self.assertEqual(len(transxchange.journeys), 114)
+        self.assertEqual(len(transxchange.get_journeys("SER22A", "SL1")), 69)
+        self.assertEqual(len(transxchange.get_journeys("SER22B", "SL2")), 43)
+        self.assertEqual(transxchange.get_journeys("SER22A", "SL2"), [])
+        self.assertEqual(transxchange.get_journeys("SER22D", "SL1"), [])
+        self.assertEqual(len(list(transxchange.get_service_journeys("SER22C"))), 2)
+
+    def test_lxml(self):
+        if not parser.etree:
+            self.skipTest("lxml isn't installed")
+
+        path = FIXTURES_DIR / "22A 22B 22C 08032021.xml"
+        with open(path, "rb") as open_file:
+            transxchange = txc.TransXChange(open_file, use_lxml=True)
+        self.assertEqual(len(transxchange.journeys), 114)
+        self.assertEqual(len(transxchange.get_journeys("SER22A", "SL1")), 69)
+        self.assertEqual(transxchange.attributes["RevisionNumber"], "1")
+
+        # text mode - falls back to the standard library
+        with open(path) as open_file:
+            iterator = parser.iterparse(
+                open_file,
+                "http://www.transxchange.org.uk/",
+                ("AnnotatedStopPointRef", "TransXChange"),
+                use_lxml=True,
+            )
+            tags = [element.tag for _, element in iterator]
+        self.assertEqual(tags, ["AnnotatedStopPointRef"] * 129 + ["TransXChange"])
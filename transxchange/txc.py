@@ -1,11 +1,12 @@
 import calendar
 import datetime
 import logging
-import xml.etree.cElementTree as ET
 
 from django.contrib.gis.geos import GEOSGeometry, LineString
 from django.utils.dateparse import parse_duration
 
+from .parser import iterparse, tostring
+
 logger = logging.getLogger(__name__)
 
 
@@ -425,7 +426,7 @@ class ServicedOrganisation:
         holidays = element.findall("Holidays/DateRange")
         self.holidays = [DateRange(e) for e in holidays if len(e)]
 
-        self.hash = ET.tostring(element)
+        self.hash = tostring(element)
 
     def __str__(self):
         return self.name or self.code
@@ -500,7 +501,7 @@ class OperatingProfile:
         self.week_of_month = None
         periodic_day_type = element.find("PeriodicDayType")
         if periodic_day_type is not None:
-            logger.info(ET.tostring(periodic_day_type).decode())
+            logger.info(tostring(periodic_day_type))
             self.week_of_month = periodic_day_type.findtext("WeekOfMonth/WeekNumber")
         # Special Days:
 
@@ -548,7 +549,7 @@ class OperatingProfile:
             if element.find("RegularDayType/HolidaysOnly") is not None:
                 self.operation_bank_holidays = element.find("RegularDayType")
 
-        self.hash = ET.tostring(element)
+        self.hash = tostring(element)
         if serviced_organisations:
             for organisation in serviced_organisations.values():
                 self.hash += organisation.hash
@@ -659,32 +660,40 @@ class Line:
             or element.findtext("LineFontColour")
             or element.findtext("LineImage")
         ):
-            logger.info(ET.tostring(element).decode())
+            logger.info(tostring(element))
 
         self.outbound_description = element.findtext("OutboundDescription/Description")
         self.inbound_description = element.findtext("InboundDescription/Description")
 
 
+# the only elements TransXChange.__init__ needs to see
+TAGS = (
+    "StopPoints",
+    "RouteSections",
+    "Routes",
+    "Operators",
+    "JourneyPatternSections",
+    "ServicedOrganisations",
+    "VehicleJourney",
+    "VehicleJourneys",
+    "Service",
+    "Garages",
+    "TransXChange",
+)
+
+
 class TransXChange:
     def get_journeys(self, service_code, line_id):
-        return [
-            journey
-            for journey in self.journeys
-            if journey.service_ref == service_code and journey.line_ref == line_id
-        ]
+        return self.service_journeys.get(service_code, {}).get(line_id, [])
 
-    def __get_journeys(self, journeys_element, serviced_organisations):
-        journeys = {
-            journey.code: journey
-            for journey in (
-                VehicleJourney(element, self.services, serviced_organisations)
-                for element in journeys_element
-            )
-        }
+    def get_service_journeys(self, service_code):
+        for journeys in self.service_journeys.get(service_code, {}).values():
+            yield from journeys
 
+    def __index_journeys(self, journeys):
         # Some Journeys do not have a direct reference to a JourneyPattern,
         # but rather a reference to another Journey which has a reference to a JourneyPattern
-        for journey in iter(journeys.values()):
+        for journey in journeys.values():
             if journey.journey_ref:
                 referenced_journey = journeys[journey.journey_ref]
                 if journey.journey_pattern is None:
@@ -692,25 +701,31 @@ class TransXChange:
                 if journey.operating_profile is None:
                     journey.operating_profile = referenced_journey.operating_profile
 
-        return [journey for journey in journeys.values() if journey.journey_pattern]
+            if journey.journey_pattern:
+                self.journeys.append(journey)
+                self.service_journeys.setdefault(journey.service_ref, {}).setdefault(
+                    journey.line_ref, []
+                ).append(journey)
 
-    def __init__(self, open_file):
-        iterator = ET.iterparse(open_file)
+    def __init__(self, open_file, use_lxml=False):
+        iterator = iterparse(
+            open_file, "http://www.transxchange.org.uk/", TAGS, use_lxml=use_lxml
+        )
 
         self.services = {}
         self.stops = {}
         self.routes = {}
         self.route_sections = {}
         self.journeys = []
+        self.service_journeys = {}  # {service_ref: {line_ref: [journeys]}}
         self.garages = {}
 
         serviced_organisations = None
 
         journey_pattern_sections = {}
+        journeys = {}
 
         for _, element in iterator:
-            if element.tag[:33] == "{http://www.transxchange.org.uk/}":
-                element.tag = element.tag[33:]
             tag = element.tag
 
             if tag == "StopPoints":
@@ -744,18 +759,33 @@ class TransXChange:
                     organisation.code: organisation
                     for organisation in serviced_organisations
                 }
-            elif tag == "VehicleJourneys":
+                element.clear()
+            elif tag == "VehicleJourney":
+                # parse each journey as soon as it's been read, rather than
+                # keeping the whole VehicleJourneys element in memory
                 try:
-                    self.journeys = self.__get_journeys(element, serviced_organisations)
+                    journey = VehicleJourney(
+                        element, self.services, serviced_organisations
+                    )
                 except (AttributeError, KeyError) as e:
                     logger.exception(e)
                     return
+                journeys[journey.code] = journey
+                element.clear()
+            elif tag == "VehicleJourneys":
+                try:
+                    self.__index_journeys(journeys)
+                except KeyError as e:
+                    logger.exception(e)
+                    return
+                journeys = None
                 element.clear()
             elif tag == "Service":
                 service = Service(
                     element, serviced_organisations, journey_pattern_sections
                 )
                 self.services[service.service_code] = service
+                element.clear()
             elif tag == "Garages":
                 for garage_element in element:
                     self.garages[garage_element.findtext("GarageCode")] = garage_element
@@ -0,0 +1,227 @@
+"""Journey location history archive.
+
+While a journey is in progress, its locations are appended to a Redis list
+(see VehicleLocation.get_appendage). Once the day is over, archive_journeys moves
+them into one file per day, so that Redis only has to hold recent history:
+
+    header  magic, number of journeys
+    index   journey ids (sorted), byte offsets of each journey's block
+    blocks  each journey's locations, one column after another, zlib-compressed
+
+so reading one journey's history only involves a binary search of the index
+and decompressing one small block
+"""
+
+import datetime
+import struct
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from .utils import redis_client
+
+# the same layout as the "I 2f ?h ?h" struct packed by VehicleLocation.get_appendage
+appendage_dtype = np.dtype(
+    [
+        ("timestamp", "<u4"),
+        ("longitude", "<f4"),
+        ("latitude", "<f4"),
+        ("has_heading", "?"),
+        ("heading", "<i2"),
+        ("has_delay", "?"),
+        ("delay", "<i2"),
+    ],
+    align=True,
+)
+
+# bytes per location in a block, without the struct padding
+row_size = sum(
+    appendage_dtype.fields[name][0].itemsize for name in appendage_dtype.names
+)
+
+header = struct.Struct("<4sI")
+magic = b"BTJ1"
+
+
+def get_archive_path(date):
+    return settings.DATA_DIR / "journeys" / f"{date}.bin"
+
+
+def get_block(locations: np.ndarray) -> bytes:
+    return zlib.compress(
+        b"".join(locations[name].tobytes() for name in appendage_dtype.names)
+    )
+
+
+def get_locations(block: bytes) -> np.ndarray:
+    """The inverse of get_block"""
+    data = zlib.decompress(block)
+    count = len(data) // row_size
+
+    locations = np.zeros(count, dtype=appendage_dtype)
+    offset = 0
+    for name in appendage_dtype.names:
+        dtype = appendage_dtype.fields[name][0]
+        locations[name] = np.frombuffer(data, dtype, count, offset)
+        offset += dtype.itemsize * count
+    return locations
+
+
+def read_block(block: bytes) -> list[dict]:
+    locations = get_locations(block)
+    columns = {name: locations[name].tolist() for name in appendage_dtype.names}
+
+    return [
+        {
+            "id": timestamp,
+            "coordinates": (longitude, latitude),
+            "delta": delay if has_delay else None,
+            "direction": heading if has_heading else None,
+            "datetime": datetime.datetime.fromtimestamp(
+                timestamp, datetime.timezone.utc
+            ),
+        }
+        for (
+            timestamp,
+            longitude,
+            latitude,
+            has_heading,
+            heading,
+            has_delay,
+            delay,
+        ) in zip(*(columns[name] for name in appendage_dtype.names))
+    ]
+
+
+def read_index(path):
+    """The sorted journey ids in an archive file, and the file offsets of their blocks"""
+    with path.open("rb") as open_file:
+        file_magic, count = header.unpack(open_file.read(header.size))
+    assert file_magic == magic
+
+    ids = np.memmap(path, "<i8", "r", header.size, (count,))
+    offsets = np.memmap(path, "<u8", "r", header.size + ids.nbytes, (count + 1,))
+    return ids, offsets
+
+
+def read_blocks(path) -> dict[int, bytes]:
+    ids, offsets = read_index(path)
+    offsets = offsets.tolist()
+    with path.open("rb") as open_file:
+        open_file.seek(offsets[0])
+        data = open_file.read()
+    start = offsets[0]
+    return {
+        journey_id: data[offsets[i] - start : offsets[i + 1] - start]
+        for i, journey_id in enumerate(ids.tolist())
+    }
+
+
+def write_archive(path, blocks: dict[int, bytes]):
+    ids = np.array(sorted(blocks), dtype="<i8")
+    offsets = np.zeros(len(ids) + 1, dtype="<u8")
+    offsets[0] = header.size + ids.nbytes + offsets.nbytes
+    offsets[1:] = offsets[0] + np.cumsum(
+        [len(blocks[journey_id]) for journey_id in ids.tolist()], dtype="<u8"
+    )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    with temp_path.open("wb") as open_file:
+        open_file.write(header.pack(magic, len(ids)))
+        open_file.write(ids.tobytes())
+        open_file.write(offsets.tobytes())
+        for journey_id in ids.tolist():
+            open_file.write(blocks[journey_id])
+    temp_path.replace(path)
+
+
+def get_archived_locations(journey) -> list[dict] | None:
+    path = get_archive_path(journey.datetime.date())
+    if not path.exists():
+        return
+
+    ids, offsets = read_index(path)
+    i = np.searchsorted(ids, journey.id)
+    if i == len(ids) or ids[i] != journey.id:
+        return
+
+    with path.open("rb") as open_file:
+        open_file.seek(int(offsets[i]))
+        block = open_file.read(int(offsets[i + 1] - offsets[i]))
+    return read_block(block)
+
+
+def get_archived_journey_ids(journeys) -> set[int]:
+    """Which of some journeys have location history in the archive"""
+    journey_ids = set()
+    for date in {journey.datetime.date() for journey in journeys}:
+        path = get_archive_path(date)
+        if path.exists():
+            ids, _ = read_index(path)
+            candidates = np.array(
+                [journey.id for journey in journeys if journey.datetime.date() == date],
+                dtype="<i8",
+            )
+            positions = np.searchsorted(ids, candidates).clip(max=len(ids) - 1)
+            journey_ids.update(candidates[ids[positions] == candidates].tolist())
+    return journey_ids
+
+
+def archive_journeys(journeys, date, chunk_size=1000):
+    """Move the location history of some journeys (which started on `date`)
+    from Redis to the archive. Can be run again for the same day, to add the
+    locations of journeys that were still going last time
+    """
+    path = get_archive_path(date)
+    if path.exists():
+        # running again for the same day - keep what's already archived
+        blocks = read_blocks(path)
+    else:
+        blocks = {}
+
+    archived_counts = {}  # how many items of each Redis list have been archived
+
+    journeys = list(journeys)
+    for i in range(0, len(journeys), chunk_size):
+        chunk = journeys[i : i + chunk_size]
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for journey in chunk:
+            pipeline.lrange(journey.get_redis_key(), 0, -1)
+        for journey, appendages in zip(chunk, pipeline.execute()):
+            if appendages:
+                archived_counts[journey.get_redis_key()] = len(appendages)
+                locations = np.frombuffer(b"".join(appendages), dtype=appendage_dtype)
+                if journey.id in blocks:
+                    # add to what's already archived, skipping any locations that
+                    # were archived before (if a previous run failed to delete them)
+                    archived = get_locations(blocks[journey.id])
+                    locations = np.concatenate(
+                        (
+                            archived,
+                            locations[
+                                ~np.isin(locations["timestamp"], archived["timestamp"])
+                            ],
+                        )
+                    )
+                    locations = locations[
+                        np.argsort(locations["timestamp"], kind="stable")
+                    ]
+                blocks[journey.id] = get_block(locations)
+
+    if not archived_counts:
+        return
+
+    write_archive(path, blocks)
+
+    # only now that the archive has been written safely - and only the locations
+    # that have been archived, not any added in the meantime (by a journey that's
+    # still going)
+    keys = list(archived_counts)
+    for i in range(0, len(keys), chunk_size):
+        pipeline = redis_client.pipeline(transaction=False)
+        for key in keys[i : i + chunk_size]:
+            pipeline.ltrim(key, archived_counts[key], -1)
+        pipeline.execute()
@@ -1,7 +1,8 @@
 import functools
 import io
-import json
+import math
 import zipfile
+from collections import defaultdict
 from datetime import date, timedelta
 
 import xmltodict
@@ -10,7 +11,9 @@ from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
 from django.core.cache import cache
 from django.db import IntegrityError
-from django.db.models import Exists, OuterRef, Q
+from django.db.models import Exists, F, OuterRef, Q
+from django.db.models.functions import Left, Upper
+from django.db.models.signals import post_save
 from django.utils import timezone
 from django.utils.dateparse import parse_duration
 
@@ -21,6 +24,7 @@ from busstops.models import (
     Service,
     ServiceCode,
     StopPoint,
+    StopUsage,
 )
 from bustimes.models import Route, Trip
 
@@ -75,6 +79,204 @@ def get_line_name_query(line_ref):
     )
 
 
+def normalise_line_name(line_name):
+    return line_name.replace("_", " ").strip().lower()
+
+
+class ServiceIndex:
+    """In-memory index of current services, by line name (or SIRI ServiceCode),
+    operator and stop code prefix, so that Command.get_service can match most
+    journeys to services without querying the database.
+
+    Services whose modified_at has changed are reloaded every so often
+    """
+
+    refresh_interval = timedelta(minutes=10)
+
+    def __init__(self, services):
+        self.services = services
+        self.refreshed_at = None
+        self.service_objects = {}  # service id -> Service
+        self.modified_at = {}  # service id -> modified_at
+        self.line_names = defaultdict(set)  # lower case line name -> service ids
+        self.siri_codes = defaultdict(set)  # ServiceCode.code -> service ids
+        self.keys = defaultdict(list)  # service id -> [(line_names or siri_codes, key)]
+        self.operators = defaultdict(set)  # service id -> operator nocs
+        self.parents = defaultdict(set)  # service id -> operator parents
+        self.stop_prefixes = defaultdict(set)  # service id -> ATCO code prefixes
+
+    def refresh(self):
+        now = timezone.now()
+        if self.refreshed_at and now - self.refreshed_at < self.refresh_interval:
+            return
+        self.refreshed_at = now
+
+        if not self.service_objects:
+            self.load()
+            return
+
+        modified_at = dict(self.services.values_list("id", "modified_at"))
+        to_remove = [
+            service_id
+            for service_id in self.service_objects
+            if modified_at.get(service_id) != self.modified_at[service_id]
+        ]
+        to_load = [
+            service_id
+            for service_id in modified_at
+            if modified_at[service_id] != self.modified_at.get(service_id)
+        ]
+        for service_id in to_remove:
+            self.remove(service_id)
+        if to_load:
+            self.load(to_load)
+
+    def add(self, index, key, service_id):
+        index[key].add(service_id)
+        self.keys[service_id].append((index, key))
+
+    def remove(self, service_id):
+        del self.service_objects[service_id]
+        del self.modified_at[service_id]
+        for index, key in self.keys.pop(service_id, ()):
+            index[key].discard(service_id)
+        self.operators.pop(service_id, None)
+        self.parents.pop(service_id, None)
+        self.stop_prefixes.pop(service_id, None)
+
+    def load(self, service_ids=None):
+        services = self.services.annotate(source_name=F("source__name"))
+        if service_ids is None:
+            condition = Q(service__current=True)
+        else:
+            services = services.filter(id__in=service_ids)
+            condition = Q(service__in=service_ids)
+
+        for service in services:
+            self.service_objects[service.id] = service
+            self.modified_at[service.id] = service.modified_at
+            self.add(
+                self.line_names, normalise_line_name(service.line_name), service.id
+            )
+
+        for service_id, line_name in (
+            Route.objects.using(settings.READ_DATABASE)
+            .filter(condition)
+            .values_list("service", "line_name")
+            .order_by()
+            .distinct()
+        ):
+            self.add(self.line_names, normalise_line_name(line_name), service_id)
+
+        for service_id, code in (
+            ServiceCode.objects.using(settings.READ_DATABASE)
+            .filter(condition, scheme__endswith="SIRI")
+            .values_list("service", "code")
+        ):
+            self.add(self.siri_codes, code, service_id)
+
+        for service_id, noc, parent in (
+            Service.operator.through.objects.using(settings.READ_DATABASE)
+            .filter(condition)
+            .values_list("service", "operator", "operator__parent")
+        ):
+            self.operators[service_id].add(noc)
+            if parent:
+                self.parents[service_id].add(parent)
+
+        for service_id, prefix in (
+            StopUsage.objects.using(settings.READ_DATABASE)
+            .filter(condition)
+            .annotate(prefix=Left("stop", 3))
+            .values_list("service", "prefix")
+            .order_by()
+            .distinct()
+        ):
+            self.stop_prefixes[service_id].add(prefix)
+
+    def get_services(self, line_refs):
+        """Service ids matching any of the line refs - like get_line_name_query"""
+        service_ids = set()
+        for line_ref in line_refs:
+            service_ids |= self.siri_codes.get(line_ref, set())
+            service_ids |= self.line_names.get(normalise_line_name(line_ref), set())
+        # (a service might have been removed since the line name was indexed)
+        return sorted(
+            service_id
+            for service_id in service_ids
+            if service_id in self.service_objects
+        )
+
+    def get_service(
+        self, line_refs, operator_ref, operators, vehicle_operator_id, destination_ref
+    ):
+        """Returns a Service, or False if there definitely isn't one,
+        or None if we need to ask the database (Command.get_service) to be sure
+        """
+        self.refresh()
+
+        service_ids = self.get_services(line_refs)
+
+        if operator_ref == "TFLO":
+            service_ids = [
+                service_id
+                for service_id in service_ids
+                if self.service_objects[service_id].source_name == "L"
+            ]
+            if service_ids:
+                return self.service_objects[service_ids[0]]
+            return
+
+        if not operators:
+            pass
+        elif len(operators) == 1 and operators[0].parent and destination_ref:
+            operator = operators[0]
+
+            # first try taking OperatorRef at face value
+            matches = [
+                service_id
+                for service_id in service_ids
+                if operator.noc in self.operators[service_id]
+            ]
+            if len(matches) == 1:
+                return self.service_objects[matches[0]]
+
+            service_ids = [
+                service_id
+                for service_id in service_ids
+                if operator.parent in self.parents[service_id]
+                or vehicle_operator_id in self.operators[service_id]
+            ]
+
+        else:
+            if len(operators) == 1:
+                nocs = {operators[0].noc, vehicle_operator_id}
+            else:
+                nocs = {operator.noc for operator in operators}
+            service_ids = [
+                service_id
+                for service_id in service_ids
+                if nocs & self.operators[service_id]
+            ]
+
+            if len(operators) == 1 or not destination_ref:
+                if not service_ids:
+                    return False
+                if len(service_ids) == 1:
+                    return self.service_objects[service_ids[0]]
+
+        if destination_ref:
+            service_ids = [
+                service_id
+                for service_id in service_ids
+                if destination_ref[:3] in self.stop_prefixes[service_id]
+            ]
+            if not service_ids:
+                return False
+            if len(service_ids) == 1:
+                return self.service_objects[service_ids[0]]
+
+
 class Command(ImportLiveVehiclesCommand):
     source_name = "Bus Open Data"
     services = (
@@ -89,6 +291,13 @@ class Command(ImportLiveVehiclesCommand):
         self.identifiers = {}
         self.journeys_ids = {}
         self.journeys_ids_ids = {}
+        self.service_index = None
+        self.trip_tables = {}  # for get_trip
+
+    def handle(self, *args, **options):
+        # (not used by the one-off debugger, which wants to show the queries)
+        self.service_index = ServiceIndex(self.services)
+        super().handle(*args, **options)
 
     @staticmethod
     def get_datetime(item):
@@ -104,7 +313,8 @@ class Command(ImportLiveVehiclesCommand):
             | Q(noc=operator_ref) & ~Exists(operator_codes)
         )
 
-    def get_vehicle(self, item):
+    @staticmethod
+    def get_vehicle_refs(item):
         monitored_vehicle_journey = item["MonitoredVehicleJourney"]
         operator_ref = monitored_vehicle_journey["OperatorRef"]
         vehicle_ref = monitored_vehicle_journey["VehicleRef"] or ""
@@ -120,56 +330,37 @@ class Command(ImportLiveVehiclesCommand):
         if not vehicle_ref and vehicle_unique_id:
             vehicle_ref = vehicle_unique_id
 
-        if (
+        return operator_ref, vehicle_ref, vehicle_unique_id
+
+    @staticmethod
+    def is_globally_unique(vehicle_ref):
+        # assume vehicle ref is globally unique (cos it looks like a vehicle reg?)
+        return (
             not vehicle_ref.isdigit()
             and vehicle_ref.isupper()
             and len(vehicle_ref) > 6
             and not vehicle_ref.startswith("BUS")
-        ):
-            # assume vehicle ref is globally unique (cos it looks like a vehicle reg?)
-            try:
-                return self.vehicles.get(code__iexact=vehicle_ref), False
-            except (Vehicle.DoesNotExist, Vehicle.MultipleObjectsReturned):
-                pass
+        )
 
+    def get_vehicle_defaults(
+        self, operator_ref, vehicle_ref, vehicle_unique_id, operators
+    ):
         # ffs
         if operator_ref == "MARS" and vehicle_unique_id:
             vehicle_ref = vehicle_unique_id
 
         defaults = {"code": vehicle_ref, "source": self.source}
 
-        operators = self.get_operator(operator_ref)
-
         if operator_ref == "TFLO":
             defaults["livery_id"] = 262
             if vehicle_ref.startswith("TMP"):
                 defaults["notes"] = "Spare ticket machine"
                 defaults["locked"] = True
-            vehicles = self.vehicles.filter(
-                Q(operator__in=operators) | Q(operator=None)
-            )
-        elif not operators:
-            vehicles = self.vehicles.filter(operator=None)
-        elif len(operators) == 1:
-            operator = operators[0]
-
-            defaults["operator"] = operator
-            if operator.parent:
-                condition = Q(operator__parent=operator.parent)
-                vehicles = self.vehicles.filter(condition)
-            else:
-                vehicles = self.vehicles.filter(operator=operator)
-        else:
+        elif operators:
             defaults["operator"] = operators[0]
-            vehicles = self.vehicles.filter(operator__in=operators)
 
-        condition = Q(code__iexact=vehicle_ref)
         if vehicle_ref.isdigit():
             defaults["fleet_number"] = vehicle_ref
-            if operators:
-                condition |= Q(code__endswith=f"-{vehicle_ref}") | Q(
-                    code__startswith=f"{vehicle_ref}_"
-                )
         elif "_-_" in vehicle_ref:
             fleet_number, reg = vehicle_ref.split("_-_", 2)
             if fleet_number.isdigit():
@@ -183,6 +374,61 @@ class Command(ImportLiveVehiclesCommand):
                 if vehicle_unique_id.isdigit():
                     defaults["fleet_number"] = vehicle_unique_id
 
+        return vehicle_ref, defaults
+
+    @staticmethod
+    def is_operator_vehicle(vehicle, operator_ref, operators):
+        """In-memory equivalent of the operator filter in get_vehicle"""
+        if operator_ref == "TFLO":
+            return vehicle.operator_id is None or any(
+                vehicle.operator_id == operator.noc for operator in operators
+            )
+        if not operators:
+            return vehicle.operator_id is None
+        if len(operators) == 1:
+            operator = operators[0]
+            if operator.parent:
+                return vehicle.operator_parent == operator.parent
+            return vehicle.operator_id == operator.noc
+        return any(vehicle.operator_id == operator.noc for operator in operators)
+
+    def get_vehicle(self, item):
+        operator_ref, vehicle_ref, vehicle_unique_id = self.get_vehicle_refs(item)
+
+        if self.is_globally_unique(vehicle_ref):
+            try:
+                return self.vehicles.get(code__iexact=vehicle_ref), False
+            except (Vehicle.DoesNotExist, Vehicle.MultipleObjectsReturned):
+                pass
+
+        operators = self.get_operator(operator_ref)
+
+        vehicle_ref, defaults = self.get_vehicle_defaults(
+            operator_ref, vehicle_ref, vehicle_unique_id, operators
+        )
+
+        if operator_ref == "TFLO":
+            vehicles = self.vehicles.filter(
+                Q(operator__in=operators) | Q(operator=None)
+            )
+        elif not operators:
+            vehicles = self.vehicles.filter(operator=None)
+        elif len(operators) == 1:
+            operator = operators[0]
+            if operator.parent:
+                condition = Q(operator__parent=operator.parent)
+                vehicles = self.vehicles.filter(condition)
+            else:
+                vehicles = self.vehicles.filter(operator=operator)
+        else:
+            vehicles = self.vehicles.filter(operator__in=operators)
+
+        condition = Q(code__iexact=vehicle_ref)
+        if vehicle_ref.isdigit() and operators:
+            condition |= Q(code__endswith=f"-{vehicle_ref}") | Q(
+                code__startswith=f"{vehicle_ref}_"
+            )
+
         vehicles = vehicles.filter(condition)
 
         try:
@@ -200,6 +446,155 @@ class Command(ImportLiveVehiclesCommand):
 
         return vehicle, created
 
+    def get_vehicles(self, items, identities):
+        """Like get_vehicle, but for lots of items at once.
+
+        Finds candidate vehicles with a couple of queries, matches them up in Python
+        (in the same way as get_vehicle would) and creates the missing vehicles and
+        BODS VehicleCodes in bulk.
+        Returns a dict of vehicle identities to vehicles
+        """
+        refs = {}
+        codes = set()
+        numbers = set()
+        operator_condition = Q()
+
+        for item, identity in zip(items, identities):
+            if identity in refs:
+                continue
+            operator_ref, vehicle_ref, vehicle_unique_id = self.get_vehicle_refs(item)
+            operators = self.get_operator(operator_ref)
+            code, defaults = self.get_vehicle_defaults(
+                operator_ref, vehicle_ref, vehicle_unique_id, operators
+            )
+            refs[identity] = (operator_ref, vehicle_ref, code, defaults, operators)
+
+            codes.add(vehicle_ref.upper())
+            codes.add(code.upper())
+            if code.isdigit() and operators:
+                numbers.add(code)
+                if operator_ref == "TFLO":
+                    operator_condition |= Q(operator__in=operators) | Q(operator=None)
+                elif len(operators) == 1 and operators[0].parent:
+                    operator_condition |= Q(operator__parent=operators[0].parent)
+                else:
+                    operator_condition |= Q(operator__in=operators)
+
+        if not refs:
+            return {}
+
+        vehicles = self.vehicles.annotate(operator_parent=F("operator__parent"))
+        candidates = {
+            vehicle.id: vehicle
+            for vehicle in vehicles.alias(upper_code=Upper("code")).filter(
+                upper_code__in=codes
+            )
+        }
+        if numbers:
+            # (numbers are all digits, so safe to put in a regular expression)
+            numbers = "|".join(numbers)
+            for vehicle in vehicles.filter(
+                operator_condition, code__regex=rf"-({numbers})$|^({numbers})_"
+            ):
+                candidates[vehicle.id] = vehicle
+
+        by_code = defaultdict(list)
+        by_number = defaultdict(list)
+
+        def add_candidate(vehicle):
+            by_code[vehicle.code.upper()].append(vehicle)
+            if "-" in vehicle.code:
+                by_number[vehicle.code.rsplit("-", 1)[1]].append(vehicle)
+            if "_" in vehicle.code:
+                by_number[vehicle.code.split("_", 1)[0]].append(vehicle)
+
+        for vehicle in sorted(candidates.values(), key=lambda vehicle: vehicle.id):
+            add_candidate(vehicle)
+
+        vehicles_by_identity = {}
+        to_create = []
+        to_update = []
+
+        for identity, item_refs in refs.items():
+            operator_ref, vehicle_ref, code, defaults, operators = item_refs
+
+            if self.is_globally_unique(vehicle_ref):
+                matches = by_code[vehicle_ref.upper()]
+                if len(matches) == 1:
+                    vehicles_by_identity[identity] = matches[0]
+                    continue
+
+            matches = [
+                vehicle
+                for vehicle in by_code[code.upper()]
+                if self.is_operator_vehicle(vehicle, operator_ref, operators)
+            ]
+            if code.isdigit() and operators:
+                matches += [
+                    vehicle
+                    for vehicle in by_number[code]
+                    if vehicle not in matches
+                    and self.is_operator_vehicle(vehicle, operator_ref, operators)
+                ]
+
+            if not matches:
+                vehicle = Vehicle(**defaults)
+                vehicle.operator_parent = (
+                    vehicle.operator.parent if vehicle.operator else None
+                )
+                vehicle.set_derived_fields()
+                to_create.append(vehicle)
+                add_candidate(vehicle)
+            elif len(matches) > 1:
+                print(operator_ref, vehicle_ref, matches)
+                # like QuerySet.first() - lowest id, or the first one we created
+                vehicle = min(matches, key=lambda vehicle: vehicle.id or math.inf)
+            else:
+                vehicle = matches[0]
+                if "fleet_code" in defaults and not vehicle.fleet_code:
+                    vehicle.fleet_code = defaults["fleet_code"]
+                    if "fleet_number" in defaults:
+                        vehicle.fleet_number = defaults["fleet_number"]
+                    if vehicle.id:
+                        to_update.append(vehicle)
+
+            vehicles_by_identity[identity] = vehicle
+
+        if to_create:
+            try:
+                Vehicle.objects.bulk_create(to_create)
+            except IntegrityError as e:
+                # e.g. clashing slugs - leave it to get_vehicle to sort out one by one
+                logger.exception(e)
+                vehicles_by_identity = {
+                    identity: vehicle
+                    for identity, vehicle in vehicles_by_identity.items()
+                    if vehicle.id
+                }
+            else:
+                for vehicle in to_create:
+                    # bulk_create doesn't send signals, but we want the new vehicle webhook
+                    post_save.send(
+                        Vehicle,
+                        instance=vehicle,
+                        created=True,
+                        update_fields=None,
+                        raw=False,
+                        using="default",
+                    )
+
+        if to_update:
+            Vehicle.objects.bulk_update(to_update, ["fleet_code", "fleet_number"])
+
+        VehicleCode.objects.bulk_create(
+            [
+                VehicleCode(code=identity, scheme="BODS", vehicle=vehicle)
+                for identity, vehicle in vehicles_by_identity.items()
+            ]
+        )
+
+        return vehicles_by_identity
+
     def get_service(self, operators, item, line_ref, vehicle_operator_id):
         monitored_vehicle_journey = item["MonitoredVehicleJourney"]
 
@@ -216,7 +611,7 @@ class Command(ImportLiveVehiclesCommand):
             destination_ref = get_destination_ref(destination_ref)
 
         # filter by LineRef or (if present and different) TicketMachineServiceCode
-        line_name_query = get_line_name_query(line_ref)
+        line_refs = [line_ref]
         try:
             ticket_machine_service_code = item["Extensions"]["VehicleJourney"][
                 "Operational"
@@ -225,7 +620,26 @@ class Command(ImportLiveVehiclesCommand):
             pass
         else:
             if ticket_machine_service_code.lower() != line_ref.lower():
-                line_name_query |= get_line_name_query(ticket_machine_service_code)
+                line_refs.append(ticket_machine_service_code)
+
+        if self.service_index:
+            service = self.service_index.get_service(
+                line_refs,
+                item["MonitoredVehicleJourney"]["OperatorRef"],
+                operators,
+                vehicle_operator_id,
+                destination_ref,
+            )
+            if service is False:
+                cache.set(cache_key, False, 3600)
+                return
+            if service:
+                return service
+            # otherwise, fall back to querying the database
+
+        line_name_query = get_line_name_query(line_refs[0])
+        if len(line_refs) > 1:
+            line_name_query |= get_line_name_query(line_refs[1])
 
         services = self.services.filter(line_name_query).defer("geometry")
 
@@ -549,6 +963,7 @@ class Command(ImportLiveVehiclesCommand):
                     arrival_time=arrival_time,
                     journey_code=journey_code,
                     block_ref=block_ref,
+                    trip_tables=self.trip_tables,
                 )
 
                 if trip := journey.trip:
@@ -683,11 +1098,20 @@ class Command(ImportLiveVehiclesCommand):
             [f"vehicle{vc.vehicle_id}" for vc in vehicle_codes]
         )
         vehicle_locations = {
-            vehicle_codes[i].vehicle_id: json.loads(item)
+            vehicle_codes[i].vehicle_id: VehicleLocation.decode_redis_json(item)
             for i, item in enumerate(vehicle_locations)
             if item
         }
 
+        # resolve all the new vehicle identities at once
+        new_items = [
+            (item, identity)
+            for item, identity in zip(items, identities)
+            if identity not in vehicles_by_identity
+        ]
+        if new_items:
+            vehicles_by_identity.update(self.get_vehicles(*zip(*new_items)))
+
         for i, item in enumerate(items):
             vehicle_identity = identities[i]
 
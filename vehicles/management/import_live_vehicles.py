@@ -5,6 +5,7 @@ from time import sleep
 
 import requests
 from ciso8601 import parse_datetime
+from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.core.cache import cache
 from django.core.management.base import BaseCommand
@@ -19,7 +20,7 @@ from tenacity import before_sleep_log, retry, wait_exponential
 from busstops.models import DataSource
 from bustimes.models import Route, Trip
 
-from ..models import Vehicle, VehicleJourney
+from ..models import Vehicle, VehicleJourney, VehicleLocation
 from ..utils import calculate_bearing, redis_client
 
 logger = logging.getLogger(__name__)
@@ -144,7 +145,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
         if latest is None:
             latest = redis_client.get(f"vehicle{vehicle.id}")
             if latest:
-                latest = json.loads(latest)
+                latest = VehicleLocation.decode_redis_json(latest)
         if latest:
             latest_datetime = parse_datetime(latest["datetime"])
             latest_latlong = Point(*latest["coordinates"])
@@ -259,7 +260,18 @@ class ImportLiveVehiclesCommand(BaseCommand):
                         datetime=journey.datetime
                     )
                 except VehicleJourney.DoesNotExist:
-                    logger.exception(e)
+                    if not journey.trip_id:
+                        logger.exception(e)
+                        return
+                    # the trip (from a trip table made before a timetable
+                    # re-import) might have been deleted - try again without it
+                    journey.trip = None
+                    try:
+                        journey.save()
+                    except IntegrityError as e:
+                        # don't carry on with an unsaved journey
+                        logger.exception(e)
+                        return
 
             if journey.service_id and VehicleJourney.service.is_cached(journey):
                 if not journey.service.tracking:
@@ -301,6 +313,8 @@ class ImportLiveVehiclesCommand(BaseCommand):
 
         geoadd = []
         sadd = {}
+        changed_ids = []
+        published = []
 
         for location, vehicle in self.to_save:
             if not location.latlong or (
@@ -312,6 +326,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
             # update live map
 
             geoadd += [location.latlong.x, location.latlong.y, vehicle.id]
+            changed_ids.append(vehicle.id)
 
             if location.journey.service_id:
                 key = f"service{location.journey.service_id}vehicles"
@@ -319,7 +334,9 @@ class ImportLiveVehiclesCommand(BaseCommand):
                     sadd[key].append(vehicle.id)
                 else:
                     sadd[key] = [vehicle.id]
+            operator_ids = []
             if vehicle.operator_id:
+                operator_ids.append(vehicle.operator_id)
                 key = f"operator{vehicle.operator_id}vehicles"
                 if key in sadd:
                     sadd[key].append(vehicle.id)
@@ -331,6 +348,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
                     and location.journey.trip.operator_id
                     and location.journey.trip.operator_id != vehicle.operator_id
                 ):
+                    operator_ids.append(location.journey.trip.operator_id)
                     key = f"operator{location.journey.trip.operator_id}vehicles"
                     if key in sadd:
                         sadd[key].append(vehicle.id)
@@ -340,12 +358,29 @@ class ImportLiveVehiclesCommand(BaseCommand):
                 location.journey.trip = None
 
             redis_json = location.get_redis_json()
-            redis_json = json.dumps(redis_json, cls=DjangoJSONEncoder)
-            pipeline.set(f"vehicle{vehicle.id}", redis_json, ex=900)
+            pipeline.set(
+                f"vehicle{vehicle.id}",
+                VehicleLocation.encode_redis_json(redis_json),
+                ex=900,
+            )
             # can't use 'mset' cos it doesn't let us specify an expiry (900 secs = 15 min)
 
+            if settings.VEHICLES_STREAM:
+                redis_json["operator_ids"] = operator_ids
+                published.append(redis_json)
+
         if geoadd:
             pipeline.geoadd("vehicle_location_locations", geoadd)
+            # log which vehicles have changed when (see vehicles_json "since") -
+            # timed as late as possible, just before the pipeline is sent
+            now = timezone.now().timestamp()
+            pipeline.zadd("vehicle_location_changes", dict.fromkeys(changed_ids, now))
+            pipeline.zremrangebyscore("vehicle_location_changes", "-inf", now - 1800)
+        if published:
+            # for anyone listening to vehicles_stream
+            pipeline.publish(
+                "vehicle_locations", json.dumps(published, cls=DjangoJSONEncoder)
+            )
         for key in sadd:
             pipeline.sadd(key, *sadd[key])
 
@@ -428,7 +463,7 @@ class ImportLiveVehiclesCommand(BaseCommand):
 
     def handle(self, immediate=False, *args, **options):
         if self.source_name:
-            self.status_key = f'{self.source_name.replace(" ", "_")}_status'
+            self.status_key = f"{self.source_name.replace(' ', '_')}_status"
             self.status = cache.get(self.status_key, [])
 
         if not immediate:
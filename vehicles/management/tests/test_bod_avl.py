@@ -1,3 +1,4 @@
+from datetime import timedelta
 from pathlib import Path
 from unittest import mock
 
@@ -19,7 +20,7 @@ from busstops.models import (
 )
 from bustimes.models import Calendar, Garage, Route, StopTime, Trip
 
-from ...models import Livery, Vehicle, VehicleJourney
+from ...models import Livery, Vehicle, VehicleCode, VehicleJourney
 from ..commands import import_bod_avl
 
 
@@ -117,6 +118,85 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             [{"noc": "WHIP"}, {"noc": "TGTC"}],
         )
 
+    def test_get_vehicles(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+
+        items = [
+            {"MonitoredVehicleJourney": {"OperatorRef": "FECS", "VehicleRef": "2929"}},
+            {
+                "MonitoredVehicleJourney": {
+                    "OperatorRef": "FECS",
+                    "VehicleRef": "FECS-11111",
+                }
+            },
+            {"MonitoredVehicleJourney": {"OperatorRef": "WHIP", "VehicleRef": "106"}},
+            {
+                "MonitoredVehicleJourney": {"OperatorRef": "WHIP", "VehicleRef": "106"},
+                "Extensions": {"VehicleJourney": {"VehicleUniqueId": "106"}},
+            },
+        ]
+        identities = [command.get_vehicle_identity(item) for item in items]
+
+        with self.assertNumQueries(7):
+            vehicles = command.get_vehicles(items, identities)
+
+        # existing vehicles, matched by operator parent
+        self.assertEqual(vehicles["FECS:2929"].name, "Jeff")
+        self.assertEqual(vehicles["FECS:FECS-11111"].operator_id, "FECS")
+
+        # one new vehicle, shared by two identities
+        self.assertEqual(vehicles["WHIP:106"], vehicles["WHIP:106:106"])
+        self.assertEqual(vehicles["WHIP:106"].operator_id, "WHIP")
+        self.assertEqual(vehicles["WHIP:106"].fleet_code, "106")
+        self.assertEqual(vehicles["WHIP:106"].slug, "whip-106")
+
+        self.assertEqual(Vehicle.objects.count(), 3)
+        self.assertEqual(
+            VehicleCode.objects.filter(scheme="BODS").count(), len(identities)
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(command.get_vehicles([], []), {})
+
+    def test_service_index(self):
+        command = import_bod_avl.Command()
+        command.source = self.source
+        command.service_index = import_bod_avl.ServiceIndex(command.services)
+
+        item = {
+            "MonitoredVehicleJourney": {
+                "OperatorRef": "HAMSTRA",
+                "DestinationRef": "2400103099",
+            }
+        }
+        operators = command.get_operator("HAMSTRA")
+        self.assertEqual(len(operators), 1)
+
+        with self.assertNumQueries(5):  # build the index
+            self.assertEqual(
+                command.get_service(operators, item, "C", "HAMS"), self.service_c
+            )
+        with self.assertNumQueries(0):
+            # route line name matches, but wrong operator
+            self.assertIsNone(command.get_service(operators, item, "UU", "HAMS"))
+
+        item = {"MonitoredVehicleJourney": {"OperatorRef": "WHIP"}}
+        operators = command.get_operator("WHIP")
+        self.assertEqual(len(operators), 1)
+        with self.assertNumQueries(0):
+            service = command.get_service(operators, item, "UU", "WHIP")
+        self.assertEqual(service.line_name, "U")
+
+        # modified service
+        self.service_c.line_name = "C2"
+        self.service_c.save(update_fields=["line_name", "modified_at"])
+        command.service_index.refreshed_at -= timedelta(minutes=11)
+        with self.assertNumQueries(6):
+            self.assertEqual(
+                command.get_service(operators, item, "c2", "HAMS"), self.service_c
+            )
+
     @time_machine.travel("2020-05-01", tick=False)
     def test_new_bod_avl_a(self):
         command = import_bod_avl.Command()
@@ -277,10 +357,19 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             "vehicles.management.commands.import_bod_avl.Command.get_items",
             return_value=items,
         ):
-            with self.assertNumQueries(42):
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe("vehicle_locations")
+            pubsub.get_message()
+
+            with self.assertNumQueries(29), override_settings(VEHICLES_STREAM=True):
                 wait = command.update()
             self.assertEqual(11, wait)
 
+            # for vehicles_stream
+            message = pubsub.get_message()["data"]
+            self.assertEqual(message.count(b'"operator_ids": '), 3)
+            self.assertIn(b'"operator_ids": ["HAMS"]', message)
+
             with self.assertNumQueries(0):
                 wait = command.update()
             self.assertEqual(11, wait)
@@ -288,6 +377,8 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             items[0]["RecordedAtTime"] = "2020-10-30T05:09:00+00:00"
             with self.assertNumQueries(1):
                 command.update()
+            # nothing published without settings.VEHICLES_STREAM
+            self.assertIsNone(pubsub.get_message())
 
             items[0]["RecordedAtTime"] = "2020-10-30T05:10:00+00:00"
             items[0]["OriginAimedDepartureTime"] = "2020-10-30T09:00:00+00:00"
@@ -351,6 +442,63 @@ class BusOpenDataVehicleLocationsTest(TestCase):
             json = response.json()
             self.assertEqual(len(json), 3)
 
+            # changes since a previous response
+            with time_machine.travel("2020-10-17T08:35:09", tick=False):
+                response = self.client.get("/vehicles.json?since=0")
+            self.assertTrue(response.json()["replace"])
+            self.assertEqual(response.json()["vehicles"], json)
+            cursor = response.json()["cursor"]
+            # the time of the latest change, not the time of the request
+            self.assertEqual(
+                cursor,
+                redis_client.zscore("vehicle_location_changes", json[0]["id"]),
+            )
+
+            with self.assertNumQueries(0):
+                response = self.client.get(f"/vehicles.json?since={cursor + 10}")
+            self.assertEqual(
+                response.json(),
+                {
+                    "cursor": cursor + 10,
+                    "replace": False,
+                    "vehicles": [],
+                    "removed": [],
+                },
+            )
+
+            # changes from just before the cursor are sent again, just in case
+            response = self.client.get(f"/vehicles.json?since={cursor}")
+            self.assertEqual(response.json()["vehicles"], json)
+
+            response = self.client.get(f"/vehicles.json?since={cursor - 60}")
+            self.assertEqual(response.json()["vehicles"], json)
+
+            # only vehicles the client could have been sent count as removed
+            response = self.client.get(
+                f"/vehicles.json?operator=HAMS&since={cursor - 60}"
+            )
+            self.assertEqual(len(response.json()["vehicles"]), 1)
+            self.assertEqual(response.json()["removed"], [])
+
+            # just outside the bounding box
+            response = self.client.get(
+                "/vehicles.json?xmin=0.29&xmax=0.3&ymin=51.2&ymax=51.22"
+                f"&since={cursor - 60}"
+            )
+            self.assertEqual(response.json()["vehicles"], [])
+            self.assertEqual(
+                response.json()["removed"],
+                [item["id"] for item in json if item["coordinates"][0] == 0.285348],
+            )
+            # nowhere near
+            response = self.client.get(
+                f"/vehicles.json?xmin=-3&xmax=-2.9&ymin=51.2&ymax=51.22&since={cursor}"
+            )
+            self.assertEqual(response.json()["removed"], [])
+
+            response = self.client.get("/vehicles.json?since=poop")
+            self.assertEqual(response.status_code, 400)
+
             # trip progress
 
             StopPoint.objects.create(
@@ -569,6 +717,41 @@ class BusOpenDataVehicleLocationsTest(TestCase):
                 ],
             )
 
+            # map tiles
+            with self.assertNumQueries(0):
+                response = self.client.get("/vehicles/tiles/6/32/21.json")
+            self.assertEqual(
+                response.json(),
+                [
+                    {
+                        "coordinates": [1.675893, 52.328398],
+                        "count": 1,
+                        "id": vehicle.id,
+                    }
+                ],
+            )
+
+            response = self.client.get("/vehicles/tiles/6/31/21.json")
+            self.assertEqual(response.json(), [])
+
+            response = self.client.get("/vehicles/tiles/6/64/21.json")
+            self.assertEqual(response.status_code, 404)
+
+            # the whole world
+            response = self.client.get("/vehicles/tiles/0/0/0.json")
+            self.assertEqual(
+                response.json(),
+                [{"coordinates": [1.675893, 52.328398], "count": 1, "id": vehicle.id}],
+            )
+
+            # expired location
+            redis_client.delete(f"vehicle{vehicle.id}")
+            response = self.client.get("/vehicles/tiles/5/16/10.json")
+            self.assertEqual(response.json(), [])
+            self.assertIsNone(
+                redis_client.zscore("vehicle_location_locations", vehicle.id)
+            )
+
     def test_handle_item_2(self):
         command = import_bod_avl.Command()
         command.source = self.source
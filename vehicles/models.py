@@ -3,6 +3,8 @@ import re
 import struct
 import uuid
 from collections import Counter
+from functools import lru_cache
+from json import dumps, loads
 from math import ceil
 from urllib.parse import quote
 
@@ -11,6 +13,7 @@ from autoslug import AutoSlugField
 from django.conf import settings
 from django.contrib.gis.db import models
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q, UniqueConstraint
 from django.db.models.functions import TruncDate, Upper
 from django.urls import reverse
@@ -49,7 +52,7 @@ def get_css(colours, direction=None, horizontal=False, angle=None):
         background += "to top"
     elif direction < 180:
         if angle:
-            background += f"{360-angle}deg"
+            background += f"{360 - angle}deg"
         else:
             background += "to left"
     elif angle:
@@ -321,6 +324,13 @@ class Vehicle(models.Model):
         return not self.locked
 
     def save(self, *args, update_fields=None, **kwargs):
+        self.set_derived_fields(update_fields)
+
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+    def set_derived_fields(self, update_fields=None):
+        """Make fleet_number, fleet_code and reg consistent with each other
+        (also used before bulk_create, which doesn't call save())"""
         if (
             update_fields is None or "fleet_number" in update_fields
         ) and self.fleet_number:
@@ -344,8 +354,6 @@ class Vehicle(models.Model):
         elif update_fields is None or "reg" in update_fields:
             self.reg = self.reg.upper().replace(" ", "")
 
-        super().save(*args, update_fields=update_fields, **kwargs)
-
     class Meta:
         indexes = [
             models.Index(Upper("fleet_code"), name="fleet_code"),
@@ -750,6 +758,19 @@ class Occupancy(models.TextChoices):
     FULL = "full", "Full"
 
 
+json_encoder = DjangoJSONEncoder()
+
+
+@lru_cache(maxsize=4096)
+def format_redis_timestamp(timestamp: float) -> str:
+    """The same string DjangoJSONEncoder gives for a UTC datetime – cached, as lots
+    of vehicles (in a vehicles_json response, say) have locations from the same second
+    """
+    return json_encoder.default(
+        datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    )
+
+
 class VehicleLocation:
     """This used to be a model,
     is no longer stored in the database
@@ -783,17 +804,7 @@ class VehicleLocation:
         if delay is not None:
             delay = round(delay.total_seconds() / 60)
 
-        if self.heading is None or type(self.heading) is int:
-            heading = self.heading
-        elif type(self.heading) is str:
-            if self.heading.isdigit():
-                heading = int(self.heading)
-            elif self.heading:
-                heading = round(float(self.heading))
-            else:
-                heading = None
-        else:
-            heading = round(self.heading)
+        heading = self.round_heading(self.heading)
 
         return self.journey.get_redis_key(), struct.pack(
             "I 2f ?h ?h",
@@ -806,6 +817,18 @@ class VehicleLocation:
             delay or 0,
         )
 
+    @staticmethod
+    def round_heading(heading):
+        if heading is None or type(heading) is int:
+            return heading
+        if type(heading) is str:
+            if heading.isdigit():
+                return int(heading)
+            if heading:
+                return round(float(heading))
+            return None
+        return round(heading)
+
     @staticmethod
     def decode_appendage(location):
         location = struct.unpack("I 2f ?h ?h", location)
@@ -819,6 +842,137 @@ class VehicleLocation:
             ),
         }
 
+    # binary alternative to get_redis_json() encoded as JSON, if settings.BINARY_LIVE_STATE:
+    # magic byte, flags, id, journey_id, trip_id, service_id,
+    # longitude, latitude, timestamp, heading, delay, and lengths of the strings that follow.
+    # About a third of the size of the JSON, and (with format_redis_timestamp's cache)
+    # faster to decode than json.loads
+    redis_struct = struct.Struct("<cB I q q I 3d h d 6H")
+    redis_strings = (
+        "destination",
+        "block",
+        "tfl_code",
+        "service",
+        "seats",
+        "wheelchair",
+    )
+
+    @classmethod
+    def encode_redis_json(cls, json: dict):
+        """get_redis_json() as bytes or a JSON string - decode_redis_json gives the same
+        dict either way (with the datetime as a UTC string, and the heading as a number)
+        """
+        if isinstance(json["datetime"], datetime.datetime) and json["datetime"].tzinfo:
+            json = {
+                **json,
+                "datetime": json["datetime"].astimezone(datetime.timezone.utc),
+            }
+
+        heading = json["heading"]
+        if type(heading) is float and heading.is_integer():
+            heading = int(heading)
+
+        if (
+            not settings.BINARY_LIVE_STATE
+            or not json.keys()
+            <= {
+                "id",
+                "journey_id",
+                "coordinates",
+                "heading",
+                "datetime",
+                "delay",
+                "trip_id",
+                "service_id",
+                *cls.redis_strings,
+            }
+            or heading is not None
+            and type(heading) is not int  # e.g. 92.5 - keep as it is
+        ):
+            return dumps(json, cls=DjangoJSONEncoder)
+
+        strings = [
+            json.get(key) if key != "service" else json.get(key, {}).get("line_name")
+            for key in cls.redis_strings
+        ]
+        delay = json.get("delay")
+
+        flags = 0
+        for i, value in enumerate([heading, delay, *strings]):
+            if value is not None:
+                flags |= 1 << i
+
+        try:
+            strings = [string.encode() for string in strings if string is not None]
+            return cls.redis_struct.pack(
+                b"\x01",
+                flags,
+                json["id"],
+                json["journey_id"],
+                json.get("trip_id") or 0,
+                json.get("service_id") or 0,
+                *json["coordinates"],
+                json["datetime"].timestamp(),
+                heading or 0,
+                delay or 0,
+                *[len(string) for string in strings],
+                *[0] * (len(cls.redis_strings) - len(strings)),
+            ) + b"".join(strings)
+        except (AttributeError, struct.error):
+            # something that doesn't fit, like a heading of 100000 or a non-string block
+            return dumps(json, cls=DjangoJSONEncoder)
+
+    @classmethod
+    def decode_redis_json(cls, value) -> dict:
+        if value[:1] != b"\x01":
+            return loads(value)
+
+        (
+            _,
+            flags,
+            vehicle_id,
+            journey_id,
+            trip_id,
+            service_id,
+            longitude,
+            latitude,
+            timestamp,
+            heading,
+            delay,
+            *lengths,
+        ) = cls.redis_struct.unpack_from(value)
+
+        json = {
+            "id": vehicle_id,
+            "journey_id": journey_id,
+            "coordinates": [longitude, latitude],
+            "heading": heading if flags & 1 else None,
+            "datetime": format_redis_timestamp(timestamp),
+            "destination": None,
+            "block": None,
+        }
+        if flags & 2:
+            json["delay"] = delay
+        if trip_id:
+            json["trip_id"] = trip_id
+        if service_id:
+            json["service_id"] = service_id
+
+        if flags >> 2:
+            offset = cls.redis_struct.size
+            lengths = iter(lengths)
+            for i, key in enumerate(cls.redis_strings):
+                if flags & 4 << i:
+                    length = next(lengths)
+                    string = value[offset : offset + length].decode()
+                    offset += length
+                    if key == "service":
+                        json[key] = {"line_name": string}
+                    else:
+                        json[key] = string
+
+        return json
+
     def get_redis_json(self):
         journey = self.journey
 
@@ -1,5 +1,5 @@
 import functools
-from datetime import timedelta
+from datetime import UTC, datetime, time, timedelta
 
 from ciso8601 import parse_datetime
 from django.core.cache import cache
@@ -11,8 +11,10 @@ from huey.contrib.djhuey import db_periodic_task, db_task
 
 from busstops.models import DataSource, Operator
 
+from .history import archive_journeys
 from .management.commands import import_bod_avl
 from .models import SiriSubscription, Vehicle, VehicleJourney, VehicleRevision
+from .utils import redis_client
 
 
 @functools.cache
@@ -20,6 +22,7 @@ def get_bod_avl_command(source_name):
     command = import_bod_avl.Command()
     command.source_name = source_name
     command.do_source()
+    command.service_index = import_bod_avl.ServiceIndex(command.services)
     return command
 
 
@@ -243,3 +246,21 @@ def timetable_source_stats():
     history.append(stats)
 
     cache.set("timetable-source-stats", history, None)
+
+
+@db_periodic_task(crontab(minute=30, hour=4))
+def archive_journey_history():
+    """Move yesterday's (UTC) journeys' location history out of Redis, into the archive.
+    Also the day before's again, for journeys that were still going this time yesterday
+    """
+    if not redis_client:
+        return
+
+    for days_ago in (2, 1):
+        date = (timezone.now() - timedelta(days=days_ago)).date()
+        start = datetime.combine(date, time(), UTC)
+        journeys = VehicleJourney.objects.filter(
+            datetime__gte=start, datetime__lt=start + timedelta(days=1)
+        ).only("id", "uuid", "datetime")
+
+        archive_journeys(journeys.iterator(), date)
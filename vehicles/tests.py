@@ -1,6 +1,12 @@
+import asyncio
+import json
+from datetime import date
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest.mock import patch
 
 import fakeredis
+import fakeredis.aioredis
 import time_machine
 from ciso8601 import parse_datetime
 from django.contrib.gis.geos import Point
@@ -10,6 +16,7 @@ from django.test import TestCase, override_settings
 from accounts.models import User
 from busstops.models import DataSource, Operator, Region, Service
 
+from .history import archive_journeys
 from .models import (
     Livery,
     Vehicle,
@@ -299,6 +306,129 @@ class VehiclesTests(TestCase):
         location.wheelchair_capacity = 1
         self.assertEqual(location.get_redis_json()["wheelchair"], "free")
 
+        redis_json = location.get_redis_json()
+        json_value = VehicleLocation.encode_redis_json(redis_json)
+        self.assertIsInstance(json_value, str)
+
+        with override_settings(BINARY_LIVE_STATE=True):
+            binary_value = VehicleLocation.encode_redis_json(redis_json)
+        self.assertIsInstance(binary_value, bytes)
+        self.assertLess(len(binary_value), len(json_value))
+
+        # decodes to the same thing either way
+        self.assertEqual(
+            VehicleLocation.decode_redis_json(binary_value),
+            VehicleLocation.decode_redis_json(json_value),
+        )
+        self.assertEqual(
+            VehicleLocation.decode_redis_json(binary_value)["datetime"],
+            "2020-10-19T23:47:00Z",
+        )
+
+        # not UTC, and a heading that can't be stored as an int without rounding
+        location.datetime = parse_datetime("2020-10-20T00:47:00+01:00")
+        location.heading = 92.5
+        redis_json = location.get_redis_json()
+        with override_settings(BINARY_LIVE_STATE=True):
+            self.assertEqual(
+                VehicleLocation.decode_redis_json(
+                    VehicleLocation.encode_redis_json(redis_json)
+                ),
+                {
+                    **VehicleLocation.decode_redis_json(json_value),
+                    "heading": 92.5,
+                },
+            )
+
+    def test_journey_history_archive(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        location = VehicleLocation(latlong=Point(1.5, 52.625), heading=90)
+        location.journey = self.journey
+        location.datetime = parse_datetime("2020-10-19 23:48+00:00")
+        redis_client.rpush(*location.get_appendage())
+
+        with (
+            TemporaryDirectory() as data_dir,
+            override_settings(DATA_DIR=Path(data_dir)),
+            patch("vehicles.history.redis_client", redis_client),
+        ):
+            archive_journeys([self.journey], date(2020, 10, 19))
+            self.assertFalse(redis_client.exists(self.journey.get_redis_key()))
+
+            # read from the archive instead of Redis
+            response = self.client.get(f"/journeys/{self.journey.id}.json")
+            self.assertEqual(
+                response.json()["locations"],
+                [
+                    {
+                        "id": 1603151280,
+                        "coordinates": [1.5, 52.625],
+                        "delta": None,
+                        "direction": 90,
+                        "datetime": "2020-10-19T23:48:00Z",
+                    }
+                ],
+            )
+
+            # more locations after the journey was archived (it was still going) -
+            # read from both Redis and the archive
+            location.latlong = Point(1.5, 52.63)
+            location.datetime = parse_datetime("2020-10-19 23:49+00:00")
+            redis_client.rpush(*location.get_appendage())
+
+            response = self.client.get(f"/journeys/{self.journey.id}.json")
+            self.assertEqual(
+                [location["id"] for location in response.json()["locations"]],
+                [1603151280, 1603151340],
+            )
+
+            # added to the archive
+            archive_journeys([self.journey], date(2020, 10, 19))
+            self.assertFalse(redis_client.exists(self.journey.get_redis_key()))
+
+            response = self.client.get(f"/journeys/{self.journey.id}.json")
+            self.assertEqual(
+                [location["id"] for location in response.json()["locations"]],
+                [1603151280, 1603151340],
+            )
+
+    def test_vehicles_stream_wsgi(self):
+        response = self.client.get("/vehicles/stream")
+        self.assertEqual(response.status_code, 404)
+
+        with override_settings(REDIS_URL="redis://localhost", VEHICLES_STREAM=True):
+            response = self.client.get("/vehicles/stream")
+        self.assertEqual(response.status_code, 501)
+
+    async def test_vehicles_stream(self):
+        server = fakeredis.FakeServer()
+        publisher = fakeredis.aioredis.FakeRedis(server=server)
+
+        with (
+            override_settings(REDIS_URL="redis://localhost", VEHICLES_STREAM=True),
+            patch(
+                "redis.asyncio.from_url",
+                return_value=fakeredis.aioredis.FakeRedis(server=server),
+            ),
+        ):
+            response = await self.async_client.get("/vehicles/stream?service=1")
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+
+            chunk = asyncio.ensure_future(anext(response.streaming_content))
+            items = [
+                {"coordinates": [1.5, 52.6], "service_id": 1, "operator_ids": ["X"]},
+                {"coordinates": [1.5, 52.6], "service_id": 2, "operator_ids": ["X"]},
+            ]
+            # wait for the listener to subscribe
+            while not await publisher.publish("vehicle_locations", json.dumps(items)):
+                await asyncio.sleep(0.01)
+
+            self.assertEqual(
+                await chunk,
+                b'data: [{"coordinates": [1.5, 52.6], "service_id": 1}]\n\n',
+            )
+            await response.streaming_content.aclose()
+
     def test_vehicle_json(self):
         vehicle = Vehicle.objects.get(id=self.vehicle_2.id)
         vehicle.feature_names = "foo, bar"
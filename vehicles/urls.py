@@ -13,6 +13,8 @@ urlpatterns = [
     path("services/<slug>/vehicles", views.service_vehicles_history),
     path("vehicles", views.vehicles),
     path("vehicles.json", views.vehicles_json),
+    path("vehicles/stream", views.vehicles_stream),
+    path("vehicles/tiles/<int:z>/<int:x>/<int:y>.json", views.vehicles_tile_json),
     path("vehicles/debug", views.debug),
     path("vehicles/history/<int:revision_id>/revert", views.vehicle_revision_revert),
     path("vehicles/history", views.vehicle_edits),
@@ -32,6 +32,26 @@ def calculate_bearing(a, b):
     return int(round(bearing_degrees))
 
 
+def get_tile_bounds(z: int, x: int, y: int) -> tuple:
+    """(xmin, ymin, xmax, ymax) longitudes and latitudes of a Web Mercator map tile"""
+    n = 2**z
+
+    def latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return x / n * 360 - 180, latitude(y + 1), (x + 1) / n * 360 - 180, latitude(y)
+
+
+def get_tile_cell(z: int, longitude: float, latitude: float) -> tuple:
+    """(x, y) of the tile at zoom level z that contains a point"""
+    n = 2**z
+    latitude = math.radians(latitude)
+    return (
+        int((longitude + 180) / 360 * n),
+        int((1 - math.asinh(math.tan(latitude)) / math.pi) / 2 * n),
+    )
+
+
 def match_reg(string):
     if "," in string:
         return all(match_reg(reg) for reg in string.split(","))
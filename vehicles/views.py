@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import json
 import logging
@@ -5,6 +6,7 @@ from itertools import pairwise
 from urllib.parse import unquote
 
 import lightningcss
+import redis.asyncio
 import xmltodict
 from django.conf import settings
 from django.contrib.auth.models import Permission
@@ -13,11 +15,18 @@ from django.contrib.gis.geos import GEOSException, Point
 from django.contrib.postgres.aggregates import StringAgg
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
 from django.core.paginator import Paginator
 from django.db import IntegrityError, OperationalError, connection, transaction
 from django.db.models import Case, F, Max, OuterRef, Q, When
 from django.db.models.functions import Coalesce, Now
-from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils import timezone
@@ -37,6 +46,7 @@ from busstops.utils import get_bounding_box
 from bustimes.models import Garage, Route, StopTime, Trip
 
 from . import filters, forms
+from .history import get_archived_journey_ids, get_archived_locations
 from .management.commands import import_bod_avl
 from .models import (
     Livery,
@@ -50,7 +60,13 @@ from .models import (
 )
 from .rtpi import add_progress_and_delay
 from .tasks import handle_siri_post
-from .utils import apply_revision, get_revision, redis_client  # calculate_bearing,
+from .utils import (  # calculate_bearing,
+    apply_revision,
+    get_revision,
+    get_tile_bounds,
+    get_tile_cell,
+    redis_client,
+)
 
 
 class Vehicles:
@@ -331,6 +347,10 @@ def respond_conditionally(request, response):
     )
 
 
+# seconds (see vehicles_json "since")
+CHANGES_OVERLAP = 10
+
+
 @require_safe
 def vehicles_json(request) -> JsonResponse:
     try:
@@ -340,6 +360,48 @@ def vehicles_json(request) -> JsonResponse:
     except GEOSException:
         return HttpResponseBadRequest()
 
+    # only vehicles that have changed since a previous response's "cursor"
+    since = request.GET.get("since")
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        # (read the change log before the vehicle locations, so that no change
+        # can slip in between them unnoticed)
+        now = timezone.now().timestamp()
+        # the change log only goes back 30 minutes (see ImportLiveVehiclesCommand.save),
+        # and a vehicle's location expires 15 minutes after its last change
+        replace = since < now - 900
+        if replace:
+            changed = redis_client.zrange(
+                "vehicle_location_changes", -1, -1, withscores=True
+            )
+        else:
+            # Changes are scored by the time they were written, but changes written
+            # at about the same time by different processes can arrive in a different
+            # order - so look back a bit further than the cursor, and send any changes
+            # from just before it again, rather than risk missing them
+            changed = redis_client.zrangebyscore(
+                "vehicle_location_changes",
+                f"({since - CHANGES_OVERLAP}",
+                "+inf",
+                withscores=True,
+            )
+            expired = redis_client.zrangebyscore(
+                "vehicle_location_changes",
+                f"({since - CHANGES_OVERLAP - 900}",
+                now - 900,
+            )
+            expired = {int(vehicle_id) for vehicle_id in expired}
+        # the next cursor is the latest change actually read, not the current time
+        if changed:
+            cursor = max(changed[-1][1], since)
+        else:
+            cursor = since if not replace else now - 900
+        changed = {int(vehicle_id) for vehicle_id, _ in changed}
+
     all_vehicles = (
         Vehicle.objects.select_related("vehicle_type")
         .annotate(
@@ -352,6 +414,7 @@ def vehicles_json(request) -> JsonResponse:
     )
 
     vehicle_ids = None
+    nearby_ids = set()
     set_names = None
     service_ids = None
     operator_ids = None
@@ -367,14 +430,32 @@ def vehicles_json(request) -> JsonResponse:
         except ValueError as e:
             return HttpResponseBadRequest(e)
 
-        vehicle_ids = redis_client.geosearch(
-            "vehicle_location_locations",
-            longitude=str((xmax + xmin) / 2),
-            latitude=str((ymax + ymin) / 2),
-            unit="km",
-            width=str(width),
-            height=str(height),
-        )
+        if since is None or replace:
+            vehicle_ids = redis_client.geosearch(
+                "vehicle_location_locations",
+                longitude=str((xmax + xmin) / 2),
+                latitude=str((ymax + ymin) / 2),
+                unit="km",
+                width=str(width),
+                height=str(height),
+            )
+        else:
+            # also vehicles just outside the box, which might have been inside it
+            # at the time of the previous response
+            vehicle_ids = []
+            for vehicle_id, (longitude, latitude) in redis_client.geosearch(
+                "vehicle_location_locations",
+                longitude=str((xmax + xmin) / 2),
+                latitude=str((ymax + ymin) / 2),
+                unit="km",
+                width=str(width + 10),
+                height=str(height + 10),
+                withcoord=True,
+            ):
+                if xmin <= longitude <= xmax and ymin <= latitude <= ymax:
+                    vehicle_ids.append(vehicle_id)
+                else:
+                    nearby_ids.add(int(vehicle_id))
 
     elif "service" in request.GET:
         try:
@@ -399,14 +480,28 @@ def vehicles_json(request) -> JsonResponse:
 
     vehicle_ids = [int(vehicle_id) for vehicle_id in vehicle_ids]
 
+    if since is not None and not replace:
+        # only vehicles that the client might have been sent before -
+        # expired ones (still in the sets and the geo index until cleaned up)...
+        removed = expired.intersection(vehicle_ids)
+        # ...and ones that have moved out of the bounding box
+        removed.update(changed.intersection(nearby_ids))
+        vehicle_ids = [
+            vehicle_id for vehicle_id in vehicle_ids if vehicle_id in changed
+        ]
+
     vehicle_ids.sort()  # for etag stableness
 
-    vehicle_locations = redis_client.mget(
-        [f"vehicle{vehicle_id}" for vehicle_id in vehicle_ids]
-    )
-    vehicle_locations = [
-        json.loads(item) if item else item for item in vehicle_locations
-    ]
+    if vehicle_ids:
+        vehicle_locations = redis_client.mget(
+            [f"vehicle{vehicle_id}" for vehicle_id in vehicle_ids]
+        )
+        vehicle_locations = [
+            VehicleLocation.decode_redis_json(item) if item else item
+            for item in vehicle_locations
+        ]
+    else:
+        vehicle_locations = []  # (MGET needs at least one key)
 
     # remove expired items from 'vehicle_location_locations'
     to_remove = [
@@ -488,6 +583,25 @@ def vehicles_json(request) -> JsonResponse:
     if journeys_to_cache_later:
         cache.set_many(journeys_to_cache_later, 3600)  # an hour
 
+    if since is not None:
+        if replace:
+            removed = []
+        else:
+            removed.update(vehicle_ids)
+            removed.difference_update(item["id"] for item in locations)
+            removed = sorted(removed)
+        return respond_conditionally(
+            request,
+            JsonResponse(
+                {
+                    "cursor": cursor,
+                    "replace": replace,
+                    "vehicles": locations,
+                    "removed": removed,
+                }
+            ),
+        )
+
     return respond_conditionally(
         request,
         JsonResponse(
@@ -497,6 +611,230 @@ def vehicles_json(request) -> JsonResponse:
     )
 
 
+@require_safe
+def vehicles_tile_json(request, z, x, y) -> JsonResponse:
+    """Vehicles in a map tile, clustered into a grid of 8 × 8 cells,
+    for zoomed-out maps that don't need every vehicle's details
+    """
+    if z > 20 or x >= 2**z or y >= 2**z or redis_client is None:
+        raise Http404
+
+    # vehicle locations change all the time, so only cache briefly
+    cache_key = f"vehicles_tile:{z}/{x}/{y}"
+    clusters = cache.get(cache_key)
+
+    if clusters is None:
+        xmin, ymin, xmax, ymax = get_tile_bounds(z, x, y)
+
+        if xmax - xmin >= 180:
+            # too wide for a box search (the distance across the whole world is 0),
+            # and most vehicles will be in the tile anyway
+            vehicle_ids = redis_client.zrange("vehicle_location_locations", 0, -1)
+            if vehicle_ids:
+                positions = redis_client.geopos(
+                    "vehicle_location_locations", *vehicle_ids
+                )
+            else:
+                positions = []
+            vehicles = [
+                (vehicle_id, position)
+                for vehicle_id, position in zip(vehicle_ids, positions)
+                if position
+            ]
+        else:
+            # widest part of the tile
+            if ymin < 0 < ymax:
+                latitude = 0
+            else:
+                latitude = min(ymin, ymax, key=abs)
+            width = haversine((latitude, xmax), (latitude, xmin))
+            height = haversine((ymin, xmax), (ymax, xmax))
+
+            vehicles = redis_client.geosearch(
+                "vehicle_location_locations",
+                longitude=str((xmax + xmin) / 2),
+                latitude=str((ymax + ymin) / 2),
+                unit="km",
+                width=str(width),
+                height=str(height),
+                withcoord=True,
+            )
+
+        vehicles = [
+            (int(vehicle_id), (longitude, latitude))
+            for vehicle_id, (longitude, latitude) in vehicles
+            if xmin <= longitude < xmax and ymin <= latitude < ymax
+        ]
+
+        # remove expired items from 'vehicle_location_locations' (like vehicles_json)
+        if vehicles:
+            pipeline = redis_client.pipeline(transaction=False)
+            for vehicle_id, _ in vehicles:
+                pipeline.exists(f"vehicle{vehicle_id}")
+            exists = pipeline.execute()
+            to_remove = [
+                vehicle_id
+                for (vehicle_id, _), vehicle_exists in zip(vehicles, exists)
+                if not vehicle_exists
+            ]
+            if to_remove:
+                redis_client.zrem("vehicle_location_locations", *to_remove)
+                vehicles = [
+                    vehicle
+                    for vehicle, vehicle_exists in zip(vehicles, exists)
+                    if vehicle_exists
+                ]
+
+        cells = {}
+        for vehicle_id, (longitude, latitude) in vehicles:
+            cell = get_tile_cell(z + 3, longitude, latitude)
+            if cell in cells:
+                cells[cell].append((vehicle_id, longitude, latitude))
+            else:
+                cells[cell] = [(vehicle_id, longitude, latitude)]
+
+        clusters = []
+        for cell in sorted(cells):
+            cell = cells[cell]
+            cluster = {
+                "coordinates": [
+                    round(sum(vehicle[1] for vehicle in cell) / len(cell), 6),
+                    round(sum(vehicle[2] for vehicle in cell) / len(cell), 6),
+                ],
+                "count": len(cell),
+            }
+            if len(cell) == 1:
+                cluster["id"] = cell[0][0]
+            clusters.append(cluster)
+
+        cache.set(cache_key, clusters, 10)
+
+    return respond_conditionally(request, JsonResponse(clusters, safe=False))
+
+
+class VehicleLocationsListener:
+    """One subscription to the vehicle_locations Redis channel per process,
+    shared by all the vehicles_stream clients (each with its own queue)
+    """
+
+    def __init__(self):
+        self.queues = set()
+        self.task = None
+
+    def add(self, queue):
+        self.queues.add(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.listen())
+
+    def remove(self, queue):
+        self.queues.discard(queue)
+        if not self.queues and self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def listen(self):
+        client = redis.asyncio.from_url(settings.REDIS_URL)
+        try:
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe("vehicle_locations")
+
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=30
+                    )
+                    if message is None:
+                        continue
+                    items = json.loads(message["data"])
+                    for queue in self.queues:
+                        if not queue.full():  # a slow client can miss some
+                            queue.put_nowait(items)
+        finally:
+            await client.aclose()
+
+
+vehicle_locations_listener = VehicleLocationsListener()
+
+
+async def stream_vehicle_locations(bounds, service_ids, operator_ids):
+    queue = asyncio.Queue(maxsize=100)
+    vehicle_locations_listener.add(queue)
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), 30)
+            except asyncio.TimeoutError:
+                yield ":\n\n"  # comment, to keep the connection open
+                # in case the listener stopped because of a Redis error
+                vehicle_locations_listener.add(queue)
+                continue
+
+            items = []
+            for item in message:
+                if bounds:
+                    longitude, latitude = item["coordinates"]
+                    if not (
+                        bounds[0] <= longitude <= bounds[2]
+                        and bounds[1] <= latitude <= bounds[3]
+                    ):
+                        continue
+                elif service_ids:
+                    if item.get("service_id") not in service_ids:
+                        continue
+                elif operator_ids:
+                    if operator_ids.isdisjoint(item["operator_ids"]):
+                        continue
+                # (the same item is shared with other clients' queues)
+                items.append(
+                    {key: value for key, value in item.items() if key != "operator_ids"}
+                )
+
+            if items:
+                yield f"data: {json.dumps(items)}\n\n"
+    finally:
+        vehicle_locations_listener.remove(queue)
+
+
+@require_safe
+async def vehicles_stream(request):
+    """Server-sent events, each a list of vehicle locations published by
+    ImportLiveVehiclesCommand.save, filtered like vehicles_json by bounding box,
+    service or operator. Vehicle details aren't included (get them from
+    vehicles_json?id=...). Only works when served by ASGI, with
+    settings.VEHICLES_STREAM
+    """
+    if not settings.REDIS_URL or not settings.VEHICLES_STREAM:
+        raise Http404
+
+    if not isinstance(request, ASGIRequest):
+        # under WSGI, each client would tie up a worker thread forever
+        return HttpResponse("Not implemented under WSGI", status=501)
+
+    try:
+        bounds = get_bounding_box(request).extent
+    except KeyError:
+        bounds = None
+    except GEOSException:
+        return HttpResponseBadRequest()
+
+    service_ids = None
+    operator_ids = None
+    if "service" in request.GET:
+        try:
+            service_ids = {
+                int(service_id) for service_id in request.GET["service"].split(",")
+            }
+        except ValueError:
+            return HttpResponseBadRequest()
+    elif "operator" in request.GET:
+        operator_ids = set(request.GET["operator"].split(","))
+
+    return StreamingHttpResponse(
+        stream_vehicle_locations(bounds, service_ids, operator_ids),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 def get_dates(vehicle=None, service=None):
     if not vehicle:
         # the database query for a service is too slow
@@ -599,6 +937,13 @@ def journeys_list(request, journeys, service=None, vehicle=None) -> dict:
             for journey, location in zip(journeys, locations):
                 journey.locations = location
 
+            archived = get_archived_journey_ids(
+                [journey for journey in journeys if not journey.locations]
+            )
+            for journey in journeys:
+                if journey.id in archived:
+                    journey.locations = True
+
     # "Track this bus" button
     if vehicle and vehicle.latest_journey_id:
         if redis_client and redis_client.get(f"vehicle{vehicle.id}"):
@@ -1039,6 +1384,19 @@ def journey_json(request, pk, vehicle_id=None, service_id=None):
         locations = [
             VehicleLocation.decode_appendage(location) for location in locations
         ]
+    else:
+        locations = []
+
+    # moved out of Redis by archive_journey_history
+    # (perhaps only partly, if the journey was still going at the time)
+    archived = get_archived_locations(journey)
+    if archived:
+        timestamps = {location["id"] for location in locations}
+        locations += [
+            location for location in archived if location["id"] not in timestamps
+        ]
+
+    if locations:
         locations.sort(key=lambda location: location["datetime"])
 
         data["locations"] = []